@@ -1,182 +1,72 @@
 # Daniel Karkhut
 
+import sys
+
 import cv2
-import copy
-import os
-from detectors import Detectors
-from tracker import Tracker
-from cell import Cell
-from detectors import Detectors
-from tracker import Tracker
-from cell import Cell
-from tqdm import tqdm
+from pipeline import ProcessFolder
 
 
 # Input parameters
 blur, dilate, cellSize = 5,3,100
 BLOB_RADIUS_THRESH = 7
 DEBUG = False
+kalmanModel = "legacy" # Kalman filter of the tracks: "legacy" (x, y) or "cv" (constant velocity, follows fast cells better)
+maxTransitFrames = 500 # frames a cell may take to cross from traceStart to traceEnd
+grayscale = True # read frames single channel at the camera's bit depth; False reads them as 8-bit BGR
+levels = None # (low, high) camera values mapped to 0-255 for detection, e.g. (0, 4095) for 12-bit; None keeps the 8 high bits
+readerThreads, readAhead = 4, 16 # frames are read and decoded ahead of the loop
+parallelWorkers = 0 # >0 detects frames in that many processes (needs background = "static"), results as a serial run; crops are read back from disk and no video is written
+parallelMode = "chunks" # "chunks" of frames per process, or "frames": batches of frames with the detections returned through shared memory
+chunkSize = 1000 # frames per chunk
+frameBatch = 32 # frames per task of the "frames" mode
+writeVideo = True # False skips all drawing and output.avi for headless throughput runs
+overlayFade, overlayMaxLength, overlayScale = 0.02, None, 1.0 # trace fading per frame, trace points shown, video resolution
+cellWriterWorkers, cellWriterQueue = 2, 32 # completed cells are saved in the background
+saveVelGraph = True # False writes only t-v.csv, without rendering VelGraph.png
+exportCellDirectories = False # also write a Cell_<id> directory per cell next to the results store
+resultsShardSize, cropChunkSize = 256, 256 # cells per shard of the results store, crops per chunk of the crop archive
+checkpointEvery = 5000 # frames between checkpoints (0 for none); the video is written as one output_<n>.avi per checkpoint interval
+checkpointReplay = None # frames replayed to rebuild the background model on resume; None replays all and resumes exactly, e.g. 500 (the MOG2 history) is faster but centroids can differ from an uninterrupted run
+resume = "--resume" in sys.argv # python Main.py --resume continues from the last checkpoint
+follow = "--follow" in sys.argv # python Main.py --follow processes frames while the camera is still writing them
+followIdle = 60 # seconds without a new frame before follow mode ends
+profile = "--profile" in sys.argv # time every stage; metrics.jsonl in the results folder gets a line every metricsInterval seconds
+metricsInterval = 10
 # cameraFolder = "test"
 # cameraFolder = "/run/user/1000/gvfs/smb-share:server=128.180.65.44,share=e/BNF-Lab_Backup-V2/T4-Notch/T4-4/T4_Notch_day1_4_filtered"
 cameraFolder = "/media/mdi220/A806DEEB06DEB990/T4_Notch_day1/T4-3"
 resultsFolder = "T4_Notch_day1_B3_processed"
+# many folders: python batch.py manifest.json
 
 print("Processing files in folder: ", cameraFolder)
 
-if not os.path.exists(resultsFolder):
-    os.makedirs(resultsFolder)
 traceStart = 430
 traceEnd = 830
 # traceStart = 530
 # traceEnd = 730
-detector = Detectors(blur, dilate, BLOB_RADIUS_THRESH, DEBUG)
-
-
-
-# Create Object Tracker
-tracker = Tracker(100, 2, 5000, 100)
-
-
-currFrame = 0
-
-track_colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0),
-                        (0, 255, 255), (255, 0, 255), (255, 127, 255),
-                        (127, 0, 255), (127, 0, 127)]
-images = []
-# orig_images = []
-cell_length = []
-cell_boxes = []
-
-
-# Setup VideoWriter
-fourcc = cv2.VideoWriter_fourcc(*'MJPG')
-out = None
-
-
-# Loop through contents of camera folder
-file_list = sorted([f for f in os.listdir(cameraFolder) if f.endswith(".tiff")])
-for filename in tqdm(file_list, desc='Processing TIFF files'):
-    frame = cv2.imread(os.path.join(cameraFolder, filename))
-
-    if out is None:  # Initialize the VideoWriter once we know frame size
-        height, width = frame.shape[:2]
-        out = cv2.VideoWriter(f'{resultsFolder}/output.avi', fourcc, 20.0, (width, height))
-        if not out.isOpened():
-            print("Failed to open video writer")
-            break  # Exit if VideoWriter cannot open
-
-    images.append(frame)
-    
-    # Make copy of original frame
-    orig_frame = copy.copy(frame)
-    # orig_images.append(orig_frame)
-
-    # Detect and return centeroids of the objects in the frame
-    centers, contours_refined, frame_boxes = detector.Detect(frame)
-    radius = detector.Radius(frame, traceStart, traceEnd )
-    cell_length.append(radius)
-    cell_boxes.append(frame_boxes) 
-
-
-    # If centroids are detected then track them
-    if (len(centers) > 0):
-
-        # Track object using Kalman Filter
-        tracker.Update(centers)
-
-        # For identified object tracks draw tracking line
-        # Use various colors to indicate different track_id
-        for i in range(len(tracker.tracks)):
-            if (len(tracker.tracks[i].trace) > 1):
-                for j in range(len(tracker.tracks[i].trace)-1):
-                    #Draw trace lines and beginning/end lines
-                    x1 = tracker.tracks[i].trace[j][0][0]
-                    y1 = tracker.tracks[i].trace[j][1][0]
-                    x2 = tracker.tracks[i].trace[j+1][0][0]
-                    y2 = tracker.tracks[i].trace[j+1][1][0]
-                    clr = tracker.tracks[i].track_id % 9
-                    cv2.line(frame, (int(x1), int(y1)), (int(x2), int(y2)), track_colors[clr], 1)
-                    cv2.line(frame, (traceStart, 0), (traceStart, 1000), (255, 0, 0), 2)
-                    cv2.line(frame, (traceEnd, 0), (traceEnd, 1000), (255, 0, 0), 2)
-
-                    # Here means: tracker.tracks[which cell is trace being drawn for].trace[index of position of cell at specific frame][0 = x, 1 = y][unsure]
-                    # if cell trace begins before x = 200 and ends after x = 1000, save the trace and store the cell
-                    # used to save cell's movement
-                    if ( (tracker.tracks[i].trace[0][0][0] < traceStart) and (tracker.tracks[i].trace[len(tracker.tracks[i].trace)-1][0][0] > traceEnd) and (tracker.tracks[i].tracked == 0) ):
-                        #Make directory for new cell
-                        cellDirectory = resultsFolder + "/Cell_{}".format(tracker.tracks[i].track_id) 
-                        os.makedirs(cellDirectory, exist_ok=True)
-
-
-                        # create intermediary cell object
-                        cell = Cell(tracker.tracks[i].track_id, cellDirectory)
-
-                        # loop to capture full movement of cell
-                        for x in range(len(tracker.tracks[i].trace)):
-                            cell.updateValues(tracker.tracks[i].trace[x][0][0], tracker.tracks[i].trace[x][1][0])
-
-                            if (cell.indexFirstLineisPassed is None) and (tracker.tracks[i].trace[x][0][0] >= traceStart):
-                                cell.indexFirstLineisPassed = x 
-
-                            if (cell.indexMiddleLineisPassed is None) and (tracker.tracks[i].trace[x][0][0] >= ((traceStart + traceEnd)/2)):
-                                cell.indexMiddleLineisPassed = x
-
-                        # take last photo 
-                        k = currFrame 
-                        #photoFrame = cv2.imread(cameraFolder + "/" + str(k).zfill(6) + ".tiff") 
-                        photoFrame = orig_images[k]
-                        crop = photoFrame[(int(tracker.tracks[i].trace[-1][1][0])  - int(cellSize/2)):(int(tracker.tracks[i].trace[-1][1][0]) + int(cellSize/2)), (int(tracker.tracks[i].trace[-1][0][0]) - int(cellSize/2)):(int(tracker.tracks[i].trace[-1][0][0]) + int(cellSize/2))].copy()
-                        cell.lastCrop = crop
-
-                        # take first photo
-                        k = currFrame - (len(tracker.tracks[i].trace) + tracker.tracks[i].skipped_frames) + cell.indexFirstLineisPassed       
-                        #photoFrame = cv2.imread(cameraFolder + "/" + str(k).zfill(6) + ".tiff") 
-                        photoFrame = orig_images[k]
-                        crop = photoFrame[(int(tracker.tracks[i].trace[cell.indexFirstLineisPassed + tracker.tracks[i].skipped_frames][1][0]) - int(cellSize/2)):(int(tracker.tracks[i].trace[cell.indexFirstLineisPassed + tracker.tracks[i].skipped_frames][1][0]) + int(cellSize/2)), (int(tracker.tracks[i].trace[cell.indexFirstLineisPassed + tracker.tracks[i].skipped_frames][0][0]) - int(cellSize/2)):(int(tracker.tracks[i].trace[cell.indexFirstLineisPassed + tracker.tracks[i].skipped_frames][0][0]) + int(cellSize/2))].copy()
-                        cell.firstCrop = crop
-
-                        #take middle photo
-                        k = currFrame - (len(tracker.tracks[i].trace) + tracker.tracks[i].skipped_frames) + cell.indexMiddleLineisPassed
-                        #photoFrame = cv2.imread(cameraFolder + "/" + str(k).zfill(6) + ".tiff") 
-                        photoFrame = orig_images[k]
-                        crop = photoFrame[(0):(photoFrame.shape[0]), (int(tracker.tracks[i].trace[cell.indexMiddleLineisPassed][0][0]) - int(cellSize)):(int(tracker.tracks[i].trace[cell.indexMiddleLineisPassed][0][0]) + int(cellSize))].copy()
-                        cell.midCrop = crop
-
-
-                        cell.deformationIndex(cell_boxes[(currFrame - (len(tracker.tracks[i].trace) + tracker.tracks[i].skipped_frames) + cell.indexFirstLineisPassed):currFrame])
-                        # Assuming you are within a loop where `i` is the index of the current track
-                       
-                        # remove cell from being tracked again by setting initial position high
-                        tracker.tracks[i].tracked = 1
-
-                        cell.generateVelGraph()
-                        cell.saveImage()
-
-                        del cell
-    
-    # Draw vertical lines at traceStart and traceEnd
-    height = frame.shape[0]
-    cv2.line(frame, (traceStart, 0), (traceStart, height), (255, 0, 0), 2)  # Red line at traceStart
-    cv2.line(frame, (traceEnd, 0), (traceEnd, height), (255, 0, 0), 2)      # Red line at traceEnd
-
-
-    for contour in contours_refined:
-        cv2.drawContours(frame, [contour], -1, (255, 0, 0), 1)
-
-    # After detecting centers, contours, and frame_boxes
-    for x, y, w, h in frame_boxes:
-        cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 0, 255), 1)
-
-    out.write(frame)
-
-    DEBUG  = 0
-    if DEBUG:
-        cv2.imshow('frame', frame)
-        if cv2.waitKey(1) & 0xFF == ord('q'):  # Press 'q' to quit
-            break
-    currFrame = currFrame + 1
-
-
-    # Release everything when job is finished
-out.release()
+roiMargin = 100 # detect this far outside the trace band so tracks start before traceStart
+background = "mog2" # "static": one median background of sampled frames (fixed channel, steady light), "running": average updated every few frames
+backgroundThreshold, backgroundPercentile, backgroundSamples = 15, 50, 200 # static: foreground threshold, percentile of backgroundSamples frames
+backgroundRate, backgroundEvery = 0.05, 10 # running: update weight, frames between updates
+
+summary = ProcessFolder(cameraFolder, resultsFolder,
+                        blur=blur, dilate=dilate, cellSize=cellSize, blobRadiusThresh=BLOB_RADIUS_THRESH,
+                        traceStart=traceStart, traceEnd=traceEnd, roiMargin=roiMargin,
+                        background=background, backgroundThreshold=backgroundThreshold,
+                        backgroundPercentile=backgroundPercentile, backgroundSamples=backgroundSamples,
+                        backgroundRate=backgroundRate, backgroundEvery=backgroundEvery,
+                        kalmanModel=kalmanModel, maxTransitFrames=maxTransitFrames, grayscale=grayscale, levels=levels, readerThreads=readerThreads, readAhead=readAhead,
+                        parallelWorkers=parallelWorkers, parallelMode=parallelMode,
+                        chunkSize=chunkSize, frameBatch=frameBatch,
+                        writeVideo=writeVideo, overlayFade=overlayFade, overlayMaxLength=overlayMaxLength,
+                        overlayScale=overlayScale, cellWriterWorkers=cellWriterWorkers, cellWriterQueue=cellWriterQueue,
+                        saveVelGraph=saveVelGraph, exportCellDirectories=exportCellDirectories,
+                        resultsShardSize=resultsShardSize, cropChunkSize=cropChunkSize,
+                        checkpointEvery=checkpointEvery, checkpointReplay=checkpointReplay, resume=resume,
+                        follow=follow, followIdle=followIdle,
+                        profile=profile, metricsInterval=metricsInterval,
+                        debug=DEBUG)
+
+print("{} cells saved, {} failed".format(summary["cells"], summary["failed"]))
+print(summary["source"])
 cv2.destroyAllWindows()
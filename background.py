@@ -0,0 +1,207 @@
+'''
+    File name         : background.py
+    File Description  : Background models separating cells from the channel
+    Python Version    : 3
+'''
+
+# Import python libraries
+import cv2
+import numpy as np
+
+# Names of the models MakeBackground builds
+BACKGROUNDS = ("mog2", "static", "running")
+# Sampled pixels StaticBackground.Fit converts to float at a time, in bytes
+BLOCK_BYTES = 32 * 1024 * 1024
+
+
+class MOG2Background(object):
+    """MOG2Background class wraps OpenCV's MOG2 subtractor, a per-pixel
+    Gaussian mixture updated with every frame. It follows lighting drift
+    and debris that settles in the channel, and is the most expensive
+    model. Foreground is 255, shadows (if detected) 127.
+    The OpenCV model cannot be pickled; a pickled copy, e.g. for a worker
+    process, starts with an empty model.
+    Attributes:
+        adaptive: the model changes with the frames it is applied to
+    """
+    adaptive = True
+
+    def __init__(self, history=500, var_threshold=16, detect_shadows=True):
+        """Initialize variables used by MOG2Background class
+        Args:
+            history, var_threshold, detect_shadows: MOG2 parameters
+        Return:
+            None
+        """
+        self.history = history
+        self.var_threshold = var_threshold
+        self.detect_shadows = detect_shadows
+        self.fgbg = cv2.createBackgroundSubtractorMOG2(history, var_threshold, detect_shadows)
+
+    def __getstate__(self):
+        return {"history": self.history, "var_threshold": self.var_threshold,
+                "detect_shadows": self.detect_shadows}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def Fit(self, images):
+        """Nothing to precompute, the model learns while it is applied"""
+        pass
+
+    def Apply(self, image):
+        """Foreground mask of an image, updating the model
+        Args:
+            image: 8-bit single channel image
+        Return:
+            uint8 foreground mask
+        """
+        return self.fgbg.apply(image)
+
+
+class StaticBackground(object):
+    """StaticBackground class holds one background image, the per-pixel
+    median (or another percentile) of frames sampled across the
+    acquisition, and marks as foreground every pixel that differs from it
+    by more than threshold. For a fixed channel under steady light the
+    background does not change, so a frame needs one absdiff and one
+    threshold, and frames can be processed in any order.
+    Attributes:
+        adaptive: the model changes with the frames it is applied to
+        image: background image, None until Fit
+    """
+    adaptive = False
+
+    def __init__(self, threshold=15, percentile=50):
+        """Initialize variables used by StaticBackground class
+        Args:
+            threshold: smallest absolute difference from the background
+                       that is foreground
+            percentile: per-pixel percentile of the sampled frames, 50
+                        for the median; cells darker than the channel
+                        are rejected better by a higher percentile when
+                        the channel is crowded
+        Return:
+            None
+        """
+        self.threshold = threshold
+        self.percentile = percentile
+        self.image = None
+
+    def Fit(self, images):
+        """Compute the background image
+        Args:
+            images: 8-bit single channel images sampled across the
+                    acquisition, preprocessed like the images Apply gets
+        Return:
+            None
+        """
+        images = list(images)
+        if not images:
+            raise ValueError("no images to compute the background from")
+        # the percentile works in float64; take it over blocks of rows so
+        # only about BLOCK_BYTES of the samples are converted at a time
+        height, width = images[0].shape[:2]
+        rows = max(1, BLOCK_BYTES // (8 * len(images) * width))
+        self.image = np.empty(images[0].shape, dtype=np.uint8)
+        for top in range(0, height, rows):
+            block = np.stack([image[top:top + rows] for image in images])
+            self.image[top:top + rows] = np.round(np.percentile(block, self.percentile, axis=0))
+
+    def Apply(self, image):
+        """Foreground mask of an image
+        Args:
+            image: 8-bit single channel image
+        Return:
+            uint8 foreground mask, 0 or 255
+        """
+        if self.image is None:
+            raise ValueError("StaticBackground has not been fitted")
+        return cv2.threshold(cv2.absdiff(image, self.image), self.threshold, 255, cv2.THRESH_BINARY)[1]
+
+
+class RunningAverageBackground(object):
+    """RunningAverageBackground class keeps an exponentially weighted
+    average of the frames as background and marks as foreground every
+    pixel that differs from it by more than threshold. The average is
+    updated every every frames, from the background pixels only, so
+    passing cells do not bleed into it. It follows slow drift at a
+    fraction of the cost of MOG2.
+    Attributes:
+        adaptive: the model changes with the frames it is applied to
+    """
+    adaptive = True
+
+    def __init__(self, threshold=15, rate=0.05, every=10):
+        """Initialize variables used by RunningAverageBackground class
+        Args:
+            threshold: smallest absolute difference from the background
+                       that is foreground
+            rate: weight of a frame in the average
+            every: frames between updates of the average
+        Return:
+            None
+        """
+        if every < 1:
+            raise ValueError("every must be at least 1")
+        self.threshold = threshold
+        self.rate = rate
+        self.every = every
+        self.average = None  # float32 average
+        self.image = None  # the average as 8-bit
+        self.count = 0
+
+    def Fit(self, images):
+        """Nothing to precompute, the first frame starts the average"""
+        pass
+
+    def Apply(self, image):
+        """Foreground mask of an image, updating the average every every
+        frames
+        Args:
+            image: 8-bit single channel image
+        Return:
+            uint8 foreground mask, 0 or 255
+        """
+        if self.average is None:
+            self.average = image.astype(np.float32)
+            self.image = image.copy()
+        mask = cv2.threshold(cv2.absdiff(image, self.image), self.threshold, 255, cv2.THRESH_BINARY)[1]
+        self.count += 1
+        if self.count % self.every == 0:
+            cv2.accumulateWeighted(image, self.average, self.rate, mask=cv2.bitwise_not(mask))
+            self.image = cv2.convertScaleAbs(self.average)
+        return mask
+
+
+def MakeBackground(name="mog2", threshold=15, percentile=50, rate=0.05, every=10):
+    """Background model by name
+    Args:
+        name: "mog2" (MOG2Background), "static" (StaticBackground, needs
+              Fit) or "running" (RunningAverageBackground)
+        threshold: foreground threshold of the static and running models
+        percentile: percentile of the static model
+        rate, every: update weight and interval of the running model
+    Return:
+        background model
+    """
+    if name == "mog2":
+        return MOG2Background()
+    if name == "static":
+        return StaticBackground(threshold, percentile)
+    if name == "running":
+        return RunningAverageBackground(threshold, rate, every)
+    raise ValueError("background must be one of {}".format(", ".join(BACKGROUNDS)))
+
+
+def SampleIndices(n_frames, samples):
+    """Indices of samples frames spread evenly over n_frames
+    Args:
+        n_frames: number of frames
+        samples: number of frames wanted
+    Return:
+        sorted list of distinct frame indices
+    """
+    if n_frames <= 0:
+        return []
+    return sorted(set(np.linspace(0, n_frames - 1, min(samples, n_frames)).round().astype(int).tolist()))
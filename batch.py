@@ -0,0 +1,173 @@
+'''
+    File name         : batch.py
+    File Description  : Batch runner processing many camera folders concurrently
+    Python Version    : 3
+'''
+
+# Import python libraries
+import argparse
+import inspect
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import time
+import traceback
+
+from pipeline import IsComplete, ProcessFolder
+
+# ProcessFolder parameters a manifest may set, per job or in "defaults";
+# jobs never show a progress bar
+PARAMETERS = [name for name in inspect.signature(ProcessFolder).parameters
+              if name not in ("cameraFolder", "resultsFolder", "progress")]
+
+
+def LoadManifest(path):
+    """Read a batch manifest, a JSON file like
+        {"defaults": {"writeVideo": false, "memoryLimitMB": 8000},
+         "jobs": [{"cameraFolder": "T4_Notch_day1/T4-3",
+                   "resultsFolder": "T4_Notch_day1_B3_processed",
+                   "blur": 5, "traceStart": 430, "traceEnd": 830}, ...]}
+    Every job needs cameraFolder and resultsFolder; other keys are
+    ProcessFolder parameters or memoryLimitMB, and override the defaults.
+    Relative folders are relative to the manifest.
+    Args:
+        path: manifest file
+    Return:
+        list of job dicts with the defaults applied
+    """
+    with open(path) as file:
+        manifest = json.load(file)
+    base = os.path.dirname(os.path.abspath(path))
+    defaults = manifest.get("defaults", {})
+    jobs = []
+    for i, entry in enumerate(manifest["jobs"]):
+        job = dict(defaults, **entry)
+        for key in ("cameraFolder", "resultsFolder"):
+            if key not in job:
+                raise ValueError("job {} has no {}".format(i, key))
+            job[key] = os.path.join(base, job[key])
+        unknown = set(job) - set(PARAMETERS) - {"cameraFolder", "resultsFolder", "memoryLimitMB"}
+        if unknown:
+            raise ValueError("job {}: unknown parameters {}".format(i, sorted(unknown)))
+        jobs.append(job)
+    return jobs
+
+
+def _RunJob(index, job, results):
+    """Process one job in a worker process and report to the results queue"""
+    job = dict(job)
+    limit = job.pop("memoryLimitMB", None)
+    if limit:
+        # address space limit; allocations beyond it raise MemoryError
+        limit = int(limit) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    try:
+        summary = ProcessFolder(progress=False, **job)
+        summary["maxRssMB"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+        results.put((index, "done", summary))
+    except BaseException as e:
+        results.put((index, "failed", {"error": repr(e), "traceback": traceback.format_exc()}))
+
+
+def RunBatch(jobs, concurrency=1, force=False):
+    """Run jobs with at most concurrency of them at a time, each in its
+    own process (so a job's memory is returned when it ends and a crash
+    or memory limit only fails that job). Jobs whose results folder is
+    already complete are skipped unless force is set.
+    Args:
+        jobs: job dicts, see LoadManifest
+        concurrency: number of jobs run at the same time
+        force: reprocess complete folders
+    Return:
+        list of per-job summary dicts, in job order
+    """
+    results = multiprocessing.Queue()
+    summaries = [None] * len(jobs)
+    queued = []
+    for index, job in enumerate(jobs):
+        if not force and IsComplete(job["cameraFolder"], job["resultsFolder"]):
+            summaries[index] = {"status": "skipped"}
+        else:
+            queued.append(index)
+    queued.reverse()
+
+    running = {}  # index -> (process, start time)
+    while queued or running:
+        while queued and len(running) < concurrency:
+            index = queued.pop()
+            process = multiprocessing.Process(target=_RunJob, args=(index, jobs[index], results))
+            process.start()
+            running[index] = (process, time.perf_counter())
+            print("Started {}".format(jobs[index]["cameraFolder"]))
+
+        # collect results; a job that died without one has failed. A job
+        # puts its result before it exits, so drain after checking
+        exited = [index for index, (process, _) in running.items() if not process.is_alive()]
+        messages = []
+        try:
+            messages.append(results.get(timeout=1.0))
+            while True:
+                messages.append(results.get_nowait())
+        except queue.Empty:
+            pass
+        for index, status, summary in messages:
+            process, start = running.pop(index)
+            process.join()
+            summary["status"] = status
+            summary.setdefault("seconds", round(time.perf_counter() - start, 3))
+            summaries[index] = summary
+            print("{} {}".format("Finished" if status == "done" else "Failed", jobs[index]["cameraFolder"]))
+        for index in exited:
+            if index in running:
+                process, start = running.pop(index)
+                process.join()
+                summaries[index] = {"status": "failed", "seconds": round(time.perf_counter() - start, 3),
+                                    "error": "worker exited with code {}".format(process.exitcode)}
+                print("Failed {}: {}".format(jobs[index]["cameraFolder"], summaries[index]["error"]))
+
+    for job, summary in zip(jobs, summaries):
+        summary.setdefault("cameraFolder", job["cameraFolder"])
+        summary.setdefault("resultsFolder", job["resultsFolder"])
+    return summaries
+
+
+def FormatSummary(summaries):
+    """Table of per-job status and throughput"""
+    lines = ["{:<8} {:>8} {:>7} {:>9} {:>8} {:>9}  {}".format(
+        "status", "frames", "cells", "seconds", "fps", "maxRssMB", "cameraFolder")]
+    for s in summaries:
+        lines.append("{:<8} {:>8} {:>7} {:>9} {:>8} {:>9}  {}".format(
+            s["status"], s.get("frames", "-"), s.get("cells", "-"), s.get("seconds", "-"),
+            s.get("fps", "-"), s.get("maxRssMB", "-"), s["cameraFolder"]))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process the camera folders of a batch manifest")
+    parser.add_argument("manifest", help="JSON manifest, see LoadManifest")
+    parser.add_argument("--jobs", type=int, default=1, help="folders processed at the same time")
+    parser.add_argument("--memory-limit", type=int, default=None,
+                        help="default per-job memory limit in MB")
+    parser.add_argument("--force", action="store_true", help="reprocess complete folders")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue interrupted folders from their last checkpoint")
+    parser.add_argument("--summary", default=None,
+                        help="summary JSON file (default: <manifest>.summary.json)")
+    args = parser.parse_args()
+
+    jobs = LoadManifest(args.manifest)
+    if args.memory_limit:
+        for job in jobs:
+            job.setdefault("memoryLimitMB", args.memory_limit)
+    if args.resume:
+        for job in jobs:
+            job.setdefault("resume", True)
+    summaries = RunBatch(jobs, args.jobs, args.force)
+    print(FormatSummary(summaries))
+    path = args.summary or os.path.splitext(args.manifest)[0] + ".summary.json"
+    with open(path, "w") as file:
+        json.dump(summaries, file, indent=1)
+    failed = sum(s["status"] == "failed" for s in summaries)
+    raise SystemExit(1 if failed else 0)
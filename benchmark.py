@@ -0,0 +1,513 @@
+'''
+    File name         : benchmark.py
+    File Description  : Throughput benchmarks for the tracking pipeline
+    Python Version    : 3
+'''
+
+# Import python libraries
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from background import BACKGROUNDS, MakeBackground, SampleIndices
+from detectors import Detectors
+from frame_source import IMREAD_NATIVE, ListFrames, ReadFrame
+from synthetic import CellAccuracy, DetectionAccuracy, FlowSequence, LoadTruth, TrackingAccuracy
+from tracker import Tracker
+
+
+def LoadFrames(folder, n_frames, levels=None):
+    """Load the first n_frames TIFFs of a camera folder as 8-bit single
+    channel frames, as the pipeline reads them
+    Args:
+        folder: camera folder
+        n_frames: number of frames to load
+        levels: 8-bit mapping of the frames, see ToGray8
+    Return:
+        list of frames
+    """
+    return [ReadFrame(os.path.join(folder, f), IMREAD_NATIVE, levels) for f in ListFrames(folder)[:n_frames]]
+
+
+def _Rate(n, seconds):
+    return n / seconds if seconds > 0 else float("inf")
+
+
+def BenchDetection(frames, blur, dilate, traceStart, traceEnd, roiMargin):
+    """Compare two-pass Detect + Radius against single-pass DetectAll,
+    with and without the radius, on the full frame and restricted to the
+    trace band
+    Args:
+        frames: list of frames
+        blur, dilate: Detectors parameters
+        traceStart, traceEnd: tracking lines
+        roiMargin: margin around the trace band
+    Return:
+        dict of frames/sec per method
+    """
+    results = {}
+
+    detector = Detectors(blur, dilate)
+    start = time.perf_counter()
+    for frame in frames:
+        detector.Detect(frame)
+        detector.Radius(frame, traceStart, traceEnd)
+    results["Detect+Radius"] = _Rate(len(frames), time.perf_counter() - start)
+
+    detector = Detectors(blur, dilate)
+    start = time.perf_counter()
+    for frame in frames:
+        detector.DetectAll(frame, traceStart, traceEnd, radius=True)
+    results["DetectAll"] = _Rate(len(frames), time.perf_counter() - start)
+
+    detector = Detectors(blur, dilate)
+    start = time.perf_counter()
+    for frame in frames:
+        detector.DetectAll(frame, traceStart, traceEnd)
+    results["DetectAll, no radius"] = _Rate(len(frames), time.perf_counter() - start)
+
+    detector = Detectors(blur, dilate, roi=(traceStart, 0, traceEnd - traceStart, None),
+                         roi_margin=roiMargin)
+    start = time.perf_counter()
+    for frame in frames:
+        detector.DetectAll(frame, traceStart, traceEnd)
+    results["DetectAll + ROI"] = _Rate(len(frames), time.perf_counter() - start)
+
+    return results
+
+
+def SyntheticDetections(n_objects, n_frames, height=1000, seed=0):
+    """Generate centroids of objects flowing along x at constant density
+    The channel gets longer with the object count, so the number of
+    neighbours within the gating distance stays about the same.
+    Args:
+        n_objects: objects per frame
+        n_frames: number of frames
+        height: channel height in pixels
+        seed: random seed
+    Return:
+        list (per frame) of lists of (2, 1) centroids
+    """
+    rng = np.random.default_rng(seed)
+    width = max(1280.0, 4e5 * n_objects / height)
+    position = np.column_stack((rng.uniform(0, width, n_objects),
+                                rng.uniform(0, height, n_objects)))
+    speed = rng.uniform(6, 10, n_objects)
+    sequence = []
+    for _ in range(n_frames):
+        position[:, 0] = (position[:, 0] + speed) % width
+        jitter = rng.normal(0, 0.5, position.shape)
+        sequence.append([p.reshape(2, 1) for p in np.round(position + jitter)])
+    return sequence
+
+
+def BenchTracking(counts, n_frames, dist_thresh=100):
+    """Per-frame Tracker.Update latency for dense and sparse gating
+    Args:
+        counts: objects per frame to test
+        n_frames: frames per run
+        dist_thresh: tracker distance threshold
+    Return:
+        dict of milliseconds/frame per (gating, count)
+    """
+    results = {}
+    for n in counts:
+        sequence = SyntheticDetections(n, n_frames)
+        for gating in ("dense", "sparse"):
+            tracker = Tracker(dist_thresh, 2, 5000, 100, gating=gating)
+            tracker.Update(sequence[0])
+            start = time.perf_counter()
+            for detections in sequence[1:]:
+                tracker.Update(detections)
+            elapsed = time.perf_counter() - start
+            results["{} {:>5}".format(gating, n)] = 1000.0 * elapsed / (n_frames - 1)
+    return results
+
+
+def BenchPlotting(n_cells, length, folder):
+    """Per-cell VelGraph.png time: global pyplot state machine (as cells
+    used to be plotted) against the reusable VelGraph template
+    Args:
+        n_cells: number of graphs per method
+        length: points per graph
+        folder: folder to write the PNGs to
+    Return:
+        dict of milliseconds/cell per method
+    """
+    from matplotlib import pyplot as plt
+    from cell import VelGraph
+
+    rng = np.random.default_rng(0)
+    speeds = [rng.normal(8, 1, length + rng.integers(-20, 20)) for _ in range(n_cells)]
+    results = {}
+
+    start = time.perf_counter()
+    for v in speeds:
+        plt.title("Speed vs Time")
+        plt.xlabel("Time (frames)")
+        plt.ylabel("Speed (mm)")
+        plt.plot(range(len(v)), v)
+        plt.savefig(folder + "/pyplot.png")
+        plt.clf()
+    results["pyplot"] = 1000.0 * (time.perf_counter() - start) / n_cells
+
+    template = VelGraph()
+    start = time.perf_counter()
+    for v in speeds:
+        template.save(np.arange(len(v)), v, folder + "/template.png")
+    results["VelGraph template"] = 1000.0 * (time.perf_counter() - start) / n_cells
+    return results
+
+
+def SuiteDetection(folder, blur=5, dilate=3, traceStart=430, traceEnd=830, roiMargin=100,
+                   background="mog2", samples=200, warmup=100, radius=10.0):
+    """Detection-only benchmark on a synthetic sequence: DetectAll
+    frames/sec, and recall and precision against the ground truth inside
+    the detected band once the background model has had warmup frames.
+    Frames are read one at a time, outside the timing, so the peak memory
+    is that of detection and not of the sequence
+    Args:
+        folder: sequence written by FlowSequence.Write
+        blur, dilate, traceStart, traceEnd, roiMargin: detector parameters
+        background: background model name, see MakeBackground
+        samples: frames a static background is estimated from
+        warmup: frames left out of the accuracy
+        radius: largest distance of a detection from its cell
+    Return:
+        dict of metrics; fit_seconds is the time taken to read the
+        samples and estimate a static background, not included in fps
+    """
+    truth, _ = LoadTruth(folder)
+    files = [os.path.join(folder, f) for f in ListFrames(folder)]
+    detector = Detectors(blur, dilate, roi=(traceStart, 0, traceEnd - traceStart, None), roi_margin=roiMargin,
+                         background=MakeBackground(background))
+    start = time.perf_counter()
+    detector.FitBackground(ReadFrame(files[i], IMREAD_NATIVE) for i in SampleIndices(len(files), samples))
+    fit_seconds = time.perf_counter() - start
+    detections = []
+    seconds = 0.0
+    for path in files:
+        frame = ReadFrame(path, IMREAD_NATIVE)
+        start = time.perf_counter()
+        detections.append(detector.DetectAll(frame, traceStart, traceEnd)[0])
+        seconds += time.perf_counter() - start
+
+    # cells cut by the edge of the band are not counted either way
+    low, high = traceStart - roiMargin + 2 * radius, traceEnd + roiMargin - 2 * radius
+    truth = truth[(truth["x"] >= low) & (truth["x"] < high)]
+    points = []
+    for centers in detections:
+        centers = np.array(centers, dtype=np.float64).reshape(-1, 2)
+        points.append(centers[(centers[:, 0] >= low) & (centers[:, 0] < high)])
+    metrics = {"fps": _Rate(len(files), seconds), "fit_seconds": fit_seconds, "frames": len(files)}
+    metrics.update(DetectionAccuracy(truth, points, radius, warmup))
+    return metrics
+
+
+def SuiteTracking(folder, distThresh=100, maxFramesToSkip=2, traceStart=430, traceEnd=830,
+                  gating="dense", dropout=0.02, jitter=0.5, seed=0, radius=10.0):
+    """Tracking-only benchmark: Tracker.Update on the ground-truth
+    centroids with position jitter and randomly dropped detections. The
+    true cell of every detection is kept as its tracker record, so ID
+    switches are counted without matching positions
+    Args:
+        folder: sequence written by FlowSequence.Write
+        distThresh, maxFramesToSkip, traceStart, traceEnd, gating:
+            Tracker parameters
+        dropout: probability of a detection being dropped
+        jitter: standard deviation of the centroid noise in pixels
+        seed: random seed of dropout and jitter
+        radius: largest distance of a saved cell's points from its cell
+    Return:
+        dict of metrics, cell metrics prefixed with cells_
+    """
+    truth, parameters = LoadTruth(folder)
+    rng = np.random.default_rng(seed)
+    n_frames = parameters["n_frames"]
+    # record 0 marks a frame in which a track was not detected
+    record = np.dtype([("cell", np.int64)])
+    sequence = [([], []) for _ in range(n_frames)]
+    for frame_idx, id, x, y in zip(truth["frame"].tolist(), truth["id"].tolist(), truth["x"], truth["y"]):
+        if rng.random() >= dropout:
+            sequence[frame_idx][0].append(np.round(np.array([[x], [y]]) + rng.normal(0, jitter, (2, 1))))
+            sequence[frame_idx][1].append(id + 1)
+
+    tracker = Tracker(distThresh, maxFramesToSkip, 5000, 100, gating=gating,
+                      trace_start=traceStart, trace_end=traceEnd, record_dtype=record)
+    frames, track_ids, cell_ids = [], [], []
+    cells = {}
+    seconds = 0.0
+    for frame_idx, (detections, truth_ids) in enumerate(sequence):
+        if not detections:
+            continue
+        records = np.array([(id,) for id in truth_ids], dtype=record)
+        start = time.perf_counter()
+        completed = tracker.Update(detections, frame_idx, records)
+        seconds += time.perf_counter() - start
+        for event in completed:
+            trace = event.track.trace
+            cells[event.track.track_id] = {"frame": np.array(trace.frames), "x": np.array(trace.x), "y": np.array(trace.y)}
+        for track in tracker.tracks:
+            if len(track.trace) > 0 and track.trace.frames[-1] == frame_idx:
+                cell = int(track.trace.Records()[-1]["cell"])
+                if cell > 0:
+                    frames.append(frame_idx)
+                    track_ids.append(track.track_id)
+                    cell_ids.append(cell - 1)
+
+    metrics = {"fps": _Rate(n_frames, seconds), "ms_per_frame": 1000.0 * seconds / n_frames}
+    metrics.update(TrackingAccuracy(truth, frames, track_ids, cell_ids))
+    for name, value in CellAccuracy(truth, cells, traceStart, traceEnd, radius).items():
+        metrics["cells_" + name] = value
+    return metrics
+
+
+def SuiteEndToEnd(folder, traceStart=430, traceEnd=830, radius=10.0, resultsFolder=None, **parameters):
+    """End-to-end benchmark: ProcessFolder on a synthetic sequence, the
+    saved cells compared with the cells that crossed the trace band
+    Args:
+        folder: sequence written by FlowSequence.Write
+        traceStart, traceEnd: trace lines
+        radius: largest distance of a cell point from the true cell
+        resultsFolder: results folder, default a temporary folder
+        parameters: further ProcessFolder parameters
+    Return:
+        dict of metrics
+    """
+    from pipeline import ProcessFolder
+    from results_store import ResultsReader
+
+    truth, _ = LoadTruth(folder)
+    with tempfile.TemporaryDirectory() as temporary:
+        results = resultsFolder or temporary
+        summary = ProcessFolder(folder, results, traceStart=traceStart, traceEnd=traceEnd,
+                                progress=False, **parameters)
+        reader = ResultsReader(os.path.join(results, "results"))
+        points = reader.Points(["frame", "x", "y"])
+        saved = reader.Cells(["id", "mean_deformation"])
+    deformation = dict(zip(saved["id"].tolist(), saved["mean_deformation"].tolist()))
+    metrics = {"fps": summary["fps"], "seconds": summary["seconds"], "cells_failed": summary["failed"]}
+    metrics.update(CellAccuracy(truth, points, traceStart, traceEnd, radius, deformation))
+    return metrics
+
+
+SUITE = {"detection": SuiteDetection, "tracking": SuiteTracking, "end-to-end": SuiteEndToEnd}
+
+
+def _RunChild(name, kwargs, results):
+    """Run one suite benchmark in a child process and report its peak memory"""
+    try:
+        metrics = SUITE[name](**kwargs)
+        metrics["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+        results.put(("done", metrics))
+    except BaseException as e:
+        results.put(("failed", {"error": repr(e)}))
+
+
+def RunIsolated(name, **kwargs):
+    """Run a suite benchmark in a fresh (spawned) process, so its peak
+    memory is its own and not that of earlier benchmarks
+    Args:
+        name: key of SUITE
+        kwargs: arguments of the benchmark
+    Return:
+        dict of metrics with peak_rss_mb
+    """
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_RunChild, args=(name, kwargs, results))
+    process.start()
+    status, metrics = results.get()
+    process.join()
+    if status != "done":
+        raise RuntimeError("{} benchmark failed: {}".format(name, metrics["error"]))
+    return metrics
+
+
+def _Version():
+    """git describe of the checkout, "unknown" outside a git checkout"""
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def Record(name, folder, parameters, metrics, version=None):
+    """Result record of one suite benchmark, one line of a results file
+    Args:
+        name: benchmark name
+        folder: sequence folder
+        parameters: benchmark parameters
+        metrics: dict of metrics
+        version: code version, default git describe
+    Return:
+        dict
+    """
+    _, sequence = LoadTruth(folder)
+    return {"benchmark": name, "version": version or _Version(),
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "host": platform.node(), "python": platform.python_version(),
+            "numpy": np.__version__, "opencv": cv2.__version__,
+            "sequence": sequence, "parameters": parameters, "metrics": metrics}
+
+
+def AppendRecord(path, record):
+    """Append a record to a JSON-lines results file"""
+    with open(path, "a") as file:
+        file.write(json.dumps(record) + "\n")
+
+
+def Compare(path, baseline=None):
+    """Compare the latest result of every benchmark configuration with a
+    baseline: the latest result of version baseline, or else the one
+    before the latest
+    Args:
+        path: JSON-lines results file
+        baseline: version to compare with
+    Return:
+        report string
+    """
+    with open(path) as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    groups = {}
+    for record in records:
+        key = (record["benchmark"], json.dumps(record["sequence"], sort_keys=True),
+               json.dumps(record["parameters"], sort_keys=True))
+        groups.setdefault(key, []).append(record)
+    lines = []
+    for (name, _, parameters), runs in groups.items():
+        current = runs[-1]
+        if baseline is None:
+            base = runs[-2] if len(runs) > 1 else None
+        else:
+            base = next((run for run in reversed(runs) if run["version"] == baseline), None)
+        lines.append("{} {} ({} vs {})".format(name, parameters, current["version"],
+                                               base["version"] if base else "no baseline"))
+        for metric, value in current["metrics"].items():
+            old = base["metrics"].get(metric) if base else None
+            if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old != 0:
+                change = "{:+.1f}%".format(100.0 * (value - old) / abs(old))
+            else:
+                change = ""
+            lines.append("  {:<22} {:>12} {:>12} {:>8}".format(
+                metric, _Format(old) if base else "-", _Format(value), change))
+    return "\n".join(lines)
+
+
+def _Format(value):
+    return "{:.4g}".format(value) if isinstance(value, float) else str(value)
+
+
+def _Print(title, results):
+    print(title)
+    for name, value in results.items():
+        print("  {:<24} {:10.1f}".format(name, value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput benchmarks for the tracking pipeline")
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    detection = sub.add_parser("detection", help="frames/sec of detection")
+    detection.add_argument("--folder", help="camera folder (default: a synthetic FlowSequence)")
+    detection.add_argument("--frames", type=int, default=300)
+    detection.add_argument("--width", type=int, default=1280)
+    detection.add_argument("--height", type=int, default=240)
+    detection.add_argument("--levels", type=int, nargs=2, default=None, help="8-bit mapping of the camera folder frames")
+    detection.add_argument("--blur", type=int, default=5)
+    detection.add_argument("--dilate", type=int, default=3)
+    detection.add_argument("--trace-start", type=int, default=430)
+    detection.add_argument("--trace-end", type=int, default=830)
+    detection.add_argument("--roi-margin", type=int, default=100)
+
+    tracking = sub.add_parser("tracking", help="Tracker.Update latency vs objects per frame")
+    tracking.add_argument("--counts", type=int, nargs="+",
+                          default=[10, 50, 100, 250, 500, 1000, 2000])
+    tracking.add_argument("--frames", type=int, default=20)
+    tracking.add_argument("--dist-thresh", type=float, default=100)
+
+    plotting = sub.add_parser("plotting", help="VelGraph.png rendering time per cell")
+    plotting.add_argument("--cells", type=int, default=50)
+    plotting.add_argument("--length", type=int, default=100)
+    plotting.add_argument("--folder", default=".")
+
+    generate = sub.add_parser("generate", help="write a synthetic sequence with ground truth")
+    generate.add_argument("folder")
+    generate.add_argument("--frames", type=int, default=1000)
+    generate.add_argument("--width", type=int, default=1280)
+    generate.add_argument("--height", type=int, default=240)
+    generate.add_argument("--spawn-rate", type=float, default=0.1, help="cells entering per frame")
+    generate.add_argument("--radius", type=float, nargs=2, default=[10.0, 14.0])
+    generate.add_argument("--speed", type=float, nargs=2, default=[6.0, 10.0], help="pixels per frame")
+    generate.add_argument("--deformation", type=float, nargs=2, default=[0.0, 0.3])
+    generate.add_argument("--noise", type=float, default=3.0)
+    generate.add_argument("--seed", type=int, default=0)
+
+    suite = sub.add_parser("suite", help="detection, tracking and end-to-end benchmarks of a synthetic sequence")
+    suite.add_argument("folder", help="sequence written by generate")
+    suite.add_argument("--results", default="benchmarks.jsonl", help="JSON-lines file the results are appended to")
+    suite.add_argument("--only", nargs="+", choices=sorted(SUITE), default=["detection", "tracking", "end-to-end"])
+    suite.add_argument("--trace-start", type=int, default=430)
+    suite.add_argument("--trace-end", type=int, default=830)
+    suite.add_argument("--background", nargs="+", choices=BACKGROUNDS, default=["mog2"],
+                       help="background models of the detection and end-to-end benchmarks")
+    suite.add_argument("--gating", choices=["dense", "sparse"], default="dense", help="tracker gating of the tracking benchmark")
+    suite.add_argument("--version", default=None, help="version recorded (default: git describe)")
+
+    compare = sub.add_parser("compare", help="compare the latest results with a baseline")
+    compare.add_argument("results", help="JSON-lines results file")
+    compare.add_argument("--baseline", default=None, help="version to compare with (default: the run before)")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "detection":
+        if args.folder:
+            frames = LoadFrames(args.folder, args.frames, args.levels)
+        else:
+            frames = [cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                      for frame, _ in FlowSequence(args.frames, args.width, args.height)]
+        _Print("Detection (frames/sec)",
+               BenchDetection(frames, args.blur, args.dilate,
+                              args.trace_start, args.trace_end, args.roi_margin))
+    elif args.benchmark == "tracking":
+        _Print("Tracking (ms/frame)",
+               BenchTracking(args.counts, args.frames, args.dist_thresh))
+    elif args.benchmark == "plotting":
+        _Print("Plotting (ms/cell)",
+               BenchPlotting(args.cells, args.length, args.folder))
+    elif args.benchmark == "generate":
+        sequence = FlowSequence(args.frames, args.width, args.height, args.spawn_rate, args.radius,
+                                args.speed, args.deformation, args.noise, seed=args.seed)
+        truth = sequence.Write(args.folder)
+        print("{} frames, {} cells written to {}".format(args.frames, len(np.unique(truth["id"])), args.folder))
+    elif args.benchmark == "suite":
+        runs = []
+        for name in args.only:
+            parameters = {"traceStart": args.trace_start, "traceEnd": args.trace_end}
+            if name == "tracking":
+                runs.append((name, dict(parameters, gating=args.gating)))
+            else:
+                runs.extend((name, dict(parameters, background=background)) for background in args.background)
+        for name, parameters in runs:
+            metrics = RunIsolated(name, folder=args.folder, **parameters)
+            AppendRecord(args.results, Record(name, args.folder, parameters, metrics, args.version))
+            print("{} {} ({})".format(name, json.dumps(parameters, sort_keys=True), args.folder))
+            for metric, value in metrics.items():
+                print("  {:<24} {:>10}".format(metric, _Format(value)))
+    elif args.benchmark == "compare":
+        print(Compare(args.results, args.baseline))
+
+
+if __name__ == "__main__":
+    main()
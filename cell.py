@@ -3,125 +3,187 @@
 
 import math
 import scipy.signal
-import statistics
+import threading
 import cv2
 import os
 import numpy as np
-from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 from detectors import Detectors
 from tracker import Tracker
 from input import Input
 
+class VelGraph:
+    """Reusable Agg figure template for VelGraph.png
+    The figure, axes and labels are built once. Axis limits are rounded up
+    to steps of xStep frames and yStep speed units, and the rendered
+    background for each pair of limits is cached, so a cell usually only
+    costs drawing its line and encoding the PNG. Not thread-safe: use
+    VelGraph.forThread() to get one template per thread.
+    """
+
+    _local = threading.local()
+
+    def __init__(self, xStep=25, yStep=2, maxCached=32):
+        self.xStep = xStep
+        self.yStep = yStep
+        self.maxCached = maxCached
+        self.figure = Figure()
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot()
+        self.axes.set_title("Speed vs Time")
+        self.axes.set_xlabel("Time (frames)")
+        self.axes.set_ylabel("Speed (mm)")
+        self.line, = self.axes.plot([], [])
+        self.backgrounds = {}
+
+    @classmethod
+    def forThread(cls):
+        if not hasattr(cls._local, "template"):
+            cls._local.template = cls()
+        return cls._local.template
+
+    def _limits(self, t, v):
+        if len(t) == 0:
+            return (0, self.xStep), (0, self.yStep)
+        xMax = max(self.xStep, math.ceil(max(t[-1], 1) / self.xStep) * self.xStep)
+        yMin = min(0, math.floor(np.min(v) / self.yStep) * self.yStep)
+        yMax = max(yMin + self.yStep, math.ceil(np.max(v) / self.yStep) * self.yStep)
+        return (0, xMax), (yMin, yMax)
+
+    def save(self, t, v, path):
+        """Plot speed v over time t and write it as a PNG to path"""
+        xlim, ylim = self._limits(t, v)
+        key = (xlim, ylim)
+        self.axes.set_xlim(xlim)
+        self.axes.set_ylim(ylim)
+        if key in self.backgrounds:
+            self.canvas.restore_region(self.backgrounds[key])
+        else:
+            # render the empty axes for these limits once
+            self.line.set_visible(False)
+            self.canvas.draw()
+            if len(self.backgrounds) >= self.maxCached:
+                self.backgrounds.pop(next(iter(self.backgrounds)))
+            self.backgrounds[key] = self.canvas.copy_from_bbox(self.figure.bbox)
+            self.line.set_visible(True)
+        self.line.set_data(t, v)
+        self.axes.draw_artist(self.line)
+        image = np.asarray(self.canvas.buffer_rgba())
+        cv2.imwrite(path, cv2.cvtColor(image, cv2.COLOR_RGBA2BGR))
+
+
 class Cell:
 
+    # fields of Cell.kinematics, one row per step between two positions
+    KINEMATICS = np.dtype([("t", np.int64), ("x", np.int64), ("y", np.int64),
+                           ("speed", np.float64), ("smoothSpeed", np.float64)])
+    OUTLIER_SPEED = 100 # steps longer than this are detection jumps, not movement
+    SMOOTH_WINDOW, SMOOTH_ORDER = 7, 3 # Savitzky-Golay window and polynomial order
+
     def __init__(self, id, directory):
         self.id = id
-        self.xCoordCenter = []
-        self.yCoordCenter = []
+        self.xCoordCenter = np.empty(0, dtype=np.int64)
+        self.yCoordCenter = np.empty(0, dtype=np.int64)
         self.indexFirstLineisPassed = None #store index that the first tracking line is passed
         self.indexMiddleLineisPassed = None #store index for mid point passing
         self.directory = directory
         self.firstCrop = None
         self.midCrop = None
         self.lastCrop = None
+        self.kinematics = None
+
+
+    #Set the coords of the cell (xCoordCenter and yCoordCenter) from a whole trace, truncated to ints
+    def setValues(self, xCoordCenter, yCoordCenter):
+        self.xCoordCenter = np.asarray(xCoordCenter).astype(np.int64)
+        self.yCoordCenter = np.asarray(yCoordCenter).astype(np.int64)
+        self.kinematics = None
+
+    #Compute speed per frame, with outliers replaced and smoothed, as a KINEMATICS array
+    def computeKinematics(self):
+        if self.kinematics is not None:
+            return self.kinematics
+        x, y = self.xCoordCenter, self.yCoordCenter
+        steps = max(len(x) - 1, 0)
+        kinematics = np.zeros(steps, dtype=self.KINEMATICS)
+        kinematics["t"] = np.arange(steps)
+        kinematics["x"] = x[:steps]
+        kinematics["y"] = y[:steps]
+
+        #distance traveled between consecutive frames
+        speed = np.hypot(np.diff(x), np.diff(y))
+        kinematics["speed"] = speed
+
+        #replace jumps with the median of the valid steps
+        outliers = speed > self.OUTLIER_SPEED
+        cleaned = speed.copy()
+        if outliers.any():
+            valid = speed[~outliers]
+            cleaned[outliers] = np.median(valid) if len(valid) else 0
+
+        #apply smoothing, shrinking the window to fit short tracks (odd, <= steps)
+        window = min(self.SMOOTH_WINDOW, steps - (steps % 2 == 0))
+        if window > 0:
+            cleaned = scipy.signal.savgol_filter(cleaned, window, min(self.SMOOTH_ORDER, window - 1))
+        kinematics["smoothSpeed"] = cleaned
+
+        self.kinematics = kinematics
+        return kinematics
+
+    #Create and save graph for cell, render=False only writes t-v.csv
+    def generateVelGraph(self, render=True):
+        kinematics = self.computeKinematics()
+
+        #plotting, leaving out the smoothing edges
+        if render:
+            path = self.directory + "/VelGraph.png"
+            smooth = kinematics["smoothSpeed"][4:-4]
+            VelGraph.forThread().save(np.arange(len(smooth)), smooth, path)
+
+        # generate time-velocity csv file: time, x, y, raw speed
+        CSVpath = self.directory + "/t-v.csv"
+        table = np.column_stack([kinematics[name] for name in ("t", "x", "y", "speed")])
+        np.savetxt(CSVpath, table, delimiter=",", fmt = '%1.f')
 
+    def computeDeformation(self, features):
+        """
+        Calculate the deformation index (w - h) / (w + h) of the cell's own bounding box in each frame.
 
-    #Add coords to cell xCoordCenter and yCoordCenter
-    def updateValues(self, xCoordCenter, yCoordCenter):
-        self.xCoordCenter.append(int(xCoordCenter))
-        self.yCoordCenter.append(int(yCoordCenter))
-
-    #Create and save graph for cell
-    def generateVelGraph(self):
-
-        #stores amount of movement per frame
-        diff = []
-
-        for x in range(len(self.xCoordCenter)-1):
-            #find the distance that was traveled using pythagorean theorem
-            z = abs( math.sqrt( ((self.xCoordCenter[x+1] - self.xCoordCenter[x])** 2) + ((self.yCoordCenter[x+1] - self.yCoordCenter[x])** 2) ))
-            #if data point is too high, replace with average value of array
-            if (z > 100):
-                diff.append(statistics.median(diff))
-                continue
-            
-            #add to array
-            diff.append(z)
-        
-
-        #apply smoothing to graph
-        #window_length must be equal or less than len(diff) and must be odd
-        window_length = len(diff)
-        if window_length % 2 == 0: 
-            xhat = scipy.signal.savgol_filter(diff, 7, 3) # even, window size 51, polynomial order 3
-        else: 
-            xhat = scipy.signal.savgol_filter(diff, 7, 3) # odd, window size, polynomial order 3
-
-        #plotting
-        plt.title("Speed vs Time") 
-        plt.xlabel("Time (frames)") 
-        plt.ylabel("Speed (mm)") 
-        plt.plot(range(len(self.xCoordCenter)-9), xhat[4:(len(xhat)-4)]) 
-        #print(xhat)
-    
-        path = self.directory + "/VelGraph.png"
-        plt.savefig(path)
-
-        plt.clf()
-
-        # generate time-velocity csv file
-        a_list = np.array(range(len(self.xCoordCenter)-1))
-        #a_list is time. xhat is velocity
-        result = []
-        temp = []
-        count = 0
-        for i in (range(len(a_list))):
-            for j in range(4):
-                if j == 3:
-                    temp.append(abs( math.sqrt( ((self.xCoordCenter[i+1] - self.xCoordCenter[i])** 2) + ((self.yCoordCenter[i+1] - self.yCoordCenter[i])** 2) )))
-                if j == 2:
-                    temp.append(self.yCoordCenter[i])
-                if j == 1:
-                    temp.append(self.xCoordCenter[i])
-                if j == 0:
-                    temp.append(a_list[i])
-            result.append(temp)
-            temp = []
-            count += 1
-        CSVpath = self.directory + "/t-v.csv"
-        
-        np.savetxt(CSVpath, result, delimiter=",", fmt = '%1.f')
+        Args:
+            features: detectors.DETECTION array with a row per frame of the cell; rows of frames where the
+                cell was not detected are zero.
+        Returns:
+            Array with the deformation index of each frame, NaN for frames without a box.
+        """
+        w = features["w"].astype(np.float64)
+        h = features["h"].astype(np.float64)
+        size = w + h
+        return np.divide(w - h, size, out=np.full(len(features), np.nan), where=size > 0)
 
-    def deformationIndex(self, boxes):
+    def deformationIndex(self, features):
         """
-        Calculate deformation index using all width and height values from bounding boxes of each frame.
-        
+        Calculate the deformation index of each frame and save it to DeformationIndex.txt.
+
         Args:
-            boxes: List of lists, where each inner list contains [x, y, width, height] for each bounding box
-                per frame.
+            features: see computeDeformation
+        Returns:
+            Array with the deformation index of each frame, NaN for frames without valid boxes.
         """
+        deformation = self.computeDeformation(features)
+
         # Path to save the deformation index results
         txt_path = self.directory + "/DeformationIndex.txt"
 
         # Open the file once and write each frame's deformation index
         with open(txt_path, "w+") as file:
-            for frame_boxes in boxes:
-                widths = [box[2] for box in frame_boxes if len(box) == 4]  # Collect all widths
-                heights = [box[3] for box in frame_boxes if len(box) == 4]  # Collect all heights
-
-                if widths and heights:
-                    deformation_indexes = []
-                    for w, h in zip(widths, heights):
-                        deformation_index = (w - h) / float(w + h) if (w + h) != 0 else 0
-                        deformation_indexes.append(deformation_index)
-
-                    # Average the deformation indexes for the frame to have a single measure
-                    avg_deformation_index = sum(deformation_indexes) / len(deformation_indexes) if deformation_indexes else 0
-                    file.write(f"{avg_deformation_index}\n")
-                    # print(f"Deformation index for frame saved to {txt_path}: {avg_deformation_index}")
+            for value in deformation:
+                if np.isnan(value):
+                    file.write("0\n")  # Default to 0 if the cell was not detected in the frame
                 else:
-                    file.write("0\n")  # Default to 0 if no boxes or valid dimensions are found
+                    file.write(f"{float(value)}\n")
+        return deformation
 
 
 
@@ -162,27 +224,17 @@ class Cell:
 
 
     def saveImage(self):
-        #if the height and length of the image =/= Image Size(cellSize) //// x.shape[0] is height, x.shape[1] is width
-        try:
-            #save First Crop
-            if (  self.firstCrop.shape[0] <  self.firstCrop.shape[1] ):
-                blackImage = np.zeros(((self.firstCrop.shape[1] -  self.firstCrop.shape[0]),  self.firstCrop.shape[1], 3), float)
-                self.firstCrop = np.concatenate((self.firstCrop, blackImage), axis=0) #first variable over second variable
-            path = self.directory + "/Firstcrop.png"
-            cv2.imwrite(path, self.firstCrop)
-
-            #save First Crop
-            if (  self.midCrop.shape[0] <  self.midCrop.shape[1] ):
-                blackImage = np.zeros(((self.midCrop.shape[1] -  self.midCrop.shape[0]),  self.midCrop.shape[1], 3), float)
-                self.midCrop = np.concatenate((self.midCrop, blackImage), axis=0) #first variable over second variable
-            path = self.directory + "/Midcrop.png"
-            cv2.imwrite(path, self.midCrop)
-
-            #save First Crop
-            if (  self.lastCrop.shape[0] <  self.lastCrop.shape[1] ):
-                blackImage = np.zeros(((self.lastCrop.shape[1] -  self.lastCrop.shape[0]), self.lastCrop.shape[1], 3), float)
-                self.lastCrop = np.concatenate((self.lastCrop, blackImage), axis=0) #first variable over second variable
-            path = self.directory + "/Lastcrop.png"
-            cv2.imwrite(path, self.lastCrop)
-        except cv2.error as e:
-            print("Cell not saved")
+        #if the height of a crop is less than its width, pad it to a square with black at the bottom
+        for crop, name in ((self.firstCrop, "/Firstcrop.png"), (self.midCrop, "/Midcrop.png"),
+                           (self.lastCrop, "/Lastcrop.png")):
+            if crop is None:
+                continue
+            try:
+                if (crop.shape[0] < crop.shape[1]):
+                    padded = np.zeros((crop.shape[1],) + crop.shape[1:], dtype=crop.dtype)
+                    padded[:crop.shape[0]] = crop
+                    crop = padded
+                cv2.imwrite(self.directory + name, crop)
+            except cv2.error as e:
+                print("Cell not saved")
+                return
@@ -0,0 +1,233 @@
+'''
+    File name         : cell_writer.py
+    File Description  : Background writer for completed cells
+    Python Version    : 3
+'''
+
+# Import python libraries
+import atexit
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from cell import Cell
+from profiling import StageProfiler
+
+# Everything needed to save a completed cell, detached from the tracker
+# and the frame store. Arrays are private copies marked read-only;
+# frame_idx holds the frame index of every trace point, if known.
+CellSnapshot = namedtuple("CellSnapshot", ["id", "directory", "x", "y",
+                                           "first_index", "middle_index",
+                                           "first_crop", "mid_crop",
+                                           "last_crop", "features",
+                                           "frame_idx"], defaults=(None,))
+
+
+def MakeSnapshot(id, directory, x, y, first_index, middle_index,
+                 first_crop, mid_crop, last_crop, features, frame_idx=None):
+    """Build a CellSnapshot, copying every array so it cannot change
+    once handed to the writer
+    Args:
+        see CellSnapshot
+    Return:
+        CellSnapshot
+    """
+    arrays = []
+    for a in (x, y, first_crop, mid_crop, last_crop, features,
+              np.full(len(x), -1) if frame_idx is None else frame_idx):
+        a = np.array(a, copy=True)
+        a.setflags(write=False)
+        arrays.append(a)
+    x, y, first_crop, mid_crop, last_crop, features, frame_idx = arrays
+    return CellSnapshot(id, directory, x, y, first_index, middle_index,
+                        first_crop, mid_crop, last_crop, features, frame_idx)
+
+
+def SaveCell(snapshot, velGraph=True, export=True):
+    """Compute the results of one cell and, if export is set, write its
+    directory with the velocity graph, t-v.csv, deformation index and crops
+    Args:
+        snapshot: CellSnapshot
+        velGraph: False skips rendering VelGraph.png
+        export: False skips the per-cell directory
+    Return:
+        (cell, points, frames) columns for ResultsStore.Append
+    """
+    cell = Cell(snapshot.id, snapshot.directory)
+    cell.setValues(snapshot.x, snapshot.y)
+    cell.indexFirstLineisPassed = snapshot.first_index
+    cell.indexMiddleLineisPassed = snapshot.middle_index
+    cell.firstCrop = snapshot.first_crop
+    cell.midCrop = snapshot.mid_crop
+    cell.lastCrop = snapshot.last_crop
+    kinematics = cell.computeKinematics()
+    crops = {}
+    if export:
+        os.makedirs(snapshot.directory, exist_ok=True)
+        deformation = cell.deformationIndex(snapshot.features)
+        cell.generateVelGraph(velGraph)
+        cell.saveImage()
+        # crop paths relative to the results folder
+        name = os.path.basename(os.path.normpath(snapshot.directory))
+        crops = {"first_crop": name + "/Firstcrop.png",
+                 "mid_crop": name + "/Midcrop.png",
+                 "last_crop": name + "/Lastcrop.png"}
+    else:
+        deformation = cell.computeDeformation(snapshot.features)
+
+    valid = ~np.isnan(deformation)
+    row = dict(crops, id=snapshot.id, first_index=snapshot.first_index,
+               middle_index=snapshot.middle_index, n_points=len(snapshot.x),
+               mean_speed=kinematics["smoothSpeed"].mean() if len(kinematics) else np.nan,
+               mean_deformation=deformation[valid].mean() if valid.any() else np.nan)
+    frame_idx = snapshot.frame_idx if snapshot.frame_idx is not None else np.full(len(snapshot.x), -1)
+    points = {"t": kinematics["t"], "frame": frame_idx[:len(kinematics)],
+              "x": kinematics["x"], "y": kinematics["y"],
+              "speed": kinematics["speed"], "smooth_speed": kinematics["smoothSpeed"]}
+    frames = {name: snapshot.features[name] for name in snapshot.features.dtype.names}
+    frames["deformation"] = deformation
+    return row, points, frames
+
+
+def _TimedSaveCell(snapshot, velGraph, export):
+    """SaveCell and the seconds it took in the worker"""
+    began = time.perf_counter()
+    result = SaveCell(snapshot, velGraph, export)
+    return result, time.perf_counter() - began
+
+
+class CellWriter(object):
+    """CellWriter class saves completed cells on a background thread or
+    process pool so plotting and file I/O stay off the frame loop.
+    Results go to a ResultsStore and crops to a CropArchive, per-cell
+    directories are optional.
+    At most max_pending cells are queued; Submit blocks beyond that
+    (backpressure). Close waits for every queued cell and is also run at
+    interpreter exit, so no submitted cell is lost.
+    Attributes:
+        saved: number of cells written
+        ids: ids of the cells written, in the order they were written
+        errors: list of (cell id, exception) for cells that failed
+    """
+
+    def __init__(self, num_workers=1, max_pending=32, use_processes=False,
+                 vel_graph=True, store=None, export=True, crops=None, profiler=None):
+        """Initialize variables used by CellWriter class
+        Args:
+            num_workers: number of writer threads/processes
+            max_pending: maximum number of cells queued or in progress
+            use_processes: use a process pool instead of threads
+            vel_graph: False skips rendering VelGraph.png
+            store: ResultsStore the cells are appended to, or None;
+                   it is closed by Close
+            export: write a Cell_<id> directory per cell
+            crops: CropArchive the crops are written to, or None; it is
+                   closed by Close
+            profiler: StageProfiler timing cell_save (in the worker) and
+                      cell_store (archive and store)
+        Return:
+            None
+        """
+        pool = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        self.pool = pool(max_workers=num_workers)
+        self.vel_graph = vel_graph
+        self.store = store
+        self.export = export
+        self.crops = crops
+        self.profiler = profiler if profiler is not None else StageProfiler(enabled=False)
+        self.max_pending = max_pending
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.saved = 0
+        self.ids = []
+        self.errors = []
+        self.closed = False
+        atexit.register(self.Close)
+
+    def Submit(self, snapshot):
+        """Queue a cell for writing, blocking while the queue is full
+        Args:
+            snapshot: CellSnapshot
+        Return:
+            None
+        """
+        self.slots.acquire()
+        future = self.pool.submit(_TimedSaveCell, snapshot, self.vel_graph, self.export)
+        future.add_done_callback(lambda f, snapshot=snapshot: self._Done(snapshot, f))
+
+    def _Archive(self, snapshot, row):
+        folder = os.path.basename(os.path.normpath(self.crops.directory))
+        for kind, crop in (("first", snapshot.first_crop), ("mid", snapshot.mid_crop),
+                           ("last", snapshot.last_crop)):
+            row[kind + "_crop"] = folder + "/" + self.crops.Put(snapshot.id, kind, crop)
+
+    def _Done(self, snapshot, future):
+        id = snapshot.id
+        error = future.exception()
+        if error is None:
+            try:
+                (row, points, frames), seconds = future.result()
+                self.profiler.Add("cell_save", seconds)
+                began = time.perf_counter()
+                if self.crops is not None:
+                    self._Archive(snapshot, row)
+                if self.store is not None:
+                    self.store.Append(row, points, frames)
+                self.profiler.Add("cell_store", time.perf_counter() - began)
+            except Exception as e:
+                error = e
+        with self.lock:
+            if error is None:
+                self.saved += 1
+                self.ids.append(id)
+            else:
+                self.errors.append((id, error))
+                print("Cell {} not saved: {!r}".format(id, error))
+        self.slots.release()
+
+    def Flush(self):
+        """Wait for all queued cells to be written and flush the store and
+        the crop archive, so everything submitted so far is on disk
+        Args:
+            None
+        Return:
+            None
+        """
+        # every queued cell holds a slot until it is done
+        for _ in range(self.max_pending):
+            self.slots.acquire()
+        for _ in range(self.max_pending):
+            self.slots.release()
+        if self.store is not None:
+            self.store.Flush()
+        if self.crops is not None:
+            self.crops.Flush()
+
+    def Close(self):
+        """Wait for all queued cells to be written and close the store and
+        the crop archive
+        Args:
+            None
+        Return:
+            None
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.pool.shutdown(wait=True)
+        if self.store is not None:
+            self.store.Close()
+        if self.crops is not None:
+            self.crops.Close()
+        atexit.unregister(self.Close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Close()
+        return False
@@ -0,0 +1,69 @@
+'''
+    File name         : checkpoint.py
+    File Description  : Pipeline checkpoints for resuming long acquisitions
+    Python Version    : 3
+'''
+
+# Import python libraries
+import os
+import pickle
+
+# Written to the results folder every checkpointEvery frames
+CHECKPOINT = "checkpoint.pkl"
+VERSION = 1
+
+
+def SaveCheckpoint(resultsFolder, state):
+    """Write a checkpoint atomically, replacing the previous one; a crash
+    while writing leaves the previous checkpoint intact
+    Args:
+        resultsFolder: results folder
+        state: dict of picklable pipeline state, see ProcessFolder
+    Return:
+        None
+    """
+    path = os.path.join(resultsFolder, CHECKPOINT)
+    with open(path + ".tmp", "wb") as file:
+        pickle.dump(dict(state, version=VERSION), file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+
+
+def LoadCheckpoint(resultsFolder):
+    """Last checkpoint of a results folder
+    Args:
+        resultsFolder: results folder
+    Return:
+        state dict, None if there is no checkpoint
+    """
+    path = os.path.join(resultsFolder, CHECKPOINT)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as file:
+        state = pickle.load(file)
+    if state.get("version") != VERSION:
+        raise ValueError("{}: unsupported checkpoint version {}".format(path, state.get("version")))
+    return state
+
+
+def RemoveCheckpoint(resultsFolder):
+    """Delete the checkpoint of a results folder, if any"""
+    path = os.path.join(resultsFolder, CHECKPOINT)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def CheckParameters(saved, current, ignore=()):
+    """Raise ValueError if a run is resumed with parameters that change
+    its results
+    Args:
+        saved: parameters stored in the checkpoint
+        current: parameters of the resumed run
+        ignore: names that may differ, e.g. the number of reader threads
+    Return:
+        None
+    """
+    changed = sorted(name for name in set(saved) | set(current)
+                     if name not in ignore and saved.get(name) != current.get(name))
+    if changed:
+        raise ValueError("cannot resume with changed parameters: " + ", ".join(
+            "{} {!r} -> {!r}".format(name, saved.get(name), current.get(name)) for name in changed))
@@ -0,0 +1,305 @@
+'''
+    File name         : crop_archive.py
+    File Description  : Packed, memory-mapped archive of cell crops
+    Python Version    : 3
+'''
+
+# Import python libraries
+import json
+import os
+import threading
+
+import numpy as np
+
+from cell import Cell
+
+KINDS = ("first", "mid", "last")
+INDEX_DTYPE = np.dtype([("id", np.int64), ("kind", np.int8), ("chunk", np.int32),
+                        ("row", np.int32), ("height", np.int32), ("width", np.int32)])
+MANIFEST = "archive.json"
+INDEX = "index.npy"
+
+
+def CropShape(crop):
+    """Archive shape for a kind whose first crop is crop: the shape of the
+    crop padded to a square at the bottom if it is wider than high, the
+    way Cell.saveImage pads it"""
+    height, width = crop.shape[:2]
+    return (max(height, width), width) + crop.shape[2:]
+
+
+def _ChunkName(kind, chunk):
+    return "{}_{:05d}.npy".format(kind, chunk)
+
+
+class CropArchive(object):
+    """CropArchive class writes the first, mid and last crops of all cells
+    of a run into fixed-shape uint8 arrays, one set of .npy chunk files of
+    chunk_size crops per kind, instead of three PNGs per cell. Chunks are
+    memory-mapped: a crop is copied into its row once and the rest of the
+    row is zeroed in place, which is the black padding of the PNGs.
+    Crops larger than the shape of their kind are cut to fit. index.npy
+    maps (cell id, kind) to chunk, row and the size of the crop inside the
+    padded row; it is rewritten by Flush and Close. Put is thread-safe.
+    Attributes:
+        directory: archive directory
+        shapes: dict of kind -> crop shape of the chunks
+    """
+
+    def __init__(self, directory, chunk_size=1024, shapes=None, append=False):
+        """Initialize variables used by CropArchive class
+        Args:
+            directory: archive directory, created if missing
+            chunk_size: crops per chunk file
+            shapes: dict of kind -> (height, width[, channels]) of the
+                    chunks, channels default to those of the first crop;
+                    kinds not given take CropShape of their first crop
+            append: keep the crops of an earlier run in directory and add
+                    to them, instead of replacing them
+        Return:
+            None
+        """
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        manifest = ReadManifest(directory)
+        index = ReadIndex(directory)
+        if not append:
+            for kind, info in manifest["kinds"].items():
+                for chunk in range(info["chunks"]):
+                    os.remove(os.path.join(directory, _ChunkName(kind, chunk)))
+            manifest = {"version": 1, "chunk_size": chunk_size, "kinds": {}}
+            index = np.empty(0, dtype=INDEX_DTYPE)
+        else:
+            self.chunk_size = manifest.get("chunk_size", chunk_size)
+        self.shapes = {kind: tuple(info["shape"]) for kind, info in manifest["kinds"].items()}
+        self.shapes.update({kind: tuple(shape) for kind, shape in (shapes or {}).items()
+                            if kind not in self.shapes})
+        self.counts = {kind: int(np.sum(index["kind"] == KINDS.index(kind))) for kind in KINDS}
+        self.chunks = {kind: [] for kind in KINDS}  # open memmaps, oldest first
+        for kind, info in manifest["kinds"].items():
+            for chunk in range(info["chunks"]):
+                self.chunks[kind].append(np.load(os.path.join(directory, _ChunkName(kind, chunk)), mmap_mode="r+"))
+        self.index = [index]
+        self._WriteManifest()
+
+    def _WriteManifest(self):
+        kinds = {}
+        for kind in KINDS:
+            if kind in self.shapes:
+                kinds[kind] = {"shape": list(self.shapes[kind]), "chunks": len(self.chunks[kind])}
+        manifest = {"version": 1, "chunk_size": self.chunk_size, "kinds": kinds}
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + ".tmp", "w") as file:
+            json.dump(manifest, file, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def _Slot(self, id, kind, crop):
+        """Allocate the row of a crop, opening a new chunk when needed"""
+        with self.lock:
+            if kind not in self.shapes:
+                self.shapes[kind] = CropShape(crop)
+            elif len(self.shapes[kind]) < crop.ndim:
+                self.shapes[kind] += crop.shape[len(self.shapes[kind]):]
+            shape = self.shapes[kind]
+            chunk, row = divmod(self.counts[kind], self.chunk_size)
+            if chunk == len(self.chunks[kind]):
+                path = os.path.join(self.directory, _ChunkName(kind, chunk))
+                self.chunks[kind].append(np.lib.format.open_memmap(
+                    path, mode="w+", dtype=np.uint8, shape=(self.chunk_size,) + shape))
+                self._WriteManifest()
+            self.counts[kind] += 1
+            height, width = min(crop.shape[0], shape[0]), min(crop.shape[1], shape[1])
+            self.index.append(np.array([(id, KINDS.index(kind), chunk, row, height, width)],
+                                       dtype=INDEX_DTYPE))
+            return self.chunks[kind][chunk], row, height, width
+
+    def Put(self, id, kind, crop):
+        """Store one crop
+        Args:
+            id: cell id
+            kind: "first", "mid" or "last"
+            crop: uint8 image
+        Return:
+            reference of the crop, "<chunk file>#<row>"
+        """
+        chunk, row, height, width = self._Slot(id, kind, crop)
+        target = chunk[row]
+        target[:height, :width] = crop[:height, :width]
+        target[height:] = 0
+        target[:height, width:] = 0
+        return "{}#{}".format(os.path.basename(chunk.filename), row)
+
+    def Flush(self):
+        """Write the chunks and the index to disk
+        Args:
+            None
+        Return:
+            None
+        """
+        with self.lock:
+            for chunks in self.chunks.values():
+                for chunk in chunks:
+                    chunk.flush()
+            self.index = [np.concatenate(self.index)]
+            path = os.path.join(self.directory, INDEX)
+            with open(path + ".tmp", "wb") as file:
+                np.save(file, self.index[0])
+            os.replace(path + ".tmp", path)
+
+    def Truncate(self, entries):
+        """Forget every crop after the first entries index entries, e.g.
+        the crops written after a checkpoint that is resumed from; their
+        rows are reused by later Puts
+        Args:
+            entries: number of index entries kept
+        Return:
+            None
+        """
+        with self.lock:
+            index = np.concatenate(self.index)[:entries]
+            self.index = [index]
+            self.counts = {kind: int(np.sum(index["kind"] == KINDS.index(kind))) for kind in KINDS}
+            path = os.path.join(self.directory, INDEX)
+            with open(path + ".tmp", "wb") as file:
+                np.save(file, index)
+            os.replace(path + ".tmp", path)
+
+    def Entries(self):
+        """Number of crops in the index"""
+        with self.lock:
+            return sum(len(part) for part in self.index)
+
+    def Close(self):
+        """Flush the archive
+        Args:
+            None
+        Return:
+            None
+        """
+        self.Flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Close()
+        return False
+
+
+def ReadManifest(directory):
+    """Manifest of an archive directory, empty if there is none yet"""
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return {"version": 1, "kinds": {}}
+    with open(path) as file:
+        return json.load(file)
+
+
+def ReadIndex(directory):
+    """Index of an archive directory, empty if there is none yet"""
+    path = os.path.join(directory, INDEX)
+    if not os.path.exists(path):
+        return np.empty(0, dtype=INDEX_DTYPE)
+    return np.load(path)
+
+
+class CropReader(object):
+    """CropReader class gives read-only, zero-copy access to the crops of
+    a CropArchive directory
+    Attributes:
+        index: INDEX_DTYPE array of all crops
+    """
+
+    def __init__(self, directory):
+        """Initialize variables used by CropReader class
+        Args:
+            directory: archive directory
+        Return:
+            None
+        """
+        self.directory = directory
+        self.manifest = ReadManifest(directory)
+        self.index = ReadIndex(directory)
+        self.rows = {(int(entry["id"]), KINDS[entry["kind"]]): entry for entry in self.index}
+        self.chunks = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def _Chunk(self, kind, chunk):
+        key = (kind, chunk)
+        if key not in self.chunks:
+            self.chunks[key] = np.load(os.path.join(self.directory, _ChunkName(kind, chunk)), mmap_mode="r")
+        return self.chunks[key]
+
+    def Ids(self, kind="first"):
+        """Cell ids with a crop of the given kind, in archive order"""
+        return self.index["id"][self.index["kind"] == KINDS.index(kind)]
+
+    def Get(self, id, kind, padded=False):
+        """Crop of a cell, None if it is not in the archive
+        Args:
+            id: cell id
+            kind: "first", "mid" or "last"
+            padded: return the full fixed-shape row with its zero padding
+        Return:
+            read-only view of the crop
+        """
+        entry = self.rows.get((int(id), kind))
+        if entry is None:
+            return None
+        crop = self._Chunk(kind, int(entry["chunk"]))[entry["row"]]
+        return crop if padded else crop[:entry["height"], :entry["width"]]
+
+    def Chunks(self, kind):
+        """Iterate over the crops of a kind one chunk at a time, e.g. to
+        feed a classifier without decoding images
+        Args:
+            kind: "first", "mid" or "last"
+        Return:
+            iterator of (cell ids, (n, height, width, channels) padded
+            crops) with both arrays in the same order
+        """
+        entries = self.index[self.index["kind"] == KINDS.index(kind)]
+        for chunk in np.unique(entries["chunk"]):
+            rows = entries[entries["chunk"] == chunk]
+            crops = self._Chunk(kind, int(chunk))
+            order = np.argsort(rows["row"])
+            rows = rows[order]
+            if np.array_equal(rows["row"], np.arange(len(rows))):
+                yield rows["id"], crops[:len(rows)]
+            else:
+                yield rows["id"], crops[rows["row"]]
+
+    def ExportPngs(self, resultsFolder, ids=None):
+        """Write Firstcrop.png, Midcrop.png and Lastcrop.png into the
+        Cell_<id> directories of resultsFolder, as Cell.saveImage does
+        Args:
+            resultsFolder: folder of the Cell_<id> directories
+            ids: cell ids to export, None for all
+        Return:
+            number of cells exported
+        """
+        if ids is None:
+            ids = np.unique(self.index["id"])
+        for id in ids:
+            cell = Cell(int(id), os.path.join(resultsFolder, "Cell_{}".format(int(id))))
+            os.makedirs(cell.directory, exist_ok=True)
+            cell.firstCrop = self.Get(id, "first")
+            cell.midCrop = self.Get(id, "mid")
+            cell.lastCrop = self.Get(id, "last")
+            cell.saveImage()
+        return len(ids)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export the crops of a crop archive as PNG files")
+    parser.add_argument("archive", help="crop archive directory")
+    parser.add_argument("resultsFolder", help="folder to write the Cell_<id> directories to")
+    parser.add_argument("--ids", type=int, nargs="*", help="cell ids to export, default all")
+    args = parser.parse_args()
+    print("{} cells exported".format(CropReader(args.archive).ExportPngs(args.resultsFolder, args.ids)))
@@ -11,32 +11,103 @@
 import numpy as np
 import cv2
 
+from background import MOG2Background
+
 # set to 1 for pipeline images
 debug = 1
 
+# Features of one detection, computed once from its contour: bounding box,
+# contour area and perimeter, circularity 4*pi*area/perimeter^2 and the
+# axes of the fitted ellipse (of the bounding box for contours < 5 points)
+DETECTION = np.dtype([("x", np.int32), ("y", np.int32), ("w", np.int32), ("h", np.int32),
+                      ("area", np.float32), ("perimeter", np.float32),
+                      ("circularity", np.float32), ("major_axis", np.float32),
+                      ("minor_axis", np.float32)])
+
 
 class Detectors(object):
     """Detectors class to detect objects in video frame
     Attributes:
         None
     """
-    def __init__(self, blurFactor, dilateFactor, blob_radius_thresh=7, debug=False):
+    def __init__(self, blurFactor, dilateFactor, blob_radius_thresh=7, debug=False,
+                 roi=None, roi_margin=0, background=None):
         """Initialize variables used by Detectors class
         Args:
             blurFactor: Degree of Gaussian Blur
             dilateFactor: Degree of contour dilation
             analysis: 0 to calculate deformation ratio, 1 to turn off
+            roi: region of interest, None for the full frame, an
+                 (x, y, w, h) rectangle (w or h None extends to the frame
+                 edge) or a single channel mask image of frame size
+            roi_margin: pixels added around the roi on every side
+            background: background model (see background.py) used and
+                        updated by this detector, None for MOG2; a
+                        static model must be fitted (FitBackground)
         Return:
             None
         """
-        self.fgbg = cv2.createBackgroundSubtractorMOG2()
+        self.background = MOG2Background() if background is None else background
         self.blurFactor = blurFactor
         self.dilateFactor = dilateFactor
         self.blob_radius_thresh = blob_radius_thresh
         self.debug = debug
+        self.roi = roi
+        self.roi_margin = roi_margin
+        self.roi_rect = None  # (x0, y0, x1, y1), resolved on first frame
+        self.roi_mask = None  # roi mask cropped to roi_rect, if any
+
+    def _ResolveRoi(self, shape):
+        """Resolve the roi into a clipped crop rectangle (and cropped mask)
+        Args:
+            shape: frame shape
+        Return:
+            None
+        """
+        height, width = shape[:2]
+        m = self.roi_margin
+        if self.roi is None:
+            self.roi_rect = (0, 0, width, height)
+            return
+        if isinstance(self.roi, np.ndarray):
+            mask = (self.roi > 0).astype(np.uint8) * 255
+            if m > 0:
+                mask = cv2.dilate(mask, np.ones((2 * m + 1, 2 * m + 1), np.uint8))
+            points = cv2.findNonZero(mask)
+            if points is None:
+                raise ValueError("roi mask is empty")
+            x, y, w, h = cv2.boundingRect(points)
+            self.roi_rect = (x, y, x + w, y + h)
+            self.roi_mask = mask[y:y + h, x:x + w]
+            return
+        x, y, w, h = self.roi
+        x1 = width if w is None else x + w
+        y1 = height if h is None else y + h
+        self.roi_rect = (max(0, x - m), max(0, y - m),
+                         min(width, x1 + m), min(height, y1 + m))
+
+    def _Crop(self, frame):
+        """Crop frame to the roi before the expensive stages
+        Args:
+            frame: single video frame
+        Return:
+            cropped frame (view), (x0, y0) offset of the crop
+        """
+        if self.roi_rect is None:
+            self._ResolveRoi(frame.shape)
+        x0, y0, x1, y1 = self.roi_rect
+        return frame[y0:y1, x0:x1], (x0, y0)
+
+    def _Gray(self, roi):
+        """Single channel view of a cropped frame; BGR frames are
+        converted, frames read single channel are used as they are"""
+        if roi.ndim == 2:
+            return roi
+        return cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
 
     def Detect(self, frame):
         """Detect objects in video frame using following pipeline
+            - Crop the frame to the region of interest
             - Convert captured frame from BGR to GRAY
             - Perform Background Subtraction
             - Detect edges using Canny Edge Detection
@@ -50,7 +121,8 @@ class Detectors(object):
             centers: vector of object centroids in a frame
         """
 
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        roi, offset = self._Crop(frame)
+        gray = self._Gray(roi)
         if self.debug:
             cv2.imshow('Gray Scale', gray)
             
@@ -58,12 +130,14 @@ class Detectors(object):
         if self.debug:
             cv2.imshow('Blurred Edges', gray_blurred)
         
-        mask = self.fgbg.apply(gray_blurred)
+        mask = self.background.Apply(gray_blurred)
         if self.debug:
             cv2.imshow('backgroundmask', mask)
         
 
         _, thresh = cv2.threshold(mask, 15, 255, cv2.THRESH_BINARY)
+        if self.roi_mask is not None:
+            thresh = cv2.bitwise_and(thresh, self.roi_mask)
         if self.debug:
             cv2.imshow('Threshold Image', thresh)
         
@@ -77,10 +151,140 @@ class Detectors(object):
             
         
         
-        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        return self._Objects(thresh, frame, offset)
+
+
+    def Radius(self, frame, traceStart, traceEnd):
+        """Detect objects in video frame using following pipeline
+            - Crop the frame to the region of interest
+            - Convert captured frame from BGR to GRAY
+            - Perform Background Subtraction
+            - Detect edges using Canny Edge Detection
+              http://docs.opencv.org/trunk/da/d22/tutorial_py_canny.html
+            - Retain only edges within the threshold
+            - Find contours
+            - Find centroids for each valid contours
+        Args:
+            frame: single video frame
+        Return:
+            centers: vector of object centroids in a frame
+        """
+
+        # Crop to the region of interest and convert BGR to GRAY
+        roi, offset = self._Crop(frame)
+        gray = self._Gray(roi)
+
+        # Perform Background Subtraction
+        fgmask = self.background.Apply(gray)
+        fgmask=cv2.GaussianBlur(fgmask, (self.blurFactor, self.blurFactor), 0)
+        fgmask = cv2.dilate(fgmask, None, iterations=self.dilateFactor) # when we apply the blur, details get lost. So, the cell detail is getting lost, losing a well-defined contour of the cell so we are padding it (adding pixel value)
+        fgmask=cv2.threshold(fgmask, 1, 255, cv2.THRESH_BINARY)[1]
+        if self.roi_mask is not None:
+            fgmask = cv2.bitwise_and(fgmask, self.roi_mask)
+
+        return self._Radius(fgmask, traceStart, traceEnd, offset)
+
+    def DetectAll(self, frame, traceStart, traceEnd, radius=False):
+        """Detect objects, and optionally the mid-channel radius, in a
+        single pass
+        Equivalent to Detect followed by Radius, but the frame is converted
+        and blurred once and the background model is applied (and updated)
+        once per frame. The radius mask is derived from the same foreground
+        mask as the detections.
+            - Crop the frame to the region of interest
+            - Convert captured frame from BGR to GRAY, unless it was
+              read single channel
+            - Blur and perform Background Subtraction
+            - Threshold and find objects (centroids, contours, boxes)
+            - Blur, dilate and threshold the same mask for the radius,
+              if asked for
+        Args:
+            frame: single video frame, BGR or 8-bit single channel
+            traceStart: x position of the first tracking line
+            traceEnd: x position of the last tracking line
+            radius: compute the mid-channel radius; it costs a blur, a
+                    dilation and a contour search per frame
+        Return:
+            centers: vector of object centroids in a frame
+            contours_refined: contours of the kept objects
+            features: DETECTION array, one row per center
+            radius_max: largest radius around the middle of the channel,
+                        None unless radius is set
+            All positions are in full-frame coordinates.
+        """
+        gray_blurred, offset = self._Prepare(frame)
+        mask = self.background.Apply(gray_blurred)
+        if self.roi_mask is not None:
+            mask = cv2.bitwise_and(mask, self.roi_mask)
+
+        _, thresh = cv2.threshold(mask, 15, 255, cv2.THRESH_BINARY)
+        if self.debug:
+            cv2.imshow('Threshold Image', thresh)
+        centers, contours_refined, features = self._Objects(thresh, frame, offset)
+        if not radius:
+            return centers, contours_refined, features, None
+
+        fgmask = cv2.GaussianBlur(mask, (self.blurFactor, self.blurFactor), 0)
+        fgmask = cv2.dilate(fgmask, None, iterations=self.dilateFactor)
+        fgmask = cv2.threshold(fgmask, 1, 255, cv2.THRESH_BINARY)[1]
+        if self.roi_mask is not None:
+            fgmask = cv2.bitwise_and(fgmask, self.roi_mask)
+        radius_max = self._Radius(fgmask, traceStart, traceEnd, offset)
+
+        return centers, contours_refined, features, radius_max
+
+    def Prime(self, frame):
+        """Update the background model with a frame without detecting,
+        e.g. to rebuild the model from the frames before a resume point.
+        Does the same background update as DetectAll, without the
+        contour and radius stages; a static model is left as it is.
+        Args:
+            frame: single video frame
+        Return:
+            None
+        """
+        if self.background.adaptive:
+            self.background.Apply(self._Prepare(frame)[0])
+
+    def FitBackground(self, frames):
+        """Precompute the background model (a static one) from frames
+        sampled across the acquisition, e.g. with background.SampleIndices
+        Args:
+            frames: video frames
+        Return:
+            None
+        """
+        self.background.Fit(self._Prepare(frame)[0] for frame in frames)
+
+    def _Prepare(self, frame):
+        """Crop, convert to gray and blur a frame, the image the background
+        model is applied to
+        Args:
+            frame: single video frame
+        Return:
+            blurred gray image of the roi, (x0, y0) offset of the crop
+        """
+        roi, offset = self._Crop(frame)
+        gray = self._Gray(roi)
+        return cv2.GaussianBlur(gray, (self.blurFactor, self.blurFactor), 0), offset
+
+    def _Objects(self, thresh, frame, offset=(0, 0)):
+        """Find contours in the thresholded foreground mask and keep those
+        larger than the blob radius threshold
+        Args:
+            thresh: binary foreground mask
+            frame: video frame (only drawn on in debug mode)
+            offset: (x0, y0) of the mask in the full frame
+        Return:
+            centers: vector of object centroids in a frame
+            contours_refined: contours of the kept objects
+            features: DETECTION array, one row per center
+        """
+        # offset returns contours, and so centroids and boxes, in full-frame coordinates
+        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=offset)
         centers = []
         contours_refined = []
-        cell_boxes = []
+        features = []
         trash_area = np.pi * (self.blob_radius_thresh ** 2)
         
         for contour in contours:
@@ -88,13 +292,17 @@ class Detectors(object):
             if M["m00"] != 0:
                 cx = int(M["m10"] / M["m00"])
                 cy = int(M["m01"] / M["m00"])
-                if cv2.contourArea(contour) > trash_area:
+                area = cv2.contourArea(contour)
+                if area > trash_area:
                     centers.append(np.array([[cx], [cy]]))
                     contours_refined.append(contour)
-                    # x_x, y_y, w_w, h_h = cv2.boundingRect(contour)
-                    # cell_boxes.append([x_x, y_y, w_w, h_h])
                     x, y, w, h = cv2.boundingRect(contour)
-                    cell_boxes.append([x, y, w, h])
+                    if len(contour) >= 5:
+                        axes = cv2.fitEllipse(contour)[1]
+                    else:
+                        axes = (w, h)
+                    features.append((x, y, w, h, area, cv2.arcLength(contour, True), 0,
+                                     max(axes), min(axes)))
 
                     if self.debug:  # Optionally display each contour
                         cv2.drawContours(frame, [contour], -1, (0, 255, 0), 1)
@@ -103,36 +311,25 @@ class Detectors(object):
             cv2.imshow('Final Detection', frame)
             cv2.waitKey(100)  # Wait for a key press to move to the next frame
 
+        features = np.array(features, dtype=DETECTION)
+        perimeter = features["perimeter"]
+        features["circularity"] = 4 * np.pi * features["area"] / np.where(perimeter > 0, perimeter ** 2, np.inf)
 
-        return centers, contours_refined,  cell_boxes if cell_boxes else []
-
+        return centers, contours_refined, features
 
-    def Radius(self, frame, traceStart, traceEnd):
-        """Detect objects in video frame using following pipeline
-            - Convert captured frame from BGR to GRAY
-            - Perform Background Subtraction
-            - Detect edges using Canny Edge Detection
-              http://docs.opencv.org/trunk/da/d22/tutorial_py_canny.html
-            - Retain only edges within the threshold
-            - Find contours
-            - Find centroids for each valid contours
+    def _Radius(self, fgmask, traceStart, traceEnd, offset=(0, 0)):
+        """Largest enclosing-circle radius of the objects crossing the
+        middle of the channel
         Args:
-            frame: single video frame
+            fgmask: binary foreground mask
+            offset: (x0, y0) of the mask in the full frame
+            traceStart: x position of the first tracking line
+            traceEnd: x position of the last tracking line
         Return:
-            centers: vector of object centroids in a frame
+            radius_max: largest radius, 1000 if no object found
         """
-
-        # Convert BGR to GRAY
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-        # Perform Background Subtraction
-        fgmask = self.fgbg.apply(gray)
-        fgmask=cv2.GaussianBlur(fgmask, (self.blurFactor, self.blurFactor), 0)
-        fgmask = cv2.dilate(fgmask, None, iterations=self.dilateFactor) # when we apply the blur, details get lost. So, the cell detail is getting lost, losing a well-defined contour of the cell so we are padding it (adding pixel value)
-        fgmask=cv2.threshold(fgmask, 1, 255, cv2.THRESH_BINARY)[1]
-
         # Find contours
-        contours, hierarchy = cv2.findContours(fgmask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        contours, hierarchy = cv2.findContours(fgmask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=offset)
         radius_modified = []
         for cnt in contours:
                 (x, y), radius = cv2.minEnclosingCircle(cnt)
@@ -148,4 +345,3 @@ class Detectors(object):
                     
         
         return radius_max
-    
\ No newline at end of file
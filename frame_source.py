@@ -0,0 +1,448 @@
+'''
+    File name         : frame_source.py
+    File Description  : Prefetching and folder-following TIFF readers for the frame loop
+    Python Version    : 3
+'''
+
+# Import python libraries
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import struct
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+# cv2.imread flags of the native load path: one channel at the bit depth of
+# the file, instead of the 3-channel 8-bit BGR frame of cv2.IMREAD_COLOR
+IMREAD_NATIVE = cv2.IMREAD_GRAYSCALE | cv2.IMREAD_ANYDEPTH
+
+
+def ListFrames(folder, extension=".tiff"):
+    """Sorted list of frame file names in a camera folder
+    Args:
+        folder: camera folder
+        extension: frame file extension
+    Return:
+        sorted list of file names
+    """
+    return sorted([f for f in os.listdir(folder) if f.endswith(extension)])
+
+
+def ToGray8(frame, levels=None):
+    """Map a single channel frame of native bit depth to the 8-bit frame
+    the background model and the crops use
+    Args:
+        frame: single channel frame of an unsigned integer type
+        levels: (low, high) native values mapped to 0 and 255, values
+                outside are clipped; None keeps the 8 high bits, as
+                cv2.imread does when it reads a 16-bit file as 8-bit
+    Return:
+        uint8 frame, frame itself if it is 8-bit and levels is None
+    """
+    if levels is None:
+        if frame.dtype == np.uint8:
+            return frame
+        if frame.dtype.kind != "u":
+            raise ValueError("{} frames need explicit levels".format(frame.dtype))
+        return np.right_shift(frame, 8 * (frame.dtype.itemsize - 1)).astype(np.uint8)
+    low, high = levels
+    if not high > low:
+        raise ValueError("levels must be (low, high) with high > low")
+    # subtract saturates at 0 and convertScaleAbs at 255
+    return cv2.convertScaleAbs(cv2.subtract(frame, low), alpha=255.0 / (high - low))
+
+
+def ReadFrame(path, flags=cv2.IMREAD_COLOR, levels=None):
+    """Read a frame like cv2.imread; single channel frames, e.g. read
+    with IMREAD_NATIVE, are mapped to 8-bit with ToGray8
+    Args:
+        path: frame file
+        flags: cv2.imread flags
+        levels: see ToGray8
+    Return:
+        frame, None if the file could not be decoded
+    """
+    frame = cv2.imread(path, flags)
+    if frame is not None and frame.ndim == 2:
+        frame = ToGray8(frame, levels)
+    return frame
+
+
+class PrefetchReader(object):
+    """PrefetchReader class reads and decodes frames ahead of use on a
+    thread pool, so that disk/NAS latency overlaps with detection and
+    tracking. Frames are handed out in file-list order; at most
+    queue_depth frames are in flight, which bounds memory (backpressure).
+    cv2.imread releases the GIL while decoding, so threads are enough.
+    Attributes:
+        io_wait: seconds the consumer spent blocked waiting for a frame
+        compute: seconds the consumer spent between frames (its own work)
+        frames: number of frames handed out
+    """
+
+    def __init__(self, folder, file_list, num_workers=4, queue_depth=16,
+                 flags=cv2.IMREAD_COLOR, levels=None):
+        """Initialize variables used by PrefetchReader class
+        Args:
+            folder: camera folder
+            file_list: file names in the order they must be processed
+            num_workers: number of reader threads
+            queue_depth: maximum number of frames read ahead
+            flags: cv2.imread flags
+            levels: 8-bit mapping of single channel frames, see ToGray8
+        Return:
+            None
+        """
+        if queue_depth < 1:
+            raise ValueError("queue_depth must be at least 1")
+        self.folder = folder
+        self.file_list = list(file_list)
+        self.num_workers = num_workers
+        self.queue_depth = queue_depth
+        self.flags = flags
+        self.levels = levels
+        self.io_wait = 0.0
+        self.compute = 0.0
+        self.frames = 0
+
+    def _read(self, filename):
+        return ReadFrame(os.path.join(self.folder, filename), self.flags, self.levels)
+
+    def __len__(self):
+        return len(self.file_list)
+
+    def __iter__(self):
+        """Yield (filename, frame) in file-list order
+        frame is None if the file could not be decoded, like cv2.imread.
+        """
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+            pending = deque()
+            names = iter(self.file_list)
+            for filename in names:
+                pending.append((filename, pool.submit(self._read, filename)))
+                if len(pending) >= self.queue_depth:
+                    break
+            try:
+                resumed = None
+                while pending:
+                    filename, future = pending.popleft()
+                    waited = time.perf_counter()
+                    if resumed is not None:
+                        self.compute += waited - resumed
+                    frame = future.result()
+                    # Refill only as frames are consumed (backpressure)
+                    nxt = next(names, None)
+                    if nxt is not None:
+                        pending.append((nxt, pool.submit(self._read, nxt)))
+                    resumed = time.perf_counter()
+                    self.io_wait += resumed - waited
+                    self.frames += 1
+                    yield filename, frame
+                if resumed is not None:
+                    self.compute += time.perf_counter() - resumed
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
+    def Summary(self):
+        """One-line summary of time spent waiting on I/O versus compute
+        Args:
+            None
+        Return:
+            summary string
+        """
+        total = self.io_wait + self.compute
+        share = 100.0 * self.io_wait / total if total > 0 else 0.0
+        return ("{} frames: waited {:.1f}s on I/O, {:.1f}s compute "
+                "({:.1f}% I/O bound)").format(self.frames, self.io_wait,
+                                              self.compute, share)
+
+
+class DiskFrames(object):
+    """DiskFrames class reads single frames back from the camera folder
+    by frame index. It has the Get of FrameStore, for the cell crops of
+    runs that do not keep frames in memory.
+    Attributes:
+        None
+    """
+
+    def __init__(self, folder, file_list, flags=cv2.IMREAD_COLOR, levels=None):
+        """Initialize variables used by DiskFrames class
+        Args:
+            folder: camera folder
+            file_list: file names, indexed by frame index
+            flags: cv2.imread flags
+            levels: 8-bit mapping of single channel frames, see ToGray8
+        Return:
+            None
+        """
+        self.folder = folder
+        self.file_list = list(file_list)
+        self.flags = flags
+        self.levels = levels
+
+    def Get(self, frame_idx):
+        """Frame frame_idx, None if it is out of range or unreadable"""
+        if not 0 <= frame_idx < len(self.file_list):
+            return None
+        return ReadFrame(os.path.join(self.folder, self.file_list[frame_idx]), self.flags, self.levels)
+
+
+# inotify events of a file that has been written completely
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+
+
+class _Inotify(object):
+    """Minimal inotify watch (Linux) reporting files closed after writing
+    or moved into a folder. Does not see writes made by other hosts to a
+    network share."""
+
+    def __init__(self, folder):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch failed on {}".format(folder))
+
+    def Read(self, timeout):
+        """Names of the files completed since the last Read, waiting up to
+        timeout seconds for one; None if events were lost (overflow)"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        names = []
+        try:
+            while True:
+                data = os.read(self.fd, 65536)
+                offset = 0
+                while offset < len(data):
+                    _, mask, _, length = struct.unpack_from("iIII", data, offset)
+                    if mask & IN_Q_OVERFLOW:
+                        return None
+                    names.append(os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b"\0")))
+                    offset += 16 + length
+        except BlockingIOError:
+            pass
+        return names
+
+    def Close(self):
+        os.close(self.fd)
+
+
+def _Successor(name):
+    """Name following name in a numbered sequence, e.g. 000041.tiff ->
+    000042.tiff, None if name has no number before its extension"""
+    stem, extension = os.path.splitext(name)
+    match = re.search(r"(\d+)$", stem)
+    if match is None:
+        return None
+    digits = match.group(1)
+    return "{}{:0{}d}{}".format(stem[:match.start()], int(digits) + 1, len(digits), extension)
+
+
+class FollowReader(object):
+    """FollowReader class follows a camera folder that is still being
+    written and hands out its frames in file-name order as they arrive,
+    for analysing cells during an acquisition. It stops when no new frame
+    has arrived for idle_timeout seconds.
+    New files are found without re-listing the folder: the next name of
+    a numbered sequence is checked directly, and the folder is listed
+    only when that fails and its modification time has changed. Where
+    available, inotify wakes the reader as soon as a file is closed;
+    polling every poll seconds remains the fallback, e.g. on network
+    shares where inotify does not see the writer.
+    A file is read once it has been closed (inotify) or not modified for
+    settle seconds; a file that still fails to decode is retried retries
+    times and then handed out as (filename, None), like PrefetchReader
+    does, so the position of every frame is its position in the file
+    list; files deleted before they are read are skipped. Files that
+    appear behind the newest name already found are not read.
+    Attributes:
+        frames: number of frames handed out
+        lag: seconds between the writer finishing the last frame handed
+             out and handing it out
+        max_lag, total_lag: largest and summed lag
+        backlog: frames found but not yet handed out
+        dropped: files handed out without a frame or deleted unread
+    """
+
+    def __init__(self, folder, extension=".tiff", poll=0.2, settle=0.5, idle_timeout=60.0,
+                 num_workers=2, queue_depth=8, flags=cv2.IMREAD_COLOR, levels=None, retries=3,
+                 after=None, watch=True):
+        """Initialize variables used by FollowReader class
+        Args:
+            folder: camera folder
+            extension: frame file extension
+            poll: seconds between checks for new files
+            settle: seconds a file must be unmodified before it is read,
+                    unless inotify reported it closed
+            idle_timeout: seconds without a new frame before iteration
+                          ends, None to follow forever
+            num_workers: number of reader threads
+            queue_depth: maximum number of frames read ahead
+            flags: cv2.imread flags
+            levels: 8-bit mapping of single channel frames, see ToGray8
+            retries: reads of a file that fails to decode before it is
+                     dropped
+            after: start after this file name, e.g. when resuming
+            watch: use inotify where available
+        Return:
+            None
+        """
+        if queue_depth < 1:
+            raise ValueError("queue_depth must be at least 1")
+        self.folder = folder
+        self.extension = extension
+        self.poll = poll
+        self.settle = settle
+        self.idle_timeout = idle_timeout
+        self.num_workers = num_workers
+        self.queue_depth = queue_depth
+        self.flags = flags
+        self.levels = levels
+        self.retries = retries
+        self.cursor = after  # newest name found
+        self.submitted = after  # newest name queued for reading
+        self.watch = watch
+        self.listed = None  # folder mtime at the last listing
+        self.closed = set()  # names inotify reported complete
+        self.frames = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.backlog = 0
+        self.dropped = 0
+
+    def _read(self, filename):
+        return ReadFrame(os.path.join(self.folder, filename), self.flags, self.levels)
+
+    def _Discover(self, events=()):
+        """Names of the files that appeared since the last call, in order
+        Args:
+            events: names reported by inotify
+        Return:
+            list of new file names
+        """
+        mtime = os.stat(self.folder).st_mtime_ns
+        found = []
+        name = _Successor(self.cursor) if self.cursor is not None else None
+        while name is not None and os.path.exists(os.path.join(self.folder, name)):
+            found.append(name)
+            name = _Successor(name)
+        if found:
+            self.listed = mtime
+        elif mtime != self.listed:
+            self.listed = mtime
+            found = [entry.name for entry in os.scandir(self.folder)
+                     if entry.name.endswith(self.extension)
+                     and (self.cursor is None or entry.name > self.cursor)]
+        found = sorted(set(found).union(name for name in events if self.cursor is None or name > self.cursor))
+        if found:
+            self.cursor = found[-1]
+        return found
+
+    def _Ready(self, name, now):
+        """(ready, mtime) of a found file; None mtime if it disappeared"""
+        try:
+            mtime = os.stat(os.path.join(self.folder, name)).st_mtime
+        except FileNotFoundError:
+            return True, None
+        if name in self.closed:
+            self.closed.discard(name)
+            return True, mtime
+        return now - mtime >= self.settle, mtime
+
+    def __iter__(self):
+        """Yield (filename, frame) in file-name order as frames arrive"""
+        watcher = None
+        if self.watch and sys.platform.startswith("linux"):
+            try:
+                watcher = _Inotify(self.folder)
+            except OSError:
+                watcher = None
+        try:
+            with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+                waiting = deque(self._Discover())  # found, not yet submitted
+                pending = deque()  # (name, mtime, attempt, future)
+                last_frame = last_check = time.perf_counter()
+                try:
+                    while True:
+                        now = time.time()
+                        while waiting and len(pending) < self.queue_depth:
+                            ready, mtime = self._Ready(waiting[0], now)
+                            if not ready:
+                                break
+                            name = self.submitted = waiting.popleft()
+                            if mtime is None:
+                                self.dropped += 1
+                                continue
+                            pending.append((name, mtime, 0, pool.submit(self._read, name)))
+                        self.backlog = len(waiting) + len(pending)
+
+                        if pending:
+                            name, mtime, attempt, future = pending.popleft()
+                            frame = future.result()
+                            if frame is None:
+                                if attempt < self.retries:  # may still be incomplete
+                                    time.sleep(self.settle)
+                                    pending.appendleft((name, mtime, attempt + 1, pool.submit(self._read, name)))
+                                else:
+                                    # handed out without a frame, so positions stay aligned with file names
+                                    self.dropped += 1
+                                    yield name, None
+                                continue
+                            self.lag = max(0.0, time.time() - mtime)
+                            self.max_lag = max(self.max_lag, self.lag)
+                            self.total_lag += self.lag
+                            self.frames += 1
+                            last_frame = time.perf_counter()
+                            yield name, frame
+                            if time.perf_counter() - last_check < self.poll:
+                                continue
+                            events = watcher.Read(0) if watcher is not None else []
+                        else:
+                            if (self.idle_timeout is not None and not waiting
+                                    and time.perf_counter() - last_frame > self.idle_timeout):
+                                return
+                            if watcher is not None:
+                                events = watcher.Read(self.poll)
+                            else:
+                                time.sleep(self.poll)
+                                events = []
+                        if events is None:  # inotify lost events, list the folder
+                            self.listed = None
+                            events = []
+                        events = [name for name in events if name.endswith(self.extension)]
+                        self.closed.update(name for name in events
+                                           if self.submitted is None or name > self.submitted)
+                        waiting.extend(self._Discover(events))
+                        last_check = time.perf_counter()
+                finally:
+                    for _, _, _, future in pending:
+                        future.cancel()
+        finally:
+            if watcher is not None:
+                watcher.Close()
+
+    def Summary(self):
+        """One-line summary of how far the reader lagged behind the writer
+        Args:
+            None
+        Return:
+            summary string
+        """
+        mean = self.total_lag / self.frames if self.frames else 0.0
+        return ("{} frames followed: lag {:.2f}s mean, {:.2f}s max, {:.2f}s last; "
+                "{} behind, {} dropped").format(self.frames, mean, self.max_lag, self.lag,
+                                                self.backlog, self.dropped)
@@ -0,0 +1,91 @@
+'''
+    File name         : frame_store.py
+    File Description  : Bounded ring buffer of recent frames for cell crops
+    Python Version    : 3
+'''
+
+# Import python libraries
+import numpy as np
+
+
+class FrameStore(object):
+    """FrameStore class keeps a fixed number of recent frames so that the
+    first, middle and last crops of a cell can be taken once its track
+    completes, without holding every decoded frame of the acquisition.
+    Frames are addressed by their absolute frame number; a frame is kept
+    in slot (frame number % capacity) and is overwritten (evicted) by the
+    frame that is capacity frames newer.
+    Attributes:
+        capacity: number of frames held at most
+    """
+
+    def __init__(self, capacity):
+        """Initialize variables used by FrameStore class
+        Args:
+            capacity: number of frames to keep
+        Return:
+            None
+        """
+        if capacity < 1:
+            raise ValueError("FrameStore capacity must be at least 1")
+        self.capacity = int(capacity)
+        self.frames = None  # preallocated on first Put, once shape is known
+        self.indices = np.full(self.capacity, -1, dtype=np.int64)
+
+    @staticmethod
+    def CapacityFor(max_frames_to_skip, max_transit_frames):
+        """Number of frames a live track can still need
+        A cell is saved as soon as it passes the end line, so its first
+        crop is never older than the frames it takes to cross the trace
+        band plus the frames its track may have been coasting undetected.
+        Args:
+            max_frames_to_skip: tracker's maximum undetected frames
+            max_transit_frames: frames a cell may take between the first
+                                line and the end line (bounded by the
+                                tracker's max_trace_length)
+        Return:
+            capacity for FrameStore
+        """
+        return int(max_transit_frames) + int(max_frames_to_skip) + 1
+
+    def Put(self, frame_idx, frame):
+        """Store a copy of frame under its absolute frame number, evicting
+        the frame that previously used the slot
+        Args:
+            frame_idx: absolute frame number
+            frame: image to store
+        Return:
+            None
+        """
+        if self.frames is None:
+            self.frames = np.empty((self.capacity,) + frame.shape,
+                                   dtype=frame.dtype)
+        slot = frame_idx % self.capacity
+        self.frames[slot] = frame
+        self.indices[slot] = frame_idx
+
+    def Get(self, frame_idx):
+        """Look up a frame by absolute frame number
+        Args:
+            frame_idx: absolute frame number
+        Return:
+            stored frame (view into the store), None if evicted or unknown
+        """
+        if frame_idx < 0 or self.frames is None:
+            return None
+        slot = frame_idx % self.capacity
+        if self.indices[slot] != frame_idx:
+            return None
+        return self.frames[slot]
+
+    def __contains__(self, frame_idx):
+        return self.Get(frame_idx) is not None
+
+    def Trim(self, oldest_needed):
+        """Evict every frame older than oldest_needed
+        Args:
+            oldest_needed: oldest frame number a live track can still need
+        Return:
+            None
+        """
+        self.indices[self.indices < oldest_needed] = -1
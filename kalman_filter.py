@@ -100,4 +100,139 @@ class KalmanFilter(object):
                                                               self.u))))
         self.P = self.P - np.dot(K, np.dot(C, K.T))
         self.lastResult = self.u
-        return self.u
\ No newline at end of file
+        return self.u
+
+class BatchKalmanFilter(object):
+    """BatchKalmanFilter class keeps the state vectors and covariances of
+    all live tracks in stacked arrays (structure of arrays) and predicts
+    and corrects any set of them in one vectorized call. Each track owns a
+    slot; slots of removed tracks are reused by new ones.
+    Models:
+        "legacy": the 2-state (x, y) model of KalmanFilter, including its
+                  zero initial state and rounding, so per-track results
+                  match KalmanFilter
+        "cv": constant-velocity model with state (x, y, vx, vy), dt of
+              one frame, initialized at the first detection
+    Attributes:
+        model: name of the motion model
+    """
+
+    def __init__(self, model="legacy", capacity=64, process_noise=1.0,
+                 measurement_noise=1.0):
+        """Initialize variables used by BatchKalmanFilter class
+        Args:
+            model: "legacy" or "cv"
+            capacity: initial number of slots, grows as needed
+            process_noise: process noise scale ("cv" only)
+            measurement_noise: observation noise scale ("cv" only)
+        Return:
+            None
+        """
+        if model == "legacy":
+            dt = 0.005
+            self.F = np.array([[1.0, dt], [0.0, 1.0]])  # state transition mat
+            self.A = np.eye(2)  # matrix in observation equations
+            self.Q = np.eye(2)  # process noise matrix
+            self.R = np.eye(2)  # observation noise matrix
+            self.P0 = np.diag((3.0, 3.0))  # initial covariance matrix
+            self.rounding = True
+        elif model == "cv":
+            dt = 1.0
+            self.F = np.array([[1.0, 0.0, dt, 0.0],
+                               [0.0, 1.0, 0.0, dt],
+                               [0.0, 0.0, 1.0, 0.0],
+                               [0.0, 0.0, 0.0, 1.0]])
+            self.A = np.array([[1.0, 0.0, 0.0, 0.0],
+                               [0.0, 1.0, 0.0, 0.0]])
+            # white noise acceleration
+            G = np.array([[0.5 * dt ** 2, 0.0], [0.0, 0.5 * dt ** 2],
+                          [dt, 0.0], [0.0, dt]])
+            self.Q = process_noise * np.dot(G, G.T)
+            self.R = measurement_noise * np.eye(2)
+            self.P0 = np.diag((measurement_noise, measurement_noise,
+                               100.0, 100.0))
+            self.rounding = False
+        else:
+            raise ValueError("model must be 'legacy' or 'cv'")
+        self.model = model
+        n = self.F.shape[0]
+        self.u = np.zeros((capacity, n))  # state vectors
+        self.P = np.zeros((capacity, n, n))  # covariance matrices
+        self.free = list(range(capacity - 1, -1, -1))
+
+    def _Grow(self):
+        capacity = len(self.u)
+        self.u = np.concatenate((self.u, np.zeros_like(self.u)))
+        self.P = np.concatenate((self.P, np.zeros_like(self.P)))
+        self.free.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def Add(self, b):
+        """Allocate a slot for a new track
+        Args:
+            b: first observation (x, y) of the track
+        Return:
+            slot index
+        """
+        if not self.free:
+            self._Grow()
+        slot = self.free.pop()
+        self.u[slot] = 0.0
+        if self.model == "cv":
+            self.u[slot, :2] = np.ravel(b)
+        self.P[slot] = self.P0
+        return slot
+
+    def Remove(self, slot):
+        """Release the slot of a removed track for reuse
+        Args:
+            slot: slot index
+        Return:
+            None
+        """
+        self.free.append(slot)
+
+    def Predict(self, slots):
+        """Predict state vectors u and covariances P of the given slots
+        Equations:
+            u'_{k|k-1} = Fu'_{k-1|k-1}
+            P_{k|k-1} = FP_{k-1|k-1} F.T + Q
+        Args:
+            slots: array of slot indices
+        Return:
+            (K, 2) predicted positions
+        """
+        u = np.matmul(self.u[slots], self.F.T)
+        if self.rounding:
+            u = np.round(u)
+        self.u[slots] = u
+        self.P[slots] = np.matmul(np.matmul(self.F, self.P[slots]), self.F.T) + self.Q
+        return np.matmul(u, self.A.T)
+
+    def Correct(self, slots, b, flags):
+        """Correct state vectors u and covariances P of the given slots
+        Slots without a detection are corrected with their own prediction
+        (zero innovation), like KalmanFilter.correct with flag 0.
+        Equations:
+            C = AP_{k|k-1} A.T + R
+            K_{k} = P_{k|k-1} A.T(C.Inv)
+            u'_{k|k} = u'_{k|k-1} + K_{k}(b_{k} - Au'_{k|k-1})
+            P_{k|k} = P_{k|k-1} - K_{k}(CK.T)
+        Args:
+            slots: array of slot indices
+            b: (K, 2) observations
+            flags: (K,) True where b is a detection
+        Return:
+            (K, 2) corrected positions
+        """
+        u = self.u[slots]
+        P = self.P[slots]
+        Au = np.matmul(u, self.A.T)
+        b = np.where(np.asarray(flags, dtype=bool)[:, np.newaxis], b, Au)
+        C = np.matmul(np.matmul(self.A, P), self.A.T) + self.R
+        K = np.matmul(np.matmul(P, self.A.T), np.linalg.inv(C))
+        u = u + np.matmul(K, (b - Au)[:, :, np.newaxis])[:, :, 0]
+        if self.rounding:
+            u = np.round(u)
+        self.u[slots] = u
+        self.P[slots] = P - np.matmul(K, np.matmul(C, np.swapaxes(K, 1, 2)))
+        return np.matmul(u, self.A.T)
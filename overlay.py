@@ -0,0 +1,115 @@
+'''
+    File name         : overlay.py
+    File Description  : Incremental trace overlay for the output video
+    Python Version    : 3
+'''
+
+# Import python libraries
+import cv2
+import numpy as np
+
+
+class TraceOverlay(object):
+    """TraceOverlay class keeps the drawn track traces in a persistent
+    layer and only draws the newest segment of every track per frame,
+    instead of redrawing whole traces. The layer is composited onto the
+    frame for the video.
+    Display options:
+        fade: fraction by which older segments fade per frame, and at
+              least one level, so the traces of dead tracks disappear
+              (0 keeps them)
+        max_length: if given, only the last max_length points of each
+                    live track are shown; the layer is redrawn every frame,
+                    which costs O(tracks * max_length)
+        scale: output resolution relative to the frame, e.g. 0.5 for a
+               half-size video; the layer is kept at that resolution
+    Attributes:
+        None
+    """
+
+    def __init__(self, colors, fade=0.0, max_length=None, scale=1.0):
+        """Initialize variables used by TraceOverlay class
+        Args:
+            colors: list of BGR colors, picked by track_id
+            fade: per-frame fade of the trace layer, 0 to 1
+            max_length: display length of traces in points, None for all
+            scale: output resolution relative to the input frame
+        Return:
+            None
+        """
+        self.colors = colors
+        self.fade = fade
+        self.max_length = max_length
+        self.scale = scale
+        self.layer = None  # premultiplied BGR traces
+        self.alpha = None  # coverage of the layer, 0 to 255
+        self.drawn = {}  # track_id -> trace.appended when last drawn
+
+    def OutputSize(self, frame_shape):
+        """(width, height) of the rendered frames, e.g. for VideoWriter"""
+        height, width = frame_shape[:2]
+        return (int(round(width * self.scale)), int(round(height * self.scale)))
+
+    def _Draw(self, points, color):
+        pts = np.round(points * self.scale).astype(np.int32).reshape(-1, 1, 2)
+        cv2.polylines(self.layer, [pts], False, color, 1)
+        cv2.polylines(self.alpha, [pts], False, 255, 1)
+
+    def Update(self, tracks):
+        """Draw what is new in the traces of the given tracks
+        Args:
+            tracks: live tracks of the tracker
+        Return:
+            None
+        """
+        if self.layer is None:
+            return
+        if self.max_length is not None:
+            self.layer[:] = 0
+            self.alpha[:] = 0
+            for track in tracks:
+                if len(track.trace) > 1:
+                    self._Draw(track.trace.Points()[-self.max_length:],
+                               self.colors[track.track_id % len(self.colors)])
+            return
+
+        if self.fade > 0:
+            keep = 1.0 - self.fade
+            cv2.convertScaleAbs(self.layer, self.layer, keep)
+            cv2.convertScaleAbs(self.alpha, self.alpha, keep)
+            # rounding alone stops the fade once fade * value < 0.5
+            cv2.subtract(self.layer, (1, 1, 1, 0), dst=self.layer)
+            cv2.subtract(self.alpha, 1, dst=self.alpha)
+
+        drawn = {}
+        for track in tracks:
+            trace = track.trace
+            last = self.drawn.get(track.track_id, 0)
+            # newest points, plus the last drawn one to connect to
+            new = min(trace.appended - last + 1, len(trace))
+            if new > 1:
+                self._Draw(trace.Points()[-new:],
+                           self.colors[track.track_id % len(self.colors)])
+            drawn[track.track_id] = trace.appended
+        self.drawn = drawn
+
+    def Render(self, frame):
+        """Composite the trace layer onto a frame
+        Args:
+            frame: BGR frame at input resolution
+        Return:
+            BGR frame at output resolution with the traces drawn
+        """
+        if self.scale != 1.0:
+            frame = cv2.resize(frame, self.OutputSize(frame.shape),
+                               interpolation=cv2.INTER_AREA)
+        if self.layer is None:
+            self.layer = np.zeros_like(frame)
+            self.alpha = np.zeros(frame.shape[:2], dtype=np.uint8)
+            return frame
+
+        if self.fade == 0:
+            np.copyto(frame, self.layer, where=(self.alpha > 0)[:, :, np.newaxis])
+            return frame
+        inverse = cv2.cvtColor(255 - self.alpha, cv2.COLOR_GRAY2BGR)
+        return cv2.add(cv2.multiply(frame, inverse, scale=1.0 / 255), self.layer)
@@ -0,0 +1,377 @@
+'''
+    File name         : parallel.py
+    File Description  : Chunked and frame-parallel multi-process detection
+    Python Version    : 3
+'''
+
+# Import python libraries
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from detectors import Detectors, DETECTION
+from frame_source import ReadFrame
+
+
+def _DetectChunk(folder, file_list, start, stop, detector_args,
+                 traceStart, traceEnd, flags, levels, radius):
+    """Detect objects in frames [start, stop) of a camera folder with a
+    fresh Detectors. Runs in a worker process.
+    Return:
+        counts: (stop - start,) number of detections per frame
+        centers: (sum(counts), 2, 1) centroids of all frames
+        features: DETECTION array of all frames
+        radii: (stop - start,) mid-channel radius per frame, None unless
+               radius is set
+        seconds: time spent in the worker
+    """
+    began = time.perf_counter()
+    detector = Detectors(**detector_args)
+    counts = np.zeros(stop - start, dtype=np.int64)
+    # an unreadable frame has no objects, the radius of _Radius without any
+    radii = np.full(stop - start, 1000.0) if radius else None
+    centers = []
+    features = []
+    for frame_idx in range(start, stop):
+        frame = ReadFrame(os.path.join(folder, file_list[frame_idx]), flags, levels)
+        if frame is None:  # as in a serial run, an unreadable frame has no detections
+            print("Frame {} skipped: could not be read".format(file_list[frame_idx]))
+            continue
+        frame_centers, _, frame_features, frame_radius = detector.DetectAll(frame, traceStart, traceEnd, radius)
+        counts[frame_idx - start] = len(frame_centers)
+        if radius:
+            radii[frame_idx - start] = frame_radius
+        centers.extend(frame_centers)
+        features.append(frame_features)
+    centers = np.array(centers, dtype=np.int64).reshape(-1, 2, 1)
+    features = np.concatenate(features) if features else np.empty(0, dtype=DETECTION)
+    return counts, centers, features, radii, time.perf_counter() - began
+
+
+class ChunkedDetection(object):
+    """ChunkedDetection class runs detection on a process pool: the frame
+    list is split into chunks of chunk_size frames and every chunk is
+    detected by its own Detectors in a worker process. The background
+    model must be fitted and must not adapt: the detections of a frame
+    then do not depend on the frames before it, and every chunk finds
+    what a serial run finds. Results are handed out frame by frame in
+    order to one Tracker, so tracks cross chunk boundaries as in a
+    serial run and keep their ids; no stitching is needed. At most
+    num_workers + 1 chunks are in flight (backpressure).
+    An adaptive model (MOG2, running average) remembers every frame it
+    has seen, so a chunk could only reproduce it by replaying all the
+    frames before it; such models are rejected.
+    Attributes:
+        frames: number of frames handed out
+        wait: seconds the consumer spent waiting for chunks
+        worker: seconds spent in the workers
+    """
+
+    def __init__(self, folder, file_list, detector_args, traceStart, traceEnd,
+                 chunk_size=1000, num_workers=None,
+                 flags=cv2.IMREAD_COLOR, levels=None, start=0, radius=False):
+        """Initialize variables used by ChunkedDetection class
+        Args:
+            folder: camera folder
+            file_list: file names in processing order
+            detector_args: keyword arguments of Detectors; background must
+                           be a fitted model that does not adapt
+            traceStart, traceEnd: trace lines, see Detectors.DetectAll
+            chunk_size: frames per chunk
+            num_workers: worker processes, default os.cpu_count()
+            flags: cv2.imread flags
+            levels: 8-bit mapping of single channel frames, see ToGray8
+            start: first frame detected, e.g. when resuming
+            radius: also compute the mid-channel radius of every frame,
+                    see Detectors.DetectAll
+        Return:
+            None
+        """
+        background = detector_args.get("background")
+        if background is None or background.adaptive:
+            raise ValueError("chunked detection needs a static background")
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        self.folder = folder
+        self.file_list = list(file_list)
+        self.detector_args = dict(detector_args)
+        self.traceStart = traceStart
+        self.traceEnd = traceEnd
+        self.chunk_size = chunk_size
+        self.num_workers = num_workers or os.cpu_count()
+        self.flags = flags
+        self.levels = levels
+        self.start = start
+        self.radius = radius
+        self.frames = 0
+        self.wait = 0.0
+        self.worker = 0.0
+
+    def __len__(self):
+        return len(self.file_list) - self.start
+
+    def Chunks(self):
+        """(start, stop) frame ranges of the chunks"""
+        return [(start, min(start + self.chunk_size, len(self.file_list)))
+                for start in range(self.start, len(self.file_list), self.chunk_size)]
+
+    def _Submit(self, pool, chunk):
+        start, stop = chunk
+        return pool.submit(_DetectChunk, self.folder, self.file_list, start, stop,
+                           self.detector_args, self.traceStart, self.traceEnd,
+                           self.flags, self.levels, self.radius)
+
+    def __iter__(self):
+        """Yield (frame_idx, centers, features, radius) in frame order,
+        centers as a (M, 2, 1) array, features as a DETECTION array and
+        radius None unless radius is set"""
+        chunks = iter(self.Chunks())
+        with ProcessPoolExecutor(max_workers=self.num_workers) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append((chunk, self._Submit(pool, chunk)))
+                if len(pending) > self.num_workers:
+                    break
+            try:
+                while pending:
+                    (start, stop), future = pending.popleft()
+                    waited = time.perf_counter()
+                    counts, centers, features, radii, seconds = future.result()
+                    self.wait += time.perf_counter() - waited
+                    self.worker += seconds
+                    nxt = next(chunks, None)
+                    if nxt is not None:
+                        pending.append((nxt, self._Submit(pool, nxt)))
+                    offsets = np.concatenate(([0], np.cumsum(counts)))
+                    for i in range(stop - start):
+                        self.frames += 1
+                        yield (start + i, centers[offsets[i]:offsets[i + 1]],
+                               features[offsets[i]:offsets[i + 1]],
+                               None if radii is None else float(radii[i]))
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
+    def Summary(self):
+        """One-line summary of the chunked detection
+        Args:
+            None
+        Return:
+            summary string
+        """
+        return ("{} frames in chunks of {} on {} processes: "
+                "{:.1f}s detection, waited {:.1f}s").format(
+                    self.frames, self.chunk_size, self.num_workers, self.worker, self.wait)
+
+
+# Detection record of FrameParallelDetection: centroid and DETECTION features;
+# the mid-channel radius is per frame and kept next to the records
+RECORD = np.dtype([("cx", np.int64), ("cy", np.int64)] + DETECTION.descr)
+
+# State of a FrameParallelDetection worker process, set by _InitFrameWorker
+_worker = {}
+
+
+def _SlotBytes(slots, batch, capacity):
+    """Size of the shared buffer of _SlotArrays"""
+    return slots * batch * (capacity * RECORD.itemsize + 16)
+
+
+def _SlotArrays(buffer, slots, batch, capacity):
+    """Views of a shared buffer as the (slots, batch, capacity) records,
+    (slots, batch) detection counts and (slots, batch) radii"""
+    records = np.ndarray((slots, batch, capacity), dtype=RECORD, buffer=buffer)
+    offset = records.nbytes
+    counts = np.ndarray((slots, batch), dtype=np.int64, buffer=buffer, offset=offset)
+    offset += counts.nbytes
+    radii = np.ndarray((slots, batch), dtype=np.float64, buffer=buffer, offset=offset)
+    return records, counts, radii
+
+
+def _InitFrameWorker(folder, file_list, detector_args, traceStart, traceEnd, flags, levels,
+                     radius, name, slots, batch, capacity):
+    """Attach a worker process to the shared record buffer and build its
+    Detectors once"""
+    memory = shared_memory.SharedMemory(name=name)
+    _worker.update(memory=memory, folder=folder, file_list=file_list,
+                   detector=Detectors(**detector_args), traceStart=traceStart, traceEnd=traceEnd,
+                   flags=flags, levels=levels, radius=radius, capacity=capacity,
+                   arrays=_SlotArrays(memory.buf, slots, batch, capacity))
+
+
+def _DetectFrames(slot, start, stop):
+    """Detect objects in frames [start, stop) and write their records,
+    and their radii if asked for, to a slot of the shared buffer. Runs in
+    a worker process.
+    Return:
+        overflow: dict of frame offset -> (centers, features) of the
+                  frames with more detections than a slot holds
+        seconds: time spent in the worker
+    """
+    began = time.perf_counter()
+    detector = _worker["detector"]
+    records, counts, radii = _worker["arrays"]
+    overflow = {}
+    for i, frame_idx in enumerate(range(start, stop)):
+        filename = _worker["file_list"][frame_idx]
+        frame = ReadFrame(os.path.join(_worker["folder"], filename), _worker["flags"], _worker["levels"])
+        if frame is None:  # as in a serial run, an unreadable frame has no detections
+            print("Frame {} skipped: could not be read".format(filename))
+            counts[slot, i], radii[slot, i] = 0, 1000
+            continue
+        centers, _, features, radius = detector.DetectAll(frame, _worker["traceStart"], _worker["traceEnd"],
+                                                          _worker["radius"])
+        if _worker["radius"]:
+            radii[slot, i] = radius
+        n = counts[slot, i] = len(centers)
+        if n > _worker["capacity"]:
+            overflow[i] = (np.array(centers, dtype=np.int64).reshape(-1, 2, 1), features)
+            continue
+        rows = records[slot, i, :n]
+        if n:
+            rows["cx"], rows["cy"] = np.array(centers, dtype=np.int64).reshape(-1, 2).T
+        for field in DETECTION.names:
+            rows[field] = features[field]
+    return overflow, time.perf_counter() - began
+
+
+def _CopyFrame(arrays, slot, i):
+    """Copy the centers and features of frame i of a slot out of the
+    shared buffer"""
+    records, counts, _ = arrays
+    rows = records[slot, i, :counts[slot, i]]
+    centers = np.stack((rows["cx"], rows["cy"]), axis=1).reshape(-1, 2, 1)
+    features = np.empty(len(rows), dtype=DETECTION)
+    for field in DETECTION.names:
+        features[field] = rows[field]
+    return centers, features
+
+
+class FrameParallelDetection(object):
+    """FrameParallelDetection class detects frames on a process pool with
+    a fixed (static) background model, so every frame can be detected on
+    its own and in any order. Workers read their frames from the camera
+    folder and build their Detectors once; they are handed batches of
+    batch frames and write only the detection records (centroid and
+    features) of each frame, and its mid-channel radius if asked for,
+    into a slot of a shared memory ring, so neither frames nor results
+    are pickled. Records are handed out in
+    frame order, for one Tracker; with the same background they are those
+    of a serial run. At most 2 * num_workers batches are in flight
+    (backpressure). Frames with more than capacity detections are
+    returned through the pool instead.
+    Attributes:
+        frames: number of frames handed out
+        wait: seconds the consumer spent waiting for batches
+        worker: seconds spent in the workers
+    """
+
+    def __init__(self, folder, file_list, detector_args, traceStart, traceEnd,
+                 batch=32, num_workers=None, flags=cv2.IMREAD_COLOR, levels=None,
+                 start=0, capacity=256, radius=False):
+        """Initialize variables used by FrameParallelDetection class
+        Args:
+            folder: camera folder
+            file_list: file names in processing order
+            detector_args: keyword arguments of Detectors; background must
+                           be a fitted model that does not adapt
+            traceStart, traceEnd: trace lines, see Detectors.DetectAll
+            batch: frames per task
+            num_workers: worker processes, default os.cpu_count()
+            flags: cv2.imread flags
+            levels: 8-bit mapping of single channel frames, see ToGray8
+            start: first frame detected, e.g. when resuming
+            capacity: detections per frame held in shared memory
+            radius: also compute the mid-channel radius of every frame,
+                    see Detectors.DetectAll
+        Return:
+            None
+        """
+        background = detector_args.get("background")
+        if background is None or background.adaptive:
+            raise ValueError("frame-parallel detection needs a static background")
+        if batch < 1:
+            raise ValueError("batch must be at least 1")
+        self.folder = folder
+        self.file_list = list(file_list)
+        self.detector_args = dict(detector_args)
+        self.traceStart = traceStart
+        self.traceEnd = traceEnd
+        self.batch = batch
+        self.num_workers = num_workers or os.cpu_count()
+        self.flags = flags
+        self.levels = levels
+        self.start = start
+        self.capacity = capacity
+        self.radius = radius
+        self.frames = 0
+        self.wait = 0.0
+        self.worker = 0.0
+
+    def __len__(self):
+        return len(self.file_list) - self.start
+
+    def __iter__(self):
+        """Yield (frame_idx, centers, features, radius) in frame order,
+        centers as a (M, 2, 1) array, features as a DETECTION array and
+        radius None unless radius is set"""
+        slots = 2 * self.num_workers
+        memory = shared_memory.SharedMemory(create=True, size=_SlotBytes(slots, self.batch, self.capacity))
+        arrays = _SlotArrays(memory.buf, slots, self.batch, self.capacity)
+        batches = iter(range(self.start, len(self.file_list), self.batch))
+        free = deque(range(slots))
+        pending = deque()
+        try:
+            with ProcessPoolExecutor(max_workers=self.num_workers, initializer=_InitFrameWorker,
+                                     initargs=(self.folder, self.file_list, self.detector_args,
+                                               self.traceStart, self.traceEnd, self.flags, self.levels,
+                                               self.radius, memory.name, slots, self.batch, self.capacity)) as pool:
+                def submit():
+                    start = next(batches, None)
+                    if start is not None:
+                        slot = free.popleft()
+                        stop = min(start + self.batch, len(self.file_list))
+                        pending.append((slot, start, stop, pool.submit(_DetectFrames, slot, start, stop)))
+
+                for _ in range(slots):
+                    submit()
+                try:
+                    while pending:
+                        slot, start, stop, future = pending.popleft()
+                        waited = time.perf_counter()
+                        overflow, seconds = future.result()
+                        self.wait += time.perf_counter() - waited
+                        self.worker += seconds
+                        # copy the records out, the slot is reused by the next batch
+                        copies = [(overflow[i] if i in overflow else _CopyFrame(arrays, slot, i))
+                                  + (float(arrays[2][slot, i]) if self.radius else None,)
+                                  for i in range(stop - start)]
+                        free.append(slot)
+                        submit()
+                        for i, (centers, features, radius) in enumerate(copies):
+                            self.frames += 1
+                            yield start + i, centers, features, radius
+                finally:
+                    for _, _, _, future in pending:
+                        future.cancel()
+        finally:
+            # the views must be gone before the buffer is closed
+            del arrays
+            memory.close()
+            memory.unlink()
+
+    def Summary(self):
+        """One-line summary of the frame-parallel detection
+        Args:
+            None
+        Return:
+            summary string
+        """
+        return ("{} frames in batches of {} on {} processes: "
+                "{:.1f}s detection, waited {:.1f}s").format(
+                    self.frames, self.batch, self.num_workers, self.worker, self.wait)
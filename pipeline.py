@@ -0,0 +1,487 @@
+'''
+    File name         : pipeline.py
+    File Description  : Detection, tracking and cell saving for one camera folder
+    Python Version    : 3
+'''
+
+# Import python libraries
+import glob
+import json
+import os
+import re
+import time
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+from background import MakeBackground, SampleIndices
+from cell_writer import CellWriter, MakeSnapshot
+from checkpoint import CheckParameters, LoadCheckpoint, RemoveCheckpoint, SaveCheckpoint
+from crop_archive import CropArchive
+from detectors import Detectors, DETECTION
+from frame_source import DiskFrames, FollowReader, IMREAD_NATIVE, ListFrames, PrefetchReader
+from frame_store import FrameStore
+from overlay import TraceOverlay
+from parallel import ChunkedDetection, FrameParallelDetection
+from profiling import StageProfiler
+from results_store import ResultsStore
+from tracker import Tracker
+
+# Written to the results folder when a folder has been processed completely
+COMPLETE_MARKER = "complete.json"
+# Stage timing and counters of profiled runs, one JSON line per interval
+METRICS_FILE = "metrics.jsonl"
+
+TRACK_COLORS = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0),
+                (0, 255, 255), (255, 0, 255), (255, 127, 255),
+                (127, 0, 255), (127, 0, 127)]
+
+# ProcessFolder parameters that may change when a run is resumed
+RUNTIME_PARAMETERS = ("resultsFolder", "readerThreads", "readAhead", "parallelWorkers", "parallelMode",
+                      "chunkSize", "frameBatch", "cellWriterWorkers", "cellWriterQueue",
+                      "checkpointReplay", "resume", "follow", "followIdle", "profile", "metricsInterval",
+                      "debug", "progress")
+
+
+def IsComplete(cameraFolder, resultsFolder):
+    """True if resultsFolder has the completion marker of a run over all
+    frames currently in cameraFolder
+    Args:
+        cameraFolder: camera folder
+        resultsFolder: results folder
+    Return:
+        bool
+    """
+    path = os.path.join(resultsFolder, COMPLETE_MARKER)
+    if not os.path.exists(path):
+        return False
+    with open(path) as file:
+        summary = json.load(file)
+    return summary.get("frames") == len(ListFrames(cameraFolder))
+
+
+def ProcessFolder(cameraFolder, resultsFolder,
+                  blur=5, dilate=3, cellSize=100, blobRadiusThresh=7,
+                  traceStart=430, traceEnd=830, roiMargin=100,
+                  background="mog2", backgroundThreshold=15, backgroundPercentile=50,
+                  backgroundSamples=200, backgroundRate=0.05, backgroundEvery=10,
+                  distThresh=100, maxFramesToSkip=2, maxTraceLength=5000,
+                  trackIdStart=100, kalmanModel="legacy", maxTransitFrames=500,
+                  grayscale=True, levels=None, readerThreads=4, readAhead=16,
+                  parallelWorkers=0, parallelMode="chunks", chunkSize=1000, frameBatch=32,
+                  writeVideo=True, overlayFade=0.02, overlayMaxLength=None,
+                  overlayScale=1.0, cellWriterWorkers=2, cellWriterQueue=32,
+                  saveVelGraph=True, exportCellDirectories=False,
+                  resultsShardSize=256, cropChunkSize=256,
+                  checkpointEvery=0, checkpointReplay=None, resume=False,
+                  follow=False, followIdle=60.0, profile=False, metricsInterval=10.0,
+                  debug=False, progress=True):
+    """Detect, track and save the cells of one camera folder
+    Args:
+        cameraFolder: folder of .tiff frames
+        resultsFolder: folder for the results store, crop archive, video
+                       and optional Cell_<id> directories
+        blur, dilate: Detectors blur and dilation
+        cellSize: side of the first and last crops, half the width of
+                  the mid crop
+        blobRadiusThresh: smallest object radius kept by the detector
+        traceStart, traceEnd: x positions of the first and end lines
+        roiMargin: detect this far outside the trace band so tracks start
+                   before traceStart
+        background: background model, "mog2" (adapts every frame),
+                    "static" (one image estimated before the run, for a
+                    fixed channel under steady light; cheapest, and needed
+                    by parallelWorkers) or "running" (average updated
+                    every backgroundEvery frames), see background.py
+        backgroundThreshold: foreground threshold of static and running
+        backgroundPercentile, backgroundSamples: per-pixel percentile of
+            backgroundSamples frames spread over the folder (static)
+        backgroundRate, backgroundEvery: update weight and interval of
+            the running average
+        distThresh, maxFramesToSkip, maxTraceLength, trackIdStart:
+            Tracker parameters
+        kalmanModel: "legacy" (x, y) or "cv" constant velocity Kalman
+                     filter of the tracks, see BatchKalmanFilter
+        maxTransitFrames: frames a cell may take to cross from traceStart
+                          to traceEnd; bounds the frames kept for crops
+        grayscale: read frames single channel at their native bit depth
+                   and map them to 8-bit with levels (see ToGray8), so
+                   frames, crops and the frames kept for them are one
+                   channel; only the video is drawn in colour. False
+                   reads every frame as 8-bit BGR
+        levels: (low, high) camera values mapped to 0 and 255, None keeps
+                the 8 high bits like the BGR read
+        readerThreads, readAhead: frames are read and decoded ahead of
+                                  the loop
+        parallelWorkers: >0 detects frames in that many processes and
+                         tracks them here in frame order, with the cells
+                         of a serial run; needs background="static", as
+                         an adaptive model depends on every frame before.
+                         Crops are read back from disk and no video is
+                         written
+        parallelMode: "chunks" hands contiguous chunks of frames to the
+                      workers, which return their detections pickled;
+                      "frames" hands them batches of frames and they
+                      return their detections through shared memory
+        chunkSize: frames per chunk of the "chunks" mode
+        frameBatch: frames per task of the "frames" mode
+        writeVideo: False skips all drawing and output.avi
+        overlayFade, overlayMaxLength, overlayScale: trace fading per
+            frame, trace points shown, video resolution
+        cellWriterWorkers, cellWriterQueue: completed cells are saved in
+                                            the background
+        saveVelGraph: False writes only t-v.csv, without VelGraph.png
+        exportCellDirectories: also write a Cell_<id> directory per cell
+        resultsShardSize, cropChunkSize: cells per shard of the results
+            store, crops per chunk of the crop archive
+        checkpointEvery: >0 writes resultsFolder/checkpoint.pkl every that
+                         many frames, and the video as one output_<n>.avi
+                         segment per checkpoint interval
+        checkpointReplay: frames before the checkpoint replayed through the
+                          background model on resume; None (default)
+                          replays from the first frame and gives exactly
+                          the cells of an uninterrupted run, at the cost
+                          of reading every frame again. A number, e.g.
+                          500 (the MOG2 history), resumes faster but the
+                          rebuilt model only approximates the original:
+                          centroids, and with them the cells, can differ
+                          from an uninterrupted run. A static background
+                          is not replayed
+        resume: continue from the checkpoint in resultsFolder, if there
+                is one, instead of starting over
+        follow: process frames as the camera writes them (FollowReader),
+                until none has arrived for followIdle seconds; needs
+                parallelWorkers=0
+        profile: time every stage of the frame loop and count detections,
+                 tracks and cells; metrics of every metricsInterval
+                 seconds are appended to resultsFolder/metrics.jsonl and
+                 the run-level statistics are added to the summary
+        debug: show the detector's pipeline images
+        progress: show a progress bar
+    Return:
+        summary dict with frames, cells, failed, unreadable (frames that
+        could not be decoded and were skipped; serial runs), seconds and fps; also
+        written to resultsFolder/complete.json
+    """
+    parameters = dict(locals())
+    began = time.perf_counter()
+    if follow and parallelWorkers > 0:
+        raise ValueError("follow mode detects frames as they arrive, set parallelWorkers=0")
+    if parallelWorkers > 0 and background != "static":
+        # workers detect their frames on their own, an adaptive model would need every frame before
+        raise ValueError("parallelWorkers > 0 needs background=\"static\" to give the cells of a serial run")
+    os.makedirs(resultsFolder, exist_ok=True)
+    marker = os.path.join(resultsFolder, COMPLETE_MARKER)
+    if os.path.exists(marker):
+        os.remove(marker)
+
+    # The tracker, overlay and bookkeeping of the results are restored from the checkpoint;
+    # the background model and the frames of live tracks are rebuilt from the camera folder
+    state = LoadCheckpoint(resultsFolder) if resume else None
+    if state is not None:
+        CheckParameters(state["parameters"], parameters, RUNTIME_PARAMETERS)
+    else:
+        RemoveCheckpoint(resultsFolder)
+    start = 0 if state is None else state["frame"]
+
+    metrics = os.path.join(resultsFolder, METRICS_FILE)
+    if profile and state is None and os.path.exists(metrics):
+        os.remove(metrics)
+    profiler = StageProfiler(profile, metrics, metricsInterval)
+    flags = IMREAD_NATIVE if grayscale else cv2.IMREAD_COLOR
+
+    detectorArgs = dict(blurFactor=blur, dilateFactor=dilate, blob_radius_thresh=blobRadiusThresh, debug=debug,
+                        roi=(traceStart, 0, traceEnd - traceStart, None), roi_margin=roiMargin,
+                        background=MakeBackground(background, backgroundThreshold, backgroundPercentile,
+                                                  backgroundRate, backgroundEvery))
+    detector = Detectors(**detectorArgs)
+    file_list = ListFrames(cameraFolder)
+    if not detector.background.adaptive:
+        # a static background is estimated from frames spread over the folder (the frames
+        # present when a followed acquisition starts); chunk workers get a copy of it
+        with profiler.Stage("background"):
+            sample = [file_list[i] for i in SampleIndices(len(file_list), backgroundSamples)]
+            reader = PrefetchReader(cameraFolder, sample, readerThreads, readAhead, flags, levels)
+            detector.FitBackground(frame for _, frame in reader if frame is not None)
+
+    # Create Object Tracker
+    # the features of every detection are kept in the trace of the track it is assigned to
+    if state is None:
+        tracker = Tracker(distThresh, maxFramesToSkip, maxTraceLength, trackIdStart, kalman_model=kalmanModel,
+                          trace_start=traceStart, trace_end=traceEnd, record_dtype=DETECTION)
+    else:
+        tracker = state["tracker"]
+
+    # Keep only the frames a live track can still need for its crops
+    frame_store = FrameStore(FrameStore.CapacityFor(tracker.max_frames_to_skip, min(maxTransitFrames, tracker.max_trace_length)))
+
+    # Setup VideoWriter and the trace overlay drawn into it
+    fourcc = cv2.VideoWriter_fourcc(*'MJPG')
+    out = None
+    overlay = TraceOverlay(TRACK_COLORS, overlayFade, overlayMaxLength, overlayScale) if state is None else state["overlay"]
+    segment = 0 if state is None else state["segment"]
+    if checkpointEvery > 0:
+        # segments after the checkpoint are written again
+        for path in glob.glob(os.path.join(resultsFolder, "output_*.avi")):
+            match = re.fullmatch(r"output_(\d+)\.avi", os.path.basename(path))
+            if match and int(match.group(1)) >= segment:
+                os.remove(path)
+
+    # Save completed cells off the frame loop, all cells of the run go to one results store
+    # and the crops to one crop archive (python crop_archive.py exports them as PNGs)
+    store = ResultsStore(resultsFolder + "/results", resultsShardSize, append=state is not None)
+    crops = CropArchive(resultsFolder + "/crops", cropChunkSize,
+                        shapes={"first": (cellSize, cellSize), "last": (cellSize, cellSize)},
+                        append=state is not None)
+    writer = CellWriter(cellWriterWorkers, cellWriterQueue, vel_graph=saveVelGraph,
+                        store=store, export=exportCellDirectories, crops=crops, profiler=profiler)
+    if state is not None:
+        # drop the cells saved after the checkpoint, they are saved again
+        store.Truncate(state["shards"])
+        crops.Truncate(state["crops"])
+        writer.saved = len(state["ids"])
+        writer.ids = list(state["ids"])
+        writer.errors = list(state["errors"])
+
+    # Loop through contents of camera folder
+    unreadable = []  # frames that could not be decoded (serial reads)
+    if parallelWorkers > 0:
+        # detection runs ahead in worker processes, tracking continues across chunks and batches here
+        if writeVideo:
+            print("parallelWorkers > 0: frames are not loaded in this process, no video is written")
+        writeVideo = False
+        frames = DiskFrames(cameraFolder, file_list, flags, levels)
+        if parallelMode == "frames":
+            source = FrameParallelDetection(cameraFolder, file_list, detectorArgs, traceStart, traceEnd,
+                                            frameBatch, parallelWorkers, flags, levels, start)
+        elif parallelMode == "chunks":
+            source = ChunkedDetection(cameraFolder, file_list, detectorArgs, traceStart, traceEnd,
+                                      chunkSize, parallelWorkers, flags, levels, start)
+        else:
+            raise ValueError("parallelMode must be 'chunks' or 'frames'")
+        detections = ((None, centers, [], features)
+                      for _, centers, features, _ in profiler.Iterate("detect", source))
+    else:
+        frames = frame_store
+        if start > 0:
+            _Replay(detector, frame_store, tracker, cameraFolder, file_list, start,
+                    checkpointReplay, readerThreads, readAhead, flags, levels)
+        if follow:
+            # frames are read as the camera writes them, the lag behind it is shown on the progress bar
+            source = FollowReader(cameraFolder, idle_timeout=followIdle, num_workers=readerThreads,
+                                  queue_depth=readAhead, flags=flags, levels=levels,
+                                  after=file_list[start - 1] if start > 0 else None)
+        else:
+            source = PrefetchReader(cameraFolder, file_list[start:], readerThreads, readAhead, flags, levels)
+
+        def detectFrames(reader):
+            for frameIndex, (filename, frame) in enumerate(profiler.Iterate("read", reader), start):
+                if frame is None:
+                    # an unreadable frame keeps its index and has no detections
+                    print("Frame {} skipped: could not be read".format(filename))
+                    unreadable.append(filename)
+                    profiler.Count("unreadable_frames")
+                    yield None, [], [], np.empty(0, dtype=DETECTION)
+                    continue
+
+                # Keep a copy of the original frame for cell crops
+                with profiler.Stage("frame_copy"):
+                    frame_store.Put(frameIndex, frame)
+
+                # Detect and return centeroids of the objects
+                with profiler.Stage("detect"):
+                    detected = detector.DetectAll(frame, traceStart, traceEnd)
+                yield (frame,) + detected[:3]
+        detections = detectFrames(source)
+
+    currFrame = start
+    progressBar = tqdm(detections, total=None if follow else len(file_list), initial=start,
+                       desc='Processing TIFF files', disable=not progress)
+    try:
+        for frame, centers, contours_refined, features in progressBar:
+
+            if writeVideo and out is None and frame is not None:  # Initialize the VideoWriter once we know frame size
+                video = "output.avi" if checkpointEvery <= 0 else "output_{:03d}.avi".format(segment)
+                out = cv2.VideoWriter(f'{resultsFolder}/{video}', fourcc, 20.0, overlay.OutputSize(frame.shape))
+                if not out.isOpened():
+                    raise IOError("Failed to open video writer")
+
+            # If centroids are detected then track them
+            if (len(centers) > 0):
+                profiler.Count("detections", len(centers))
+
+                # Track object using Kalman Filter; returns the tracks that have
+                # just crossed from before traceStart to past traceEnd
+                with profiler.Stage("track"):
+                    completed = tracker.Update(centers, currFrame, features)
+
+                # For identified object tracks draw the newest tracking line segments
+                # Use various colors to indicate different track_id
+                if writeVideo:
+                    with profiler.Stage("trace_draw"):
+                        overlay.Update(tracker.tracks)
+
+                # save the trace and store the cell of every completed track
+                for event in completed:
+                    with profiler.Stage("cell_submit"):
+                        _SubmitCell(writer, frames, event, cellSize, resultsFolder)
+                    profiler.Count("cells_completed")
+
+            if writeVideo and frame is not None:
+                with profiler.Stage("annotate"):
+                    # Single channel frames get their colour only here, for the video
+                    if frame.ndim == 2:
+                        frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+                    # Draw vertical lines at traceStart and traceEnd
+                    height = frame.shape[0]
+                    cv2.line(frame, (traceStart, 0), (traceStart, height), (255, 0, 0), 2)  # Red line at traceStart
+                    cv2.line(frame, (traceEnd, 0), (traceEnd, height), (255, 0, 0), 2)      # Red line at traceEnd
+
+                    for contour in contours_refined:
+                        cv2.drawContours(frame, [contour], -1, (255, 0, 0), 1)
+
+                    # After detecting centers, contours, and bounding boxes
+                    for x, y, w, h in features[["x", "y", "w", "h"]].tolist():
+                        cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 0, 255), 1)
+
+                with profiler.Stage("render"):
+                    composed = overlay.Render(frame)
+                with profiler.Stage("video_write"):
+                    out.write(composed)
+
+            # Evict frames no live track can still need
+            with profiler.Stage("trim"):
+                live_starts = [int(track.trace.frames[0]) for track in tracker.tracks if track.tracked == 0 and len(track.trace) > 0]
+                frame_store.Trim(min(live_starts, default=currFrame))
+
+            currFrame = currFrame + 1
+            if follow and progress:
+                progressBar.set_postfix(lag="{:.2f}s".format(source.lag), behind=source.backlog, refresh=False)
+            if profiler.enabled:
+                profiler.Gauge("frame", currFrame)
+                profiler.Gauge("live_tracks", len(live_starts))
+                profiler.Gauge("tracks", len(tracker.tracks))
+                profiler.Gauge("cells_saved", writer.saved)
+                profiler.Gauge("cells_failed", len(writer.errors))
+                if follow:
+                    profiler.Gauge("lag_seconds", round(source.lag, 3))
+                    profiler.Gauge("behind", source.backlog)
+                profiler.Frame()
+
+            if checkpointEvery > 0 and currFrame % checkpointEvery == 0 and (follow or currFrame < len(file_list)):
+                # close the video segment and wait for the queued cells, so the results on
+                # disk are exactly those of the frames before the checkpoint
+                if out is not None:
+                    out.release()
+                    out = None
+                segment += 1
+                with profiler.Stage("checkpoint"):
+                    writer.Flush()
+                    SaveCheckpoint(resultsFolder, {
+                        "parameters": parameters, "frame": currFrame, "tracker": tracker,
+                        "overlay": overlay, "segment": segment,
+                        "shards": len(store.manifest["shards"]), "crops": crops.Entries(),
+                        "ids": list(writer.ids),
+                        "errors": [(id, repr(error)) for id, error in writer.errors]})
+    finally:
+        # Release everything when job is finished
+        progressBar.close()
+        if out is not None:
+            out.release()
+        writer.Close()
+        profiler.Gauge("cells_saved", writer.saved)
+        profiler.Gauge("cells_failed", len(writer.errors))
+        profiler.Close()
+
+    seconds = time.perf_counter() - began
+    summary = {"cameraFolder": cameraFolder, "resultsFolder": resultsFolder,
+               "frames": currFrame, "resumedFrom": start, "cells": writer.saved, "failed": len(writer.errors),
+               "unreadable": len(unreadable),
+               "seconds": round(seconds, 3), "fps": round((currFrame - start) / seconds, 3) if seconds > 0 else 0.0,
+               "source": source.Summary()}
+    if profile:
+        summary["profile"] = profiler.Stats()
+        if progress:
+            print(profiler.Report())
+    with open(marker + ".tmp", "w") as file:
+        json.dump(summary, file, indent=1)
+    os.replace(marker + ".tmp", marker)
+    RemoveCheckpoint(resultsFolder)
+    return summary
+
+
+def _Replay(detector, frame_store, tracker, cameraFolder, file_list, start, replay,
+            readerThreads, readAhead, flags, levels):
+    """Rebuild what a checkpoint does not hold: the background model,
+    from the frames before start (MOG2 cannot be saved), and the frames
+    the live tracks of the restored tracker still need for their crops
+    Args:
+        detector: fresh Detectors, its background fitted if static
+        frame_store: empty FrameStore
+        tracker: restored Tracker
+        cameraFolder: camera folder
+        file_list: frame file names
+        start: first frame of the resumed run
+        replay: frames replayed through the background model, None for all
+        readerThreads, readAhead, flags, levels: PrefetchReader parameters
+    Return:
+        None
+    """
+    first = 0 if replay is None else max(0, start - replay)
+    if not detector.background.adaptive:
+        first = start
+    live_starts = [int(track.trace.frames[0]) for track in tracker.tracks if track.tracked == 0 and len(track.trace) > 0]
+    oldest = min(live_starts, default=start)
+    begin = min(first, oldest)
+    reader = PrefetchReader(cameraFolder, file_list[begin:start], readerThreads, readAhead, flags, levels)
+    for frameIndex, (filename, frame) in enumerate(reader, begin):
+        if frame is None:
+            continue
+        if frameIndex >= first:
+            detector.Prime(frame)
+        if frameIndex >= oldest:
+            frame_store.Put(frameIndex, frame)
+
+
+def _SubmitCell(writer, frames, event, cellSize, resultsFolder):
+    """Crop the first, middle and last frames of a completed track and
+    queue the cell on the writer
+    Args:
+        writer: CellWriter
+        frames: FrameStore or DiskFrames the crops are taken from
+        event: CellEvent of the track
+        cellSize: crop size
+        resultsFolder: results folder
+    Return:
+        None
+    """
+    trace = event.track.trace
+    xs, ys = trace.x, trace.y
+    first, middle = event.first_index, event.middle_index
+    firstCrop = midCrop = lastCrop = None
+
+    # take last photo
+    photoFrame = frames.Get(event.last_frame)
+    if photoFrame is not None:
+        lastCrop = photoFrame[(int(ys[-1]) - int(cellSize/2)):(int(ys[-1]) + int(cellSize/2)), (int(xs[-1]) - int(cellSize/2)):(int(xs[-1]) + int(cellSize/2))]
+
+    # take first photo
+    photoFrame = frames.Get(event.first_frame)
+    if photoFrame is not None:
+        firstCrop = photoFrame[(int(ys[first]) - int(cellSize/2)):(int(ys[first]) + int(cellSize/2)), (int(xs[first]) - int(cellSize/2)):(int(xs[first]) + int(cellSize/2))]
+
+    #take middle photo
+    photoFrame = frames.Get(event.middle_frame)
+    if photoFrame is not None:
+        midCrop = photoFrame[(0):(photoFrame.shape[0]), (int(xs[middle]) - int(cellSize)):(int(xs[middle]) + int(cellSize))]
+
+    if (firstCrop is None) or (midCrop is None) or (lastCrop is None):
+        print("Cell {} not saved: frame no longer available".format(event.track.track_id))
+        return
+
+    # plotting and file writing happen on the cell writer
+    cellDirectory = resultsFolder + "/Cell_{}".format(event.track.track_id)
+    writer.Submit(MakeSnapshot(event.track.track_id, cellDirectory, xs, ys, first, middle,
+                               firstCrop, midCrop, lastCrop, trace.Records()[first:], trace.frames))
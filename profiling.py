@@ -0,0 +1,293 @@
+'''
+    File name         : profiling.py
+    File Description  : Stage timing and counters for the frame loop
+    Python Version    : 3
+'''
+
+# Import python libraries
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+# Run-level percentiles come from log-spaced histograms of the stage
+# durations: 1us to 100s, 20 bins per decade (about 12% resolution)
+HISTOGRAM_MIN, HISTOGRAM_DECADES, HISTOGRAM_PER_DECADE = 1e-6, 8, 20
+PERCENTILES = (50, 90, 99)
+
+
+def _Bins(seconds):
+    position = (np.log10(np.maximum(seconds, HISTOGRAM_MIN)) - np.log10(HISTOGRAM_MIN)) * HISTOGRAM_PER_DECADE
+    return np.minimum(position.astype(np.int64), HISTOGRAM_DECADES * HISTOGRAM_PER_DECADE - 1)
+
+
+def _HistogramPercentile(histogram, q):
+    """Upper edge of the bin holding the q-th percentile, in seconds"""
+    counts = np.cumsum(histogram)
+    if counts[-1] == 0:
+        return 0.0
+    index = int(np.searchsorted(counts, q / 100.0 * counts[-1]))
+    return HISTOGRAM_MIN * 10 ** ((index + 1) / HISTOGRAM_PER_DECADE)
+
+
+class _Timer(object):
+    """Reusable context manager timing one stage"""
+    __slots__ = ("profiler", "name", "began")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.began = 0.0
+
+    def __enter__(self):
+        self.began = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.Add(self.name, time.perf_counter() - self.began)
+        return False
+
+
+class _NullTimer(object):
+    """Timer of a disabled profiler"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class StageProfiler(object):
+    """StageProfiler class times the stages of the frame loop and keeps
+    counters (summed per frame, e.g. detections) and gauges (last value,
+    e.g. live tracks). Stages are timed with
+        with profiler.Stage("detect"):
+            ...
+    or, for the wait on an iterator, profiler.Iterate("read", reader).
+    Every interval seconds the durations of the interval are folded into
+    the run histograms, so memory stays bounded however long the run,
+    and a JSON line with the frames/sec, per-stage percentiles, counters
+    and gauges of the interval is appended to the metrics file, if any,
+    so long runs can be watched while they run. Report gives the
+    percentiles of the whole run.
+    A disabled profiler hands out a shared no-op timer, so the hooks can
+    stay in place. Stage timers are reused and belong to the frame loop's
+    thread; Add and Count are thread-safe, for stages timed on worker
+    threads.
+    Attributes:
+        enabled: timing and metrics are collected
+        frames: number of frames ended with Frame
+    """
+
+    def __init__(self, enabled=True, metrics_path=None, interval=10.0):
+        """Initialize variables used by StageProfiler class
+        Args:
+            enabled: False turns every hook into a no-op
+            metrics_path: JSON-lines file the interval metrics are
+                          appended to, None for none
+            interval: seconds between metrics lines
+        Return:
+            None
+        """
+        self.enabled = enabled
+        self.metrics_path = metrics_path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.samples = {}  # stage -> durations of the current interval
+        self.histograms = {}  # stage -> run histogram
+        self.totals = {}  # stage -> [calls, seconds, max]
+        self.counters = {}
+        self.interval_counters = {}
+        self.gauges = {}
+        self.frames = 0
+        self.interval_frames = 0
+        self.began = self.interval_began = time.perf_counter()
+        self.metrics = None
+        if enabled and metrics_path is not None:
+            directory = os.path.dirname(metrics_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.metrics = open(metrics_path, "a")
+
+    def Stage(self, name):
+        """Context manager timing one stage
+        Args:
+            name: stage name
+        Return:
+            timer, reusable
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = _Timer(self, name)
+        return timer
+
+    def Iterate(self, name, iterable):
+        """Yield the items of iterable, timing the wait for every item as
+        stage name
+        Args:
+            name: stage name
+            iterable: e.g. a frame reader
+        Return:
+            generator
+        """
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            began = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.Add(name, time.perf_counter() - began)
+            yield item
+
+    def Add(self, name, seconds):
+        """Record one duration of a stage
+        Args:
+            name: stage name
+            seconds: duration
+        Return:
+            None
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            samples = self.samples.get(name)
+            if samples is None:
+                samples = self.samples[name] = []
+                self.histograms[name] = np.zeros(HISTOGRAM_DECADES * HISTOGRAM_PER_DECADE, dtype=np.int64)
+                self.totals[name] = [0, 0.0, 0.0]
+            samples.append(seconds)
+            total = self.totals[name]
+            total[0] += 1
+            total[1] += seconds
+            if seconds > total[2]:
+                total[2] = seconds
+
+    def Count(self, name, value=1):
+        """Add to a counter, e.g. the detections of a frame"""
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+                self.interval_counters[name] = self.interval_counters.get(name, 0) + value
+
+    def Gauge(self, name, value):
+        """Set a gauge, e.g. the number of live tracks"""
+        if self.enabled:
+            self.gauges[name] = value
+
+    def Frame(self):
+        """End a frame; when interval has passed, folds the interval into
+        the run histograms and writes its metrics line
+        Args:
+            None
+        Return:
+            None
+        """
+        if not self.enabled:
+            return
+        self.frames += 1
+        self.interval_frames += 1
+        if time.perf_counter() - self.interval_began >= self.interval:
+            self._Emit()
+
+    def _Emit(self, final=False):
+        """Fold the interval into the run histograms and write its line,
+        if there is a metrics file"""
+        now = time.perf_counter()
+        with self.lock:
+            samples, self.samples = self.samples, {name: [] for name in self.samples}
+            counters, self.interval_counters = self.interval_counters, {}
+        seconds = now - self.interval_began
+        stages = {}
+        for name, durations in samples.items():
+            if not durations:
+                continue
+            durations = np.asarray(durations)
+            self.histograms[name] += np.bincount(_Bins(durations), minlength=len(self.histograms[name]))
+            stage = {"calls": len(durations), "seconds": round(float(durations.sum()), 6)}
+            for q, value in zip(PERCENTILES, np.percentile(durations, PERCENTILES)):
+                stage["p{}_ms".format(q)] = round(1000.0 * float(value), 4)
+            stage["max_ms"] = round(1000.0 * float(durations.max()), 4)
+            stages[name] = stage
+        if self.metrics is not None:
+            line = {"time": round(time.time(), 3), "elapsed": round(now - self.began, 3),
+                    "frames": self.frames, "fps": round(self.interval_frames / seconds, 3) if seconds > 0 else 0.0,
+                    "stages": stages, "counters": counters, "gauges": dict(self.gauges)}
+            if final:
+                line["final"] = True
+            self.metrics.write(json.dumps(line) + "\n")
+            self.metrics.flush()
+        self.interval_frames = 0
+        self.interval_began = now
+
+    def Stats(self):
+        """Run-level statistics
+        Args:
+            None
+        Return:
+            dict with frames, seconds, fps, counters, gauges and per
+            stage calls, seconds, share of the run and percentiles
+        """
+        seconds = time.perf_counter() - self.began
+        with self.lock:
+            totals = {name: tuple(total) for name, total in self.totals.items()}
+            pending = {name: np.asarray(samples) for name, samples in self.samples.items()}
+        stages = {}
+        for name, (calls, total, longest) in totals.items():
+            # the samples of the current interval are not in the run histogram yet
+            histogram = self.histograms[name] + np.bincount(_Bins(pending[name]), minlength=len(self.histograms[name]))
+            stage = {"calls": calls, "seconds": round(total, 6),
+                     "share": round(total / seconds, 4) if seconds > 0 else 0.0}
+            for q in PERCENTILES:
+                stage["p{}_ms".format(q)] = round(1000.0 * min(_HistogramPercentile(histogram, q), longest), 4)
+            stage["max_ms"] = round(1000.0 * longest, 4)
+            stages[name] = stage
+        return {"frames": self.frames, "seconds": round(seconds, 3),
+                "fps": round(self.frames / seconds, 3) if seconds > 0 else 0.0,
+                "stages": stages, "counters": dict(self.counters), "gauges": dict(self.gauges)}
+
+    def Report(self):
+        """Table of the run-level statistics
+        Args:
+            None
+        Return:
+            report string
+        """
+        stats = self.Stats()
+        lines = ["{} frames in {:.1f}s, {:.1f} frames/sec".format(stats["frames"], stats["seconds"], stats["fps"]),
+                 "{:<14} {:>8} {:>9} {:>6} {:>9} {:>9} {:>9} {:>9}".format(
+                     "stage", "calls", "seconds", "share", "p50 ms", "p90 ms", "p99 ms", "max ms")]
+        for name, stage in sorted(stats["stages"].items(), key=lambda item: -item[1]["seconds"]):
+            lines.append("{:<14} {:>8} {:>9.2f} {:>5.1f}% {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}".format(
+                name, stage["calls"], stage["seconds"], 100.0 * stage["share"],
+                stage["p50_ms"], stage["p90_ms"], stage["p99_ms"], stage["max_ms"]))
+        for name, value in sorted(stats["counters"].items()):
+            lines.append("{}: {}".format(name, value))
+        for name, value in sorted(stats["gauges"].items()):
+            lines.append("{}: {}".format(name, value))
+        return "\n".join(lines)
+
+    def Close(self):
+        """Write the last interval and close the metrics file
+        Args:
+            None
+        Return:
+            None
+        """
+        if self.metrics is not None:
+            self._Emit(final=True)
+            self.metrics.close()
+            self.metrics = None
@@ -0,0 +1,315 @@
+'''
+    File name         : results_store.py
+    File Description  : Columnar results store, one set of NPZ shards per run
+    Python Version    : 3
+'''
+
+# Import python libraries
+import json
+import os
+import threading
+
+import numpy as np
+
+# Per-cell columns and their dtypes, crops are paths relative to the results
+# folder: "<crop archive>/<chunk file>#<row>" or "Cell_<id>/<name>.png"
+CELL_COLUMNS = [("id", np.int64), ("first_index", np.int64),
+                ("middle_index", np.int64), ("n_points", np.int64),
+                ("mean_speed", np.float64), ("mean_deformation", np.float64),
+                ("first_crop", "U128"), ("mid_crop", "U128"),
+                ("last_crop", "U128")]
+# Per-point columns, one row per step of a cell (see Cell.KINEMATICS), with
+# the frame index of the step (-1 if unknown)
+POINT_COLUMNS = [("t", np.int64), ("frame", np.int64), ("x", np.int64), ("y", np.int64),
+                 ("speed", np.float64), ("smooth_speed", np.float64)]
+# Per-frame columns, one row per frame of a cell from the first line on:
+# its own detection (see detectors.DETECTION, zero where it was not
+# detected) and deformation index (NaN where it was not detected)
+FRAME_COLUMNS = [("w", np.int32), ("h", np.int32), ("area", np.float32),
+                 ("perimeter", np.float32), ("circularity", np.float32),
+                 ("major_axis", np.float32), ("minor_axis", np.float32),
+                 ("deformation", np.float64)]
+
+MANIFEST = "manifest.json"
+
+
+def _Ranges(lengths):
+    stop = np.cumsum(lengths, dtype=np.int64)
+    return stop - lengths, stop
+
+
+class ResultsStore(object):
+    """ResultsStore class appends the results of all cells of a run to one
+    directory of column-wise NPZ shards, instead of a directory of small
+    files per cell. Cells are buffered and written as a shard of up to
+    shard_size cells; every column is a separate array in the shard, and
+    the variable-length point and frame columns are concatenated with
+    per-cell start/stop offsets. manifest.json lists the shards with the
+    min/max of every numeric cell column, so readers can skip shards.
+    Shards are only ever added, so a crash loses at most the buffered
+    cells. Append is thread-safe.
+    Attributes:
+        directory: store directory
+        cells: number of cells appended
+    """
+
+    def __init__(self, directory, shard_size=256, compress=False, append=False):
+        """Initialize variables used by ResultsStore class
+        Args:
+            directory: store directory, created if missing
+            shard_size: cells per shard
+            compress: write compressed shards (smaller, slower to read)
+            append: keep the shards of an earlier run in directory and add
+                    to them, instead of replacing them
+        Return:
+            None
+        """
+        self.directory = directory
+        self.shard_size = shard_size
+        self.compress = compress
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.manifest = ReadManifest(directory)
+        if not append and self.manifest["shards"]:
+            for shard in self.manifest["shards"]:
+                os.remove(os.path.join(directory, shard["file"]))
+            self.manifest["shards"] = []
+            WriteManifest(directory, self.manifest)
+        self.cells = sum(shard["cells"] for shard in self.manifest["shards"])
+        self.pending = []
+
+    def Append(self, cell, points, frames):
+        """Add one cell, writing a shard when shard_size cells are buffered
+        Args:
+            cell: dict of CELL_COLUMNS values; missing crops are ""
+            points: dict or structured array of POINT_COLUMNS arrays
+            frames: dict or structured array of FRAME_COLUMNS arrays
+        Return:
+            None
+        """
+        row = tuple(cell.get(name, "") for name, _ in CELL_COLUMNS)
+        points = {name: np.asarray(points[name], dtype=dtype)
+                  for name, dtype in POINT_COLUMNS}
+        frames = {name: np.asarray(frames[name], dtype=dtype)
+                  for name, dtype in FRAME_COLUMNS}
+        with self.lock:
+            self.pending.append((row, points, frames))
+            self.cells += 1
+            if len(self.pending) >= self.shard_size:
+                self._Flush()
+
+    def Flush(self):
+        """Write the buffered cells as a shard
+        Args:
+            None
+        Return:
+            None
+        """
+        with self.lock:
+            self._Flush()
+
+    def _Flush(self):
+        if not self.pending:
+            return
+        rows, points, frames = zip(*self.pending)
+        self.pending = []
+        columns = {}
+        cells = np.array(list(rows), dtype=CELL_COLUMNS)
+        for name, _ in CELL_COLUMNS:
+            columns["cell." + name] = cells[name]
+        for prefix, parts, names in (("point", points, POINT_COLUMNS),
+                                     ("frame", frames, FRAME_COLUMNS)):
+            lengths = np.array([len(part[names[0][0]]) for part in parts], dtype=np.int64)
+            columns["cell.{}_start".format(prefix)], columns["cell.{}_stop".format(prefix)] = _Ranges(lengths)
+            for name, _ in names:
+                columns[prefix + "." + name] = np.concatenate([part[name] for part in parts])
+
+        index = len(self.manifest["shards"])
+        name = "cells_{:05d}.npz".format(index)
+        temp = os.path.join(self.directory, name + ".tmp")
+        with open(temp, "wb") as file:
+            (np.savez_compressed if self.compress else np.savez)(file, **columns)
+        os.replace(temp, os.path.join(self.directory, name))
+
+        stats = {}
+        for column, dtype in CELL_COLUMNS:
+            values = cells[column]
+            if np.dtype(dtype).kind in "if" and not np.isnan(values).all():
+                stats[column] = [np.nanmin(values).item(), np.nanmax(values).item()]
+        self.manifest["shards"].append({"file": name, "cells": len(cells),
+                                        "points": len(columns["point.t"]),
+                                        "stats": stats})
+        WriteManifest(self.directory, self.manifest)
+
+    def Truncate(self, shards):
+        """Drop the buffered cells and every shard after the first shards,
+        e.g. the cells written after a checkpoint that is resumed from
+        Args:
+            shards: number of shards kept
+        Return:
+            None
+        """
+        with self.lock:
+            self.pending = []
+            for shard in self.manifest["shards"][shards:]:
+                path = os.path.join(self.directory, shard["file"])
+                if os.path.exists(path):
+                    os.remove(path)
+            self.manifest["shards"] = self.manifest["shards"][:shards]
+            WriteManifest(self.directory, self.manifest)
+            self.cells = sum(shard["cells"] for shard in self.manifest["shards"])
+
+    def Close(self):
+        """Write the remaining buffered cells
+        Args:
+            None
+        Return:
+            None
+        """
+        self.Flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Close()
+        return False
+
+
+def ReadManifest(directory):
+    """Manifest of a store directory, empty if there is none yet"""
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return {"version": 1, "shards": []}
+    with open(path) as file:
+        return json.load(file)
+
+
+def WriteManifest(directory, manifest):
+    """Replace the manifest of a store directory atomically"""
+    path = os.path.join(directory, MANIFEST)
+    with open(path + ".tmp", "w") as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+class ResultsReader(object):
+    """ResultsReader class reads a ResultsStore directory. Only the
+    requested columns of the shards that can match the filters are
+    loaded.
+    Filters are given as column=(low, high) for an inclusive range of a
+    numeric cell column (either bound may be None), or column=values for
+    membership, e.g.
+        reader.Cells(["id", "mean_speed"], mean_deformation=(0.1, None))
+    Attributes:
+        None
+    """
+
+    def __init__(self, directory):
+        """Initialize variables used by ResultsReader class
+        Args:
+            directory: store directory
+        Return:
+            None
+        """
+        self.directory = directory
+        self.manifest = ReadManifest(directory)
+
+    def __len__(self):
+        return sum(shard["cells"] for shard in self.manifest["shards"])
+
+    def _Shards(self, filters):
+        for shard in self.manifest["shards"]:
+            stats = shard["stats"]
+            skip = False
+            for column, condition in filters.items():
+                if column not in stats:
+                    continue
+                low, high = stats[column]
+                if isinstance(condition, tuple):
+                    skip |= ((condition[0] is not None and high < condition[0])
+                             or (condition[1] is not None and low > condition[1]))
+                else:
+                    values = np.asarray(condition)
+                    skip |= not ((values >= low) & (values <= high)).any()
+            if not skip:
+                yield shard
+
+    @staticmethod
+    def _Mask(data, filters):
+        mask = np.ones(len(data["cell.id"]), dtype=bool)
+        for column, condition in filters.items():
+            values = data["cell." + column]
+            if isinstance(condition, tuple):
+                low, high = condition
+                if low is not None:
+                    mask &= values >= low
+                if high is not None:
+                    mask &= values <= high
+            else:
+                mask &= np.isin(values, np.asarray(condition))
+        return mask
+
+    def _Read(self, columns, filters, ranges):
+        """Yield (shard data, mask) with the wanted columns loaded"""
+        needed = set("cell." + name for name in columns) | set("cell." + name for name in filters)
+        needed.add("cell.id")
+        for prefix in ranges:
+            needed |= {"cell.{}_start".format(prefix), "cell.{}_stop".format(prefix)}
+        for shard in self._Shards(filters):
+            with np.load(os.path.join(self.directory, shard["file"])) as npz:
+                data = {name: npz[name] for name in needed}
+                mask = self._Mask(data, filters)
+                if mask.any():
+                    yield npz, data, mask
+
+    def Cells(self, columns=None, **filters):
+        """Per-cell columns of the matching cells
+        Args:
+            columns: names from CELL_COLUMNS, None for all
+            filters: see class docstring
+        Return:
+            dict of column name -> array
+        """
+        columns = [name for name, _ in CELL_COLUMNS] if columns is None else list(columns)
+        parts = {name: [] for name in columns}
+        for _, data, mask in self._Read(columns, filters, ()):
+            for name in columns:
+                parts[name].append(data["cell." + name][mask])
+        dtypes = dict(CELL_COLUMNS)
+        return {name: np.concatenate(parts[name]) if parts[name] else np.empty(0, dtype=dtypes[name])
+                for name in columns}
+
+    def _Ragged(self, prefix, names, columns, filters):
+        names = [name for name, _ in names] if columns is None else list(columns)
+        result = {}
+        for npz, data, mask in self._Read((), filters, (prefix,)):
+            stops = data["cell.{}_stop".format(prefix)]
+            # shards written before a column existed read it as -1
+            values = {name: npz[prefix + "." + name] if prefix + "." + name in npz.files
+                      else np.full(stops[-1] if len(stops) else 0, -1) for name in names}
+            starts = data["cell.{}_start".format(prefix)][mask]
+            stops = stops[mask]
+            for id, start, stop in zip(data["cell.id"][mask], starts, stops):
+                result[int(id)] = {name: values[name][start:stop] for name in names}
+        return result
+
+    def Points(self, columns=None, **filters):
+        """Per-point columns of the matching cells
+        Args:
+            columns: names from POINT_COLUMNS, None for all
+            filters: see class docstring
+        Return:
+            dict of cell id -> dict of column name -> array
+        """
+        return self._Ragged("point", POINT_COLUMNS, columns, filters)
+
+    def Frames(self, columns=None, **filters):
+        """Per-frame columns of the matching cells, e.g. deformation
+        Args:
+            columns: names from FRAME_COLUMNS, None for all
+            filters: see class docstring
+        Return:
+            dict of cell id -> dict of column name -> array
+        """
+        return self._Ragged("frame", FRAME_COLUMNS, columns, filters)
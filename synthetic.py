@@ -0,0 +1,287 @@
+'''
+    File name         : synthetic.py
+    File Description  : Synthetic flowing-cell sequences with ground truth and accuracy metrics
+    Python Version    : 3
+'''
+
+# Import python libraries
+import json
+import os
+
+import cv2
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+# Ground truth of one cell in one frame: centre, full ellipse axes along
+# and across the flow and deformation index (major - minor)/(major + minor),
+# which is what Cell.computeDeformation measures from the bounding box
+TRUTH = np.dtype([("frame", np.int64), ("id", np.int64), ("x", np.float64), ("y", np.float64),
+                  ("major_axis", np.float32), ("minor_axis", np.float32),
+                  ("deformation", np.float32)])
+
+TRUTH_FILE = "ground_truth.npy"
+PARAMETERS_FILE = "sequence.json"
+
+# fixed-point bits for sub-pixel drawing with cv2.ellipse
+_SHIFT = 4
+
+
+class FlowSequence(object):
+    """FlowSequence class generates a video of cells flowing along x
+    through a channel, with the ground truth of every cell in every
+    frame. Cells enter at the left edge at random heights as a Poisson
+    stream of spawn_rate cells per frame, keep their own speed (with a
+    little jitter) and are drawn as dark ellipses with a bright rim,
+    elongated along the flow by their deformation index, over a static
+    textured background with Gaussian noise. The same parameters and seed
+    give the same sequence.
+    Attributes:
+        parameters: dict of the generator parameters
+    """
+
+    def __init__(self, n_frames=1000, width=1280, height=240, spawn_rate=0.1,
+                 radius=(10.0, 14.0), speed=(6.0, 10.0), deformation=(0.0, 0.3),
+                 noise=3.0, speed_jitter=0.2, seed=0):
+        """Initialize variables used by FlowSequence class
+        Args:
+            n_frames: number of frames
+            width, height: frame size in pixels
+            spawn_rate: mean number of cells entering per frame
+            radius: (min, max) radius of an undeformed cell in pixels
+            speed: (min, max) speed in pixels per frame
+            deformation: (min, max) deformation index
+            noise: standard deviation of the per-frame noise
+            speed_jitter: standard deviation of the per-frame speed change
+            seed: random seed
+        Return:
+            None
+        """
+        self.parameters = dict(n_frames=n_frames, width=width, height=height, spawn_rate=spawn_rate,
+                               radius=list(radius), speed=list(speed), deformation=list(deformation),
+                               noise=noise, speed_jitter=speed_jitter, seed=seed)
+
+    def _Background(self, rng):
+        p = self.parameters
+        coarse = rng.normal(0, 8, (max(2, p["height"] // 40), max(2, p["width"] // 40)))
+        texture = cv2.resize(coarse, (p["width"], p["height"]), interpolation=cv2.INTER_CUBIC)
+        background = np.float32(120) + texture.astype(np.float32)
+        # channel walls
+        background[:6] = 60
+        background[-6:] = 60
+        return background
+
+    def __len__(self):
+        return self.parameters["n_frames"]
+
+    def __iter__(self):
+        """Yield (frame, truth) per frame, frame as a BGR uint8 image and
+        truth as a TRUTH array of the cells at least partly in view"""
+        p = self.parameters
+        rng = np.random.default_rng(p["seed"])
+        background = self._Background(rng)
+        r_max = p["radius"][1] * np.sqrt(1 + p["deformation"][1]) / np.sqrt(1 - min(p["deformation"][1], 0.9))
+        cells = []  # [id, x, y, speed, a, b, deformation]
+        next_id = 0
+        for frame_idx in range(p["n_frames"]):
+            for _ in range(rng.poisson(p["spawn_rate"])):
+                y = rng.uniform(6 + 2 * r_max, p["height"] - 6 - 2 * r_max)
+                # do not spawn on top of a cell that has just entered
+                if any(c[1] < 3 * r_max and abs(c[2] - y) < 3 * r_max for c in cells):
+                    continue
+                r = rng.uniform(*p["radius"])
+                d = rng.uniform(*p["deformation"])
+                # keep the area of the undeformed cell
+                a, b = r * np.sqrt((1 + d) / (1 - d)), r * np.sqrt((1 - d) / (1 + d))
+                cells.append([next_id, -a, y, rng.uniform(*p["speed"]), a, b, d])
+                next_id += 1
+
+            image = background.copy()
+            rows = []
+            for id, x, y, v, a, b, d in cells:
+                center = (int(round(x * (1 << _SHIFT))), int(round(y * (1 << _SHIFT))))
+                axes = (int(round(a * (1 << _SHIFT))), int(round(b * (1 << _SHIFT))))
+                cv2.ellipse(image, center, axes, 0, 0, 360, 175, 3, cv2.LINE_AA, _SHIFT)
+                cv2.ellipse(image, center, axes, 0, 0, 360, 40, -1, cv2.LINE_AA, _SHIFT)
+                if x + a > 0 and x - a < p["width"]:
+                    rows.append((frame_idx, id, x, y, 2 * a, 2 * b, d))
+            image += np.float32(p["noise"]) * rng.standard_normal(image.shape, dtype=np.float32)
+            gray = np.clip(image, 0, 255).astype(np.uint8)
+
+            for cell in cells:
+                cell[1] += max(0.5, cell[3] + rng.normal(0, p["speed_jitter"]))
+            cells = [cell for cell in cells if cell[1] - cell[4] < p["width"]]
+            yield cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR), np.array(rows, dtype=TRUTH)
+
+    def Write(self, folder):
+        """Write the sequence as numbered TIFFs with ground_truth.npy and
+        sequence.json (the parameters) next to them
+        Args:
+            folder: output folder, created if missing
+        Return:
+            TRUTH array of all frames
+        """
+        os.makedirs(folder, exist_ok=True)
+        truth = []
+        for frame_idx, (frame, rows) in enumerate(self):
+            # uncompressed, LZW makes writing several times slower
+            cv2.imwrite(os.path.join(folder, "{:06d}.tiff".format(frame_idx)), frame,
+                        [cv2.IMWRITE_TIFF_COMPRESSION, 1])
+            truth.append(rows)
+        truth = np.concatenate(truth) if truth else np.empty(0, dtype=TRUTH)
+        np.save(os.path.join(folder, TRUTH_FILE), truth)
+        with open(os.path.join(folder, PARAMETERS_FILE), "w") as file:
+            json.dump(self.parameters, file, indent=1)
+        return truth
+
+
+def LoadTruth(folder):
+    """Ground truth and parameters of a sequence written by FlowSequence
+    Args:
+        folder: sequence folder
+    Return:
+        TRUTH array, parameters dict
+    """
+    truth = np.load(os.path.join(folder, TRUTH_FILE))
+    with open(os.path.join(folder, PARAMETERS_FILE)) as file:
+        parameters = json.load(file)
+    return truth, parameters
+
+
+def _ByFrame(frames):
+    """Start and stop of every frame's rows in an array sorted by frame"""
+    order = np.argsort(frames, kind="stable")
+    frames = frames[order]
+    values, starts = np.unique(frames, return_index=True)
+    stops = np.append(starts[1:], len(frames))
+    return order, dict(zip(values.tolist(), zip(starts.tolist(), stops.tolist())))
+
+
+def _Match(a, b, radius):
+    """Pairs (i, j) of closest points of a and b at most radius apart"""
+    if len(a) == 0 or len(b) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    cost = np.hypot(a[:, None, 0] - b[None, :, 0], a[:, None, 1] - b[None, :, 1])
+    rows, cols = linear_sum_assignment(np.where(cost <= radius, cost, 1e9))
+    keep = cost[rows, cols] <= radius
+    return rows[keep], cols[keep]
+
+
+def DetectionAccuracy(truth, detections, radius=10.0, skip=0):
+    """Recall and precision of detected centroids against the ground truth
+    Args:
+        truth: TRUTH array
+        detections: per frame, an (N, 2) array of detected x, y
+        radius: largest distance of a detection from its cell
+        skip: frames at the start left out, e.g. while the background
+              model is learned
+    Return:
+        dict of recall, precision and mean centroid error in pixels
+    """
+    order, ranges = _ByFrame(truth["frame"])
+    truth = truth[order]
+    matched = expected = found = 0
+    errors = []
+    for frame_idx in range(skip, len(detections)):
+        start, stop = ranges.get(frame_idx, (0, 0))
+        cells = np.column_stack((truth["x"][start:stop], truth["y"][start:stop]))
+        points = np.asarray(detections[frame_idx], dtype=np.float64).reshape(-1, 2)
+        rows, cols = _Match(cells, points, radius)
+        matched += len(rows)
+        expected += len(cells)
+        found += len(points)
+        errors.extend(np.hypot(*(cells[rows] - points[cols]).T))
+    return {"recall": matched / expected if expected else 1.0,
+            "precision": matched / found if found else 1.0,
+            "centroid_error_px": float(np.mean(errors)) if errors else 0.0}
+
+
+def TrackingAccuracy(truth, frames, track_ids, cell_ids):
+    """ID switches and coverage of tracker output against the ground truth
+    Args:
+        truth: TRUTH array
+        frames, track_ids: frame index and track id of every detection a
+                           track was assigned
+        cell_ids: ground-truth cell id of each of these detections
+    Return:
+        dict of id_switches (a cell's track id changing), fragmented
+        cells (cells followed by more than one track), merged tracks
+        (tracks that followed more than one cell), coverage (share of
+        ground-truth points assigned to a track) and cells
+    """
+    order = np.argsort(np.asarray(frames), kind="stable")
+    last = {}  # cell id -> last track id
+    tracks = {}  # cell id -> set of track ids
+    cells = {}  # track id -> set of cell ids
+    switches = 0
+    for i in order.tolist():
+        cell, track = int(cell_ids[i]), int(track_ids[i])
+        if cell in last and last[cell] != track:
+            switches += 1
+        last[cell] = track
+        tracks.setdefault(cell, set()).add(track)
+        cells.setdefault(track, set()).add(cell)
+    return {"id_switches": switches,
+            "fragmented_cells": sum(len(t) > 1 for t in tracks.values()),
+            "merged_tracks": sum(len(c) > 1 for c in cells.values()),
+            "coverage": len(order) / len(truth) if len(truth) else 1.0,
+            "cells": int(len(np.unique(truth["id"])))}
+
+
+def CellAccuracy(truth, cells, traceStart, traceEnd, radius=10.0, deformation=None):
+    """Saved cells against the cells that crossed the trace band
+    Args:
+        truth: TRUTH array
+        cells: dict of saved cell id -> dict with "frame", "x" and "y"
+               arrays, e.g. ResultsReader.Points()
+        traceStart, traceEnd: trace lines
+        radius: largest distance of a cell point from the true cell
+        deformation: optional dict of saved cell id -> measured mean
+                     deformation
+    Return:
+        dict of expected, saved, missed, duplicate and false cells, and
+        the mean absolute deformation error if deformation is given
+    """
+    order, ranges = _ByFrame(truth["frame"])
+    truth = truth[order]
+    ids, first_x, last_x = _Ends(truth)
+    expected = set(ids[(first_x < traceStart) & (last_x > traceEnd)].tolist())
+    true_deformation = {int(id): float(d) for id, d in zip(truth["id"], truth["deformation"])}
+
+    owners = {}  # true cell id -> saved cell ids
+    false = 0
+    errors = []
+    for saved, columns in cells.items():
+        votes = {}
+        for frame_idx, x, y in zip(np.asarray(columns["frame"]).tolist(), columns["x"], columns["y"]):
+            start, stop = ranges.get(frame_idx, (0, 0))
+            if stop == start:
+                continue
+            distance = np.hypot(truth["x"][start:stop] - x, truth["y"][start:stop] - y)
+            nearest = int(np.argmin(distance))
+            if distance[nearest] <= radius:
+                id = int(truth["id"][start + nearest])
+                votes[id] = votes.get(id, 0) + 1
+        if not votes:
+            false += 1
+            continue
+        owner = max(votes, key=votes.get)
+        owners.setdefault(owner, []).append(saved)
+        if deformation is not None and np.isfinite(deformation.get(saved, np.nan)):
+            errors.append(abs(deformation[saved] - true_deformation[owner]))
+    found = expected & set(owners)
+    result = {"expected": len(expected), "saved": len(cells), "missed": len(expected - found),
+              "duplicate": sum(len(saved) - 1 for saved in owners.values()), "false": false}
+    if deformation is not None:
+        result["deformation_error"] = float(np.mean(errors)) if errors else float("nan")
+    return result
+
+
+def _Ends(truth):
+    """Cell ids and the x of every cell in its first and last frame"""
+    order = np.lexsort((truth["frame"], truth["id"]))
+    ids = truth["id"][order]
+    x = truth["x"][order]
+    unique = np.unique(ids)
+    starts = np.searchsorted(ids, unique, side="left")
+    stops = np.searchsorted(ids, unique, side="right")
+    return unique, x[starts], x[stops - 1]
@@ -0,0 +1,124 @@
+'''
+    File name         : track_trace.py
+    File Description  : Bounded trace path storage for tracks
+    Python Version    : 3
+'''
+
+# Import python libraries
+import numpy as np
+
+
+class Trace(object):
+    """Trace class stores the path of a track as float32 rows of
+    (x, y, frame_idx) in a ring buffer of at most capacity rows.
+    Every row is written twice, at its slot and at slot + capacity, so the
+    live rows are always one contiguous block: append and eviction are
+    O(1) and View() is a zero-copy array view, oldest row first.
+    The buffer starts small and doubles up to capacity.
+    Optionally every row carries a record of the given structured dtype,
+    e.g. the features of the detection the point was corrected with,
+    kept in a second buffer with the same layout.
+    Attributes:
+        capacity: maximum number of rows kept
+        appended: number of rows appended since the track started
+    """
+
+    def __init__(self, capacity, initial=64, record_dtype=None):
+        """Initialize variables used by Trace class
+        Args:
+            capacity: maximum trace length, older rows are evicted
+            initial: initial allocation in rows
+            record_dtype: structured dtype of the per-row records, None
+                          for no records
+        Return:
+            None
+        """
+        self.capacity = int(capacity)
+        self.size = min(self.capacity, initial)  # allocated rows
+        self.buffer = np.zeros((2 * self.size, 3), dtype=np.float32)
+        self.records = None
+        if record_dtype is not None:
+            self.records = np.zeros(2 * self.size, dtype=record_dtype)
+        self.start = 0  # slot of the oldest row
+        self.length = 0
+        self.appended = 0
+
+    def __len__(self):
+        return self.length
+
+    def _Grow(self):
+        size = min(self.capacity, 2 * self.size)
+        buffer = np.zeros((2 * size, 3), dtype=np.float32)
+        # only grows before the first eviction, so rows start at slot 0
+        buffer[:self.length] = self.buffer[:self.length]
+        buffer[size:size + self.length] = self.buffer[:self.length]
+        self.buffer = buffer
+        if self.records is not None:
+            records = np.zeros(2 * size, dtype=self.records.dtype)
+            records[:self.length] = self.records[:self.length]
+            records[size:size + self.length] = self.records[:self.length]
+            self.records = records
+        self.size = size
+
+    def Append(self, x, y, frame_idx, record=None):
+        """Append a point, evicting the oldest one when full
+        Args:
+            x, y: position
+            frame_idx: absolute frame number of the position
+            record: record of the point, None for a zeroed record
+        Return:
+            None
+        """
+        if self.length == self.size:
+            if self.size < self.capacity:
+                self._Grow()
+            else:
+                self.start = (self.start + 1) % self.size
+                self.length -= 1
+        slot = (self.start + self.length) % self.size
+        self.buffer[slot] = (x, y, frame_idx)
+        self.buffer[slot + self.size] = self.buffer[slot]
+        if self.records is not None:
+            if record is None:
+                self.records[slot] = 0
+            else:
+                self.records[slot] = record
+            self.records[slot + self.size] = self.records[slot]
+        self.length += 1
+        self.appended += 1
+
+    def Clear(self):
+        """Drop all points, keeping the allocation
+        Args:
+            None
+        Return:
+            None
+        """
+        self.start = 0
+        self.length = 0
+
+    def View(self):
+        """(length, 3) view of (x, y, frame_idx) rows, oldest first"""
+        return self.buffer[self.start:self.start + self.length]
+
+    def Records(self):
+        """(length,) view of the records, oldest first, None without"""
+        if self.records is None:
+            return None
+        return self.records[self.start:self.start + self.length]
+
+    @property
+    def x(self):
+        return self.View()[:, 0]
+
+    @property
+    def y(self):
+        return self.View()[:, 1]
+
+    @property
+    def frames(self):
+        return self.View()[:, 2]
+
+    def Points(self):
+        """(length, 2) view of (x, y) rows, e.g. for cv2.polylines"""
+        return self.View()[:, :2]
@@ -8,10 +8,23 @@
 '''
 
 # Import python libraries
+from collections import namedtuple
+
 import numpy as np
-from kalman_filter import KalmanFilter
-from common import dprint
+from kalman_filter import BatchKalmanFilter
+from track_trace import Trace
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+
+# Emitted by Tracker.Update when a track has crossed the trace band: its
+# trace starts before the first line and its last point is past the end
+# line. Indices are into track.trace at the time of the event.
+CellEvent = namedtuple("CellEvent", ["track", "first_index", "middle_index",
+                                     "first_frame", "middle_frame",
+                                     "last_frame"])
 
 
 class Track(object):
@@ -20,20 +33,26 @@ class Track(object):
         None
     """
 
-    def __init__(self, prediction, trackIdCount):
+    def __init__(self, prediction, trackIdCount, slot, max_trace_length,
+                 record_dtype=None):
         """Initialize variables used by Track class
         Args:
             prediction: predicted centroids of object to be tracked
             trackIdCount: identification of each track object
+            slot: slot of this track in the tracker's BatchKalmanFilter
+            max_trace_length: trace path history length
+            record_dtype: dtype of the detection records kept in the trace
         Return:
             None
         """
         self.track_id = trackIdCount  # identification of each track object
-        self.KF = KalmanFilter()  # KF instance to track this object
+        self.slot = slot  # Kalman filter state slot of this object
         self.prediction = np.asarray(prediction)  # predicted centroids (x,y)
         self.skipped_frames = 0  # number of frames skipped undetected
-        self.trace = []  # trace path
+        self.trace = Trace(max_trace_length, record_dtype=record_dtype)  # trace path (x, y, frame_idx)
         self.tracked = 0 # is 0 if not saved in cells yet, is 1 if saved
+        self.first_line = None  # trace.appended count when first line is passed
+        self.middle_line = None  # trace.appended count when middle is passed
 
 
 class Tracker(object):
@@ -43,7 +62,8 @@ class Tracker(object):
     """
 
     def __init__(self, dist_thresh, max_frames_to_skip, max_trace_length,
-                 trackIdCount):
+                 trackIdCount, gating="dense", kalman_model="legacy",
+                 trace_start=None, trace_end=None, record_dtype=None):
         """Initialize variable used by Tracker class
         Args:
             dist_thresh: distance threshold. When exceeds the threshold,
@@ -52,16 +72,39 @@ class Tracker(object):
                                 the track object undetected
             max_trace_lenght: trace path history length
             trackIdCount: identification of each track object
+            gating: "dense" solves one assignment over all tracks and
+                    detections; "sparse" only pairs tracks with detections
+                    within dist_thresh (KD-tree) and solves each connected
+                    group separately, which keeps dense frames near
+                    linear time. In sparse mode a track with no detection
+                    within dist_thresh counts a skipped frame.
+            kalman_model: BatchKalmanFilter model, "legacy" (x, y) or
+                          "cv" constant velocity (x, y, vx, vy)
+            trace_start, trace_end: x positions of the first and end
+                                    lines; when given, Update reports
+                                    tracks that crossed the band
+            record_dtype: structured dtype of per-detection records (e.g.
+                          detectors.DETECTION) to keep in the traces,
+                          None for none
         Return:
             None
         """
+        if gating not in ("dense", "sparse"):
+            raise ValueError("gating must be 'dense' or 'sparse'")
+        self.gating = gating
         self.dist_thresh = dist_thresh
         self.max_frames_to_skip = max_frames_to_skip
         self.max_trace_length = max_trace_length
         self.tracks = []
+        self.kf = BatchKalmanFilter(kalman_model)  # states of all tracks
+        self.predictions = np.empty((0, 2))  # (N, 2) predicted centroids of tracks
         self.trackIdCount = trackIdCount
+        self.frameCount = 0  # frame index used when Update is not given one
+        self.trace_start = trace_start
+        self.trace_end = trace_end
+        self.record_dtype = record_dtype
 
-    def Update(self, detections):
+    def Update(self, detections, frame_idx=None, records=None):
         """Update tracks vector using following steps:
             - Create tracks if no tracks vector found
             - Calculate cost using sum of square distance
@@ -69,111 +112,229 @@ class Tracker(object):
             - Using Hungarian Algorithm assign the correct
               detected measurements to predicted tracks
               https://en.wikipedia.org/wiki/Hungarian_algorithm
+            - Un_assign pairs whose cost exceeds dist_thresh
             - Identify tracks with no assignment, if any
             - If tracks are not detected for long time, remove them
             - Now look for un_assigned detects
             - Start new tracks
             - Update KalmanFilter state, lastResults and tracks trace
+            - Check the new trace points against the trace lines
         Args:
             detections: detected centroids of object to be tracked
-            deformationRatios: detected deformation ratio of objects to be tracked
+            frame_idx: absolute frame number of the detections, stored
+                       in the trace; defaults to a count of Update calls
+            records: array of record_dtype, one per detection; the record
+                     of the detection assigned to a track is stored with
+                     its trace point, coasting tracks store a zeroed one
         Return:
-            None
+            events: CellEvent for every track that completed the trace
+                    band in this update (those tracks are marked tracked)
         """
 
+        if frame_idx is None:
+            frame_idx = self.frameCount
+        self.frameCount = frame_idx + 1
+
+        # Stack detected centroids as a contiguous (M, 2) array
+        points = np.asarray(detections, dtype=float).reshape(-1, 2)
+
         # Create tracks if no tracks vector found
         if (len(self.tracks) == 0):
             for i in range(len(detections)):
-                track = Track(detections[i], self.trackIdCount)
-                self.trackIdCount += 1
-                self.tracks.append(track)
-
-        # Calculate cost using sum of square distance between
-        # predicted vs detected centroids
-        N = len(self.tracks)
-        M = len(detections)
-        cost = np.zeros(shape=(N, M))   # Cost matrix
-        for i in range(len(self.tracks)):
-            for j in range(len(detections)):
-                try:
-                    diff = self.tracks[i].prediction - detections[j]
-                    distance = np.sqrt(diff[0][0]*diff[0][0] +
-                                       diff[1][0]*diff[1][0])
-                    cost[i][j] = distance
-                except:
-                    pass
+                self._NewTrack(detections[i])
+            self.predictions = points.copy()
+
+        M = len(points)
+        if self.gating == "sparse":
+            assignment = self._SparseAssign(points)
+            unmatched = assignment == -1
+        else:
+            assignment, unmatched = self._DenseAssign(points)
+        for i in np.flatnonzero(unmatched):
+            self.tracks[i].skipped_frames += 1
+
+        # Tracks already saved as cells no longer need their trace
+        for track in self.tracks:
+            if (track.tracked == 1):
+                track.trace.Clear()
+
+        # If tracks are not detected for long time, remove them
+        keep = np.array([track.skipped_frames <= self.max_frames_to_skip
+                         for track in self.tracks], dtype=bool)
+        if not keep.all():
+            for track in [track for track, k in zip(self.tracks, keep) if not k]:
+                self.kf.Remove(track.slot)
+            self.tracks = [track for track, k in zip(self.tracks, keep) if k]
+            assignment = assignment[keep]
+
+        # Now look for un_assigned detects
+        un_assigned_detects = np.ones(M, dtype=bool)
+        un_assigned_detects[assignment[assignment != -1]] = False
+
+        # Start new tracks
+        for j in np.flatnonzero(un_assigned_detects):
+            self._NewTrack(detections[j])
+
+        # Update KalmanFilter state of all assigned/coasting tracks at once
+        n = len(assignment)
+        slots = np.array([track.slot for track in self.tracks[:n]], dtype=int)
+        detected = assignment != -1
+        b = np.zeros((n, 2))
+        b[detected] = points[assignment[detected]]
+        self.kf.Predict(slots)
+        predictions = np.empty((len(self.tracks), 2))
+        predictions[:n] = self.kf.Correct(slots, b, detected)
+
+        # Update lastResults and tracks trace
+        for i in range(n):
+            record = None
+            if(detected[i]):
+                self.tracks[i].skipped_frames = 0
+                if records is not None:
+                    record = records[assignment[i]]
+            self.tracks[i].prediction = predictions[i].reshape(2, 1)
+            self.tracks[i].trace.Append(predictions[i, 0], predictions[i, 1],
+                                        frame_idx, record)
+
+        # New tracks predict their detection until their first update
+        predictions[len(assignment):] = points[un_assigned_detects]
+        self.predictions = predictions
+
+        # Check line crossings of the points just appended
+        events = []
+        if self.trace_start is not None:
+            for i in range(n):
+                if (self.tracks[i].tracked == 0):
+                    event = self._CheckLines(self.tracks[i], predictions[i, 0])
+                    if event is not None:
+                        events.append(event)
+        return events
+
+    def _CheckLines(self, track, x):
+        """Record when a track passes the first and middle lines and report
+        it once its newest point, x, is past the end line while its trace
+        still starts before the first line. O(1) per point.
+        Args:
+            track: track whose trace just got point x
+            x: x position of the newest trace point
+        Return:
+            CellEvent, or None
+        """
+        middle = (self.trace_start + self.trace_end) / 2
+        count = track.trace.appended - 1  # count of the newest point
+        if (track.first_line is None) and (x >= self.trace_start):
+            track.first_line = count
+        if (track.middle_line is None) and (x >= middle):
+            track.middle_line = count
+        if not ((x > self.trace_end) and (track.trace.x[0] < self.trace_start)):
+            return None
+
+        # Convert append counts into indices of the current trace
+        evicted = track.trace.appended - len(track.trace)
+        first = track.first_line - evicted
+        mid = track.middle_line - evicted
+        if first < 0 or mid < 0:  # passed before the oldest kept point
+            xs = track.trace.x
+            first = int(np.argmax(xs >= self.trace_start))
+            mid = int(np.argmax(xs >= middle))
+        frames = track.trace.frames
+        track.tracked = 1
+        return CellEvent(track, first, mid, int(frames[first]),
+                         int(frames[mid]), int(frames[-1]))
+
+    def _NewTrack(self, detection):
+        """Start a new track at a detection
+        Args:
+            detection: detected centroid (2, 1)
+        Return:
+            None
+        """
+        track = Track(detection, self.trackIdCount, self.kf.Add(detection),
+                      self.max_trace_length, self.record_dtype)
+        self.trackIdCount += 1
+        self.tracks.append(track)
+
+    def _DenseAssign(self, points):
+        """Assign detections to tracks with one Hungarian Algorithm solve
+        over the full cost matrix
+        Args:
+            points: (M, 2) detected centroids
+        Return:
+            assignment: detection index per track, -1 if none
+            unmatched: tracks left out of the assignment
+        """
+        # Calculate cost using the distance between predicted vs detected
+        # centroids, broadcast over all (track, detection) pairs
+        N = len(self.predictions)
+        diff = self.predictions[:, np.newaxis, :] - points[np.newaxis, :, :]
+        cost = np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
 
         # Let's average the squared ERROR
         cost = (0.5) * cost
+
         # Using Hungarian Algorithm assign the correct detected measurements
         # to predicted tracks
-        assignment = []
-        for _ in range(N):
-            assignment.append(-1)
         row_ind, col_ind = linear_sum_assignment(cost)
-        for i in range(len(row_ind)):
-            assignment[row_ind[i]] = col_ind[i]
-
-        # Identify tracks with no assignment, if any
-        un_assigned_tracks = []
-        for i in range(len(assignment)):
-            if (assignment[i] != -1):
-                # check for cost distance threshold.
-                # If cost is very high then un_assign (delete) the track
-                if (cost[i][assignment[i]] > self.dist_thresh):
-                    assignment[i] = -1
-                    un_assigned_tracks.append(i)
-                pass
-            else:
-                self.tracks[i].skipped_frames += 1
 
-        # If tracks are not detected for long time, remove them
-        if(self.tracks[i].tracked == 1):
-            del self.tracks[i].trace[:]
-
-        del_tracks = []
-        for i in range(len(self.tracks)):
-            if (self.tracks[i].skipped_frames > self.max_frames_to_skip):
-                del_tracks.append(i)
-        if (len(del_tracks) > 0):  # only when skipped frame exceeds max
-            for id in del_tracks:
-                if id < len(self.tracks):
-                    del self.tracks[id]
-                    del assignment[id]
-                else:
-                    dprint("ERROR: id is greater than length of tracks")
+        # Identify tracks with no assignment, if any. Pairs whose cost is
+        # above the distance threshold are un_assigned (gated) afterwards,
+        # only tracks left out of the assignment count a skipped frame
+        assignment = np.full(N, -1, dtype=int)
+        valid = cost[row_ind, col_ind] <= self.dist_thresh
+        assignment[row_ind[valid]] = col_ind[valid]
+        unmatched = np.ones(N, dtype=bool)
+        unmatched[row_ind] = False
+        return assignment, unmatched
 
-        # Now look for un_assigned detects
-        un_assigned_detects = []
-        for i in range(len(detections)):
-                if i not in assignment:
-                    un_assigned_detects.append(i)
+    def _SparseAssign(self, points):
+        """Assign detections to tracks using only candidate pairs within
+        dist_thresh, found with a KD-tree. The bipartite candidate graph is
+        split into connected components and each one is solved on its own.
+        Args:
+            points: (M, 2) detected centroids
+        Return:
+            assignment: detection index per track, -1 if none
+        """
+        N = len(self.predictions)
+        M = len(points)
+        assignment = np.full(N, -1, dtype=int)
+        if N == 0 or M == 0:
+            return assignment
 
-        # Start new tracks
-        if(len(un_assigned_detects) != 0):
-            for i in range(len(un_assigned_detects)):
-                track = Track(detections[un_assigned_detects[i]],
-                              self.trackIdCount)
-                self.trackIdCount += 1
-                self.tracks.append(track)
-
-        # Update KalmanFilter state, lastResults and tracks trace
-        for i in range(len(assignment)):
-            self.tracks[i].KF.predict()
-
-            if(assignment[i] != -1):
-                self.tracks[i].skipped_frames = 0
-                self.tracks[i].prediction = self.tracks[i].KF.correct(
-                                            detections[assignment[i]], 1)
-            else:
-                self.tracks[i].prediction = self.tracks[i].KF.correct(
-                                            np.array([[0], [0]]), 0)
-
-            if(len(self.tracks[i].trace) > self.max_trace_length):
-                for j in range(len(self.tracks[i].trace) -
-                               self.max_trace_length):
-                    del self.tracks[i].trace[j]
-
-            self.tracks[i].trace.append(self.tracks[i].prediction)
-            self.tracks[i].KF.lastResult = self.tracks[i].prediction
-            
\ No newline at end of file
+        # Candidate pairs: cost = half the distance, so distance <= 2 * dist_thresh
+        candidates = cKDTree(points).query_ball_point(self.predictions,
+                                                      r=2.0 * self.dist_thresh)
+        counts = np.fromiter((len(c) for c in candidates), dtype=int, count=N)
+        rows = np.repeat(np.arange(N), counts)
+        cols = np.fromiter((j for c in candidates for j in c), dtype=int,
+                           count=counts.sum())
+        cost = 0.5 * np.linalg.norm(self.predictions[rows] - points[cols], axis=1)
+        keep = cost <= self.dist_thresh
+        rows, cols, cost = rows[keep], cols[keep], cost[keep]
+        if len(rows) == 0:
+            return assignment
+
+        # Tracks are nodes 0..N-1, detections are nodes N..N+M-1
+        graph = coo_matrix((np.ones(len(rows)), (rows, N + cols)),
+                           shape=(N + M, N + M))
+        _, labels = connected_components(graph, directed=False)
+
+        # Solve each component; pairs within a component that are not
+        # candidates cost more than any set of candidate pairs
+        order = np.argsort(labels[rows], kind="stable")
+        rows, cols, cost = rows[order], cols[order], cost[order]
+        bounds = np.flatnonzero(np.diff(labels[rows])) + 1
+        for r, c, w in zip(np.split(rows, bounds), np.split(cols, bounds),
+                           np.split(cost, bounds)):
+            if len(r) == 1:
+                assignment[r[0]] = c[0]
+                continue
+            sub_rows, r_idx = np.unique(r, return_inverse=True)
+            sub_cols, c_idx = np.unique(c, return_inverse=True)
+            gate_cost = (self.dist_thresh + 1.0) * (min(len(sub_rows), len(sub_cols)) + 1)
+            sub = np.full((len(sub_rows), len(sub_cols)), gate_cost)
+            sub[r_idx, c_idx] = w
+            row_ind, col_ind = linear_sum_assignment(sub)
+            valid = sub[row_ind, col_ind] <= self.dist_thresh
+            assignment[sub_rows[row_ind[valid]]] = sub_cols[col_ind[valid]]
+        return assignment